@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""Benchmark the checker's own overhead, offline
+
+Runs each phase of checking a repo against synthetic local git repos,
+with in-process stand-ins for the docker client, test containers
+and jupyter-repo2docker, so only our orchestration is measured:
+
+- clone_repo: mirroring and checking out a local repo (cold and cached)
+- build_image: capturing --build-mb MB of fake repo2docker output (via tee)
+- find_notebooks: listing --notebooks notebooks, from git and by walking
+- run_tests: batching tests into fake containers and splitting their logs
+- results: writing --results results to CSV and SQLite
+
+Output is JSON with the best time of --repeat runs of each benchmark.
+Compare with the output from another commit with --compare,
+which exits with status 1 if anything got slower than --threshold:
+
+    python benchmarks/bench_checker.py -o before.json
+    git checkout ...
+    python benchmarks/bench_checker.py -o after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from subprocess import check_output
+from subprocess import DEVNULL
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import docker  # noqa
+
+from repo2docker_checker import checker  # noqa
+from repo2docker_checker import prune  # noqa
+from repo2docker_checker.gitcache import GitCache  # noqa
+from repo2docker_checker.results import CSVResults  # noqa
+from repo2docker_checker.results import SQLiteResults  # noqa
+from repo2docker_checker.results import TestResult  # noqa
+
+LINE = b"  Downloading numpy-1.19.0-cp38-cp38-manylinux2010_x86_64.whl (14.6 MB)\n"
+
+# bump when benchmarks change in ways that make old results incomparable
+VERSION = 1
+
+
+class FakeImage:
+    def __init__(self, images, image_id):
+        self.images = images
+        self.id = image_id
+
+    def tag(self, repository, tag):
+        self.images[f"{repository}:{tag}"] = self
+
+
+class FakeImages(dict):
+    def get(self, image_id):
+        if image_id not in self:
+            raise docker.errors.ImageNotFound(image_id)
+        return self[image_id]
+
+
+class FakeDocker:
+    """Stand-in for the docker client, with images in a dict"""
+
+    def __init__(self):
+        self.images = FakeImages()
+
+    def info(self):
+        return {"NCPU": os.cpu_count() or 1, "MemTotal": 0}
+
+
+class FakeRepo2Docker:
+    """Stand-in for running jupyter-repo2docker (checker.run)
+
+    Writes build_bytes of pip-like output to stdout,
+    and adds the image to the fake docker client.
+    """
+
+    def __init__(self, client, build_bytes):
+        self.client = client
+        self.block = LINE * (64 * 1024 // len(LINE))
+        self.n_blocks = max(1, build_bytes // len(self.block))
+
+    def __call__(self, cmd, stdout=None, **kwargs):
+        image_id = cmd[cmd.index("--image-name") + 1]
+        for i in range(self.n_blocks):
+            stdout.write(self.block)
+        stdout.flush()
+        self.client.images[image_id] = FakeImage(self.client.images, image_id)
+
+
+class FakeEngine:
+    """Stand-in for checker.engine(), running inrepo instantly
+
+    Every test passes, with log_bytes of output each.
+    """
+
+    def __init__(self, log_bytes=10000):
+        self.output = (LINE * (log_bytes // len(LINE) + 1))[:log_bytes]
+
+    def run_container(self, config, log_w, timeout=None):
+        # host_path:container_path:mode
+        io_dir = next(
+            bind.split(":")[0]
+            for bind in config["HostConfig"]["Binds"]
+            if bind.split(":")[1] == "/io"
+        )
+        args = config["Cmd"]
+        if "batch" in args:
+            manifest = args[-1].replace("/io", io_dir, 1)
+            batch_dir = os.path.dirname(manifest)
+            with open(manifest) as f:
+                tests = json.load(f)
+            with open(os.path.join(batch_dir, "results.jsonl"), "w") as results_f:
+                for i, (kind, argument) in enumerate(tests):
+                    with open(os.path.join(batch_dir, f"{i}.log"), "wb") as f:
+                        f.write(self.output)
+                    record = {
+                        "index": i,
+                        "kind": kind,
+                        "test_id": argument,
+                        "success": True,
+                        "log": f"{i}.log",
+                        "duration": 0,
+                    }
+                    results_f.write(json.dumps(record) + "\n")
+        else:
+            log_w.write(self.output)
+        return {"StatusCode": 0}
+
+
+@contextmanager
+def patched(obj, **attrs):
+    """Temporarily set attributes (e.g. module globals)"""
+    saved = {name: getattr(obj, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(obj, name, value)
+
+
+def git(*args, cwd=None):
+    env = dict(os.environ)
+    env.update(
+        {
+            "GIT_AUTHOR_NAME": "bench",
+            "GIT_AUTHOR_EMAIL": "bench@example.com",
+            "GIT_COMMITTER_NAME": "bench",
+            "GIT_COMMITTER_EMAIL": "bench@example.com",
+        }
+    )
+    return check_output(("git",) + args, cwd=cwd, env=env, stderr=DEVNULL)
+
+
+def make_repo(path, n_notebooks, notebook_bytes=10000):
+    """Make a local git repo with n_notebooks notebooks, in nested directories
+
+    Also has requirements.txt and some files that aren't notebooks.
+    """
+    os.makedirs(path)
+    filler = "x" * notebook_bytes
+    nb = {
+        "cells": [
+            {"cell_type": "markdown", "metadata": {}, "source": filler},
+            {
+                "cell_type": "code",
+                "execution_count": None,
+                "metadata": {},
+                "outputs": [],
+                "source": "1 + 1",
+            },
+        ],
+        "metadata": {"kernelspec": {"name": "python3", "language": "python"}},
+        "nbformat": 4,
+        "nbformat_minor": 4,
+    }
+    for i in range(n_notebooks):
+        # spread notebooks over a few levels of directories
+        parts = [f"dir{i % (d + 2)}" for d in range(i % 4)]
+        nb_dir = os.path.join(path, *parts)
+        os.makedirs(nb_dir, exist_ok=True)
+        with open(os.path.join(nb_dir, f"nb{i}.ipynb"), "w") as f:
+            json.dump(nb, f)
+        with open(os.path.join(nb_dir, f"data{i}.csv"), "w") as f:
+            f.write("a,b\n1,2\n")
+    with open(os.path.join(path, "requirements.txt"), "w") as f:
+        f.write("numpy\n")
+    git("init", "-q", cwd=path)
+    git("symbolic-ref", "HEAD", "refs/heads/master", cwd=path)
+    git("add", "-A", cwd=path)
+    git("commit", "-q", "-m", "synthetic repo", cwd=path)
+    return path
+
+
+def bench_clone(td, repo_path):
+    """Clone into an empty cache, then again from the cache"""
+    repo = f"file://{repo_path}"
+    times = {}
+    with patched(checker, git_cache=GitCache(os.path.join(td, "git-cache"), echo=None)):
+        for key in ("clone_repo_cold", "clone_repo_cached"):
+            tic = time.perf_counter()
+            checkout_path, resolved_ref, last_modified = checker.clone_repo(
+                repo, "master"
+            )
+            times[key] = time.perf_counter() - tic
+            checker.remove_checkout(checkout_path)
+    shutil.rmtree(os.path.join(td, "git-cache"))
+    return times
+
+
+def bench_build(td, repo_path, build_bytes):
+    """Build with a fake repo2docker producing build_bytes of output"""
+    client = FakeDocker()
+    log_file = os.path.join(td, "build.txt")
+    with patched(
+        checker,
+        _docker_client=client,
+        run=FakeRepo2Docker(client, build_bytes),
+        quiet=True,
+    ):
+        tic = time.perf_counter()
+        checker.build_image(
+            "https://example.com/repo", "abc1234", repo_path, log_file, force_build=True
+        )
+        seconds = time.perf_counter() - tic
+    os.remove(log_file)
+    return {"build_image": seconds}
+
+
+def bench_find_notebooks(td, repo_path):
+    """Find notebooks from the git index, and by walking a copy without .git"""
+    walk_path = os.path.join(td, "walk")
+    if not os.path.exists(walk_path):
+        shutil.copytree(repo_path, walk_path, ignore=shutil.ignore_patterns(".git"))
+    times = {}
+    for key, path in [
+        ("find_notebooks_git", repo_path),
+        ("find_notebooks_walk", walk_path),
+    ]:
+        tic = time.perf_counter()
+        checker.find_notebooks(path)
+        times[key] = time.perf_counter() - tic
+    return times
+
+
+def bench_run_tests(td, repo_path, n_notebooks):
+    """Run all notebooks in fake containers, in one batch and one per container"""
+    times = {}
+    for key, per_container in [("run_tests_batch", 0), ("run_tests_each", 1)]:
+        run_dir = os.path.join(td, "run")
+        os.makedirs(os.path.join(run_dir, "logs"))
+        with patched(
+            checker,
+            _engine=FakeEngine(),
+            _docker_client=FakeDocker(),
+            _test_slots=None,
+            notebook_limit=n_notebooks,
+            tests_per_container=per_container,
+            quiet=True,
+        ):
+            tic = time.perf_counter()
+            results = list(checker.run_tests("image", repo_path, run_dir))
+            times[key] = time.perf_counter() - tic
+        assert len(results) == n_notebooks and all(r["success"] for r in results)
+        shutil.rmtree(run_dir)
+    return times
+
+
+def bench_results(td, n_results):
+    """Write n_results results to CSV and SQLite"""
+    results = [
+        TestResult(
+            f"https://github.com/org/repo{i // 10}",
+            "master",
+            "abc1234",
+            "2020-01-01T00:00:00+00:00",
+            "notebook",
+            f"nb{i}.ipynb",
+            True,
+            f"logs/test-{i}.txt",
+            "2020-01-01T00:00:00",
+            "bench",
+            "0.11.0",
+            "",
+            1.5,
+        )
+        for i in range(n_results)
+    ]
+    times = {}
+    path = os.path.join(td, "results.csv")
+    tic = time.perf_counter()
+    with CSVResults(path) as csv_results:
+        for result in results:
+            csv_results.add(result)
+    times["results_csv"] = time.perf_counter() - tic
+    os.remove(path)
+
+    path = os.path.join(td, "results.sqlite")
+    tic = time.perf_counter()
+    db = SQLiteResults(path)
+    for result in results:
+        db.add(result)
+    db.close()
+    times["results_sqlite"] = time.perf_counter() - tic
+    os.remove(path)
+    return times
+
+
+def run_benchmarks(notebooks=200, build_mb=100, n_results=10000, repeat=5):
+    """Run all benchmarks, return the results as a dict"""
+    params = {
+        "notebooks": notebooks,
+        "build_mb": build_mb,
+        "results": n_results,
+        "repeat": repeat,
+    }
+    # amount of work done by each benchmark, for throughput
+    amounts = {
+        "build_image": (build_mb, "MB"),
+        "find_notebooks_git": (notebooks, "notebooks"),
+        "find_notebooks_walk": (notebooks, "notebooks"),
+        "run_tests_batch": (notebooks, "tests"),
+        "run_tests_each": (notebooks, "tests"),
+        "results_csv": (n_results, "results"),
+        "results_sqlite": (n_results, "results"),
+    }
+    all_times = {}
+    with tempfile.TemporaryDirectory() as td, patched(
+        prune, usage_file=os.path.join(td, "image-usage.json")
+    ):
+        repo_path = make_repo(os.path.join(td, "repo"), notebooks)
+        for i in range(repeat):
+            for times in (
+                bench_clone(td, repo_path),
+                bench_build(td, repo_path, build_mb * 1024 * 1024),
+                bench_find_notebooks(td, repo_path),
+                bench_run_tests(td, repo_path, notebooks),
+                bench_results(td, n_results),
+            ):
+                for key, seconds in times.items():
+                    all_times.setdefault(key, []).append(seconds)
+
+    benchmarks = {}
+    for key, times in all_times.items():
+        best = min(times)
+        benchmarks[key] = {
+            "seconds": round(best, 6),
+            "all": [round(t, 6) for t in times],
+        }
+        if key in amounts:
+            amount, unit = amounts[key]
+            benchmarks[key][f"{unit}_per_s"] = round(amount / best, 1)
+    try:
+        commit = (
+            check_output(["git", "rev-parse", "HEAD"], cwd=here, stderr=DEVNULL)
+            .decode("utf8")
+            .strip()
+        )
+    except Exception:
+        commit = None
+    return {
+        "version": VERSION,
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "benchmarks": benchmarks,
+    }
+
+
+def compare(before, after, threshold=1.5):
+    """Compare two benchmark results
+
+    Returns a list of (name, before seconds, after seconds, ratio, regressed).
+    A benchmark has regressed if it takes more than threshold times as long.
+    """
+    if before.get("version") != after.get("version"):
+        raise ValueError(
+            f"Can't compare benchmark versions {before.get('version')} and {after.get('version')}"
+        )
+    if before["params"] != after["params"]:
+        print(
+            f"Warning: comparing different params {before['params']} and {after['params']}",
+            file=sys.stderr,
+        )
+    rows = []
+    for name, result in after["benchmarks"].items():
+        if name not in before["benchmarks"]:
+            continue
+        old = before["benchmarks"][name]["seconds"]
+        new = result["seconds"]
+        ratio = new / old if old else float("inf")
+        rows.append((name, old, new, ratio, ratio > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--notebooks", type=int, default=200, help="Notebooks per repo")
+    parser.add_argument(
+        "--build-mb", type=int, default=100, help="MB of fake build output"
+    )
+    parser.add_argument(
+        "--results", type=int, default=10000, help="Number of results to write"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each benchmark")
+    parser.add_argument("-o", "--output", help="File to write JSON results to")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="""With --compare, fail if anything takes this many times as long
+        (timings of such short benchmarks are noisy on shared machines)""",
+    )
+    opts = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        notebooks=opts.notebooks,
+        build_mb=opts.build_mb,
+        n_results=opts.results,
+        repeat=opts.repeat,
+    )
+    output = json.dumps(results, indent=1)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for name, result in results["benchmarks"].items():
+        rates = ", ".join(f"{v} {k}" for k, v in result.items() if k.endswith("_per_s"))
+        print(
+            f"{name}: {result['seconds']:.4f}s{' (' + rates + ')' if rates else ''}",
+            file=sys.stderr,
+        )
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            before = json.load(f)
+        rows = compare(before, results, threshold=opts.threshold)
+        regressions = [row for row in rows if row[-1]]
+        print(f"Compared to {before.get('commit')}:", file=sys.stderr)
+        for name, old, new, ratio, regressed in rows:
+            flag = "  SLOWER" if regressed else ""
+            print(
+                f"  {name}: {old:.4f}s -> {new:.4f}s ({ratio:.2f}x){flag}",
+                file=sys.stderr,
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
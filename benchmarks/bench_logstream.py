@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Measure throughput of build log capture
+
+Pushes synthetic pip/conda-like output through `tee`
+and reports MB/s, with and without echo to stderr.
+
+    python benchmarks/bench_logstream.py --mb 200 > /dev/null
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from threading import Thread
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from repo2docker_checker.logstream import tee  # noqa
+
+LINE = b"  Downloading numpy-1.19.0-cp38-cp38-manylinux2010_x86_64.whl (14.6 MB)\n"
+
+
+def bench_tee(total_bytes, echo):
+    """Time pushing total_bytes through tee, return MB/s"""
+    block = LINE * (64 * 1024 // len(LINE))
+    n_blocks = max(1, total_bytes // len(block))
+    with tempfile.TemporaryDirectory() as td:
+        log_file = os.path.join(td, "log.txt")
+        tic = time.perf_counter()
+        with tee(log_file, echo=echo) as stdout:
+
+            def produce():
+                # write from another thread, like a subprocess would
+                for i in range(n_blocks):
+                    stdout.write(block)
+                stdout.flush()
+
+            t = Thread(target=produce)
+            t.start()
+            t.join()
+        toc = time.perf_counter()
+        assert os.stat(log_file).st_size == n_blocks * len(block)
+    return n_blocks * len(block) / (toc - tic) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--mb", type=int, default=100, help="MB of output to push through tee"
+    )
+    opts = parser.parse_args()
+    total_bytes = opts.mb * 1024 * 1024
+    results = {}
+    for echo in (False, True):
+        key = "tee_echo_mb_per_s" if echo else "tee_mb_per_s"
+        results[key] = round(bench_tee(total_bytes, echo=echo), 1)
+        print(f"{key}: {results[key]}", file=sys.stderr)
+    print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
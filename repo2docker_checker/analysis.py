@@ -0,0 +1,169 @@
+"""Checking a repo before building it
+
+Building takes minutes, so repos that can't produce a test result
+(no notebooks) or whose environment obviously can't be built
+(invalid requirements, or packages that don't exist)
+are found by looking at the checkout, without building.
+
+Whether packages exist is checked against a local package index:
+a text file of known package names, one per line,
+e.g. the names listed in https://pypi.org/simple/
+"""
+import logging
+import os
+import re
+
+from packaging.requirements import InvalidRequirement
+from packaging.requirements import Requirement
+from ruamel.yaml import YAML
+from ruamel.yaml import YAMLError
+
+from .buildcache import config_dir
+from .buildcache import ENV_FILES
+from .buildcache import WHOLE_REPO_FILES
+from .discovery import DEFAULT_PRIORITY
+from .discovery import find_notebooks
+
+log = logging.getLogger(__name__)
+
+# reasons a repo can't be tested
+NO_NOTEBOOKS = "no-notebooks"
+INVALID_SPEC = "invalid-spec"
+UNKNOWN_PACKAGE = "unknown-package"
+
+
+def normalize_name(name):
+    """Normalize a package name, as in PEP 503"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def load_package_index(path):
+    """Load a set of normalized package names from a file, one per line"""
+    with open(path) as f:
+        return {normalize_name(line.strip()) for line in f if line.strip()}
+
+
+def _logical_lines(lines):
+    """Join requirements lines continued with a backslash, as pip does
+
+    Yields (lineno, line), with the number of each logical line's first line.
+    """
+    start = None
+    parts = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if start is None:
+            start = lineno
+        if line.endswith("\\"):
+            parts.append(line[:-1])
+            continue
+        parts.append(line)
+        yield start, " ".join(parts)
+        start = None
+        parts = []
+    if parts:
+        yield start, " ".join(parts)
+
+
+# options after a requirement on the same line (e.g. --hash=..., --install-option=...)
+_per_requirement_options = re.compile(r"\s+--?[A-Za-z].*$")
+
+
+def check_requirements(path, package_index=None):
+    """Check a requirements.txt file
+
+    Returns a list of (reason, message) problems.
+    Only plain requirements are checked,
+    not options, URLs, local paths or included files.
+    Lines continued with a backslash are joined,
+    and per-requirement options (e.g. --hash) are ignored.
+    Package names are only checked against package_index
+    if the file doesn't use another index.
+    """
+    problems = []
+    unknown = []
+    other_index = False
+    with open(path, errors="replace") as f:
+        lines = f.readlines()
+    for lineno, line in _logical_lines(lines):
+        line = line.split(" #", 1)[0].strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("-"):
+            if re.match(r"^(-i|--index-url|--extra-index-url|-f|--find-links)\b", line):
+                other_index = True
+            continue
+        if "://" in line or line.startswith((".", "/")) or line.startswith("git+"):
+            continue
+        line = _per_requirement_options.sub("", line)
+        try:
+            req = Requirement(line)
+        except InvalidRequirement as e:
+            problems.append((INVALID_SPEC, f"{path}:{lineno}: {e}"))
+            continue
+        if package_index is not None and req.url is None:
+            if normalize_name(req.name) not in package_index:
+                unknown.append(f"{path}:{lineno}: no such package {req.name}")
+    if not other_index:
+        problems.extend((UNKNOWN_PACKAGE, message) for message in unknown)
+    return problems
+
+
+def check_environment_yml(path):
+    """Check that an environment.yml file can be parsed
+
+    Returns a list of (reason, message) problems.
+    """
+    try:
+        with open(path) as f:
+            env = YAML(typ="safe").load(f)
+    except YAMLError as e:
+        return [(INVALID_SPEC, f"{path}: {e}")]
+    if env is not None and not isinstance(env, dict):
+        return [(INVALID_SPEC, f"{path}: not a mapping")]
+    return []
+
+
+def analyze(checkout_path, package_index=None, notebook_priority=DEFAULT_PRIORITY):
+    """Look at a checkout to find out if it's worth building
+
+    Returns a dict with:
+
+    - notebooks: the notebooks that would be tested
+    - config_files: repo2docker config files found (relative to the checkout)
+    - problems: list of (reason, message) problems with the config files
+    - reason: why the repo can't be tested (one of NO_NOTEBOOKS,
+      INVALID_SPEC, UNKNOWN_PACKAGE) or None if it can
+    """
+    path = config_dir(checkout_path)
+    config_files = [
+        os.path.relpath(os.path.join(path, name), checkout_path)
+        for name in ENV_FILES + WHOLE_REPO_FILES
+        if os.path.isfile(os.path.join(path, name))
+    ]
+    problems = []
+    requirements = os.path.join(path, "requirements.txt")
+    if os.path.isfile(requirements):
+        problems.extend(check_requirements(requirements, package_index))
+    environment_yml = os.path.join(path, "environment.yml")
+    if os.path.isfile(environment_yml):
+        problems.extend(check_environment_yml(environment_yml))
+    # report paths relative to the checkout
+    problems = [
+        (reason, message.replace(checkout_path + os.path.sep, ""))
+        for reason, message in problems
+    ]
+
+    notebooks = find_notebooks(checkout_path, priority=notebook_priority)
+    if problems:
+        reason = problems[0][0]
+    elif not notebooks:
+        reason = NO_NOTEBOOKS
+    else:
+        reason = None
+    return {
+        "notebooks": notebooks,
+        "config_files": config_files,
+        "problems": problems,
+        "reason": reason,
+    }
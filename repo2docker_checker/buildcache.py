@@ -0,0 +1,331 @@
+"""Reuse images for repos whose environment hasn't changed
+
+repo2docker builds the environment from a few config files
+(requirements.txt, environment.yml, runtime.txt, ...).
+If those are unchanged from a previous build of the same repo,
+the environment can be reused and only the repo contents updated.
+
+Across repos, builds with the same buildpack and python version
+start with the same layers (repo2docker's base environment).
+Base images built from minimal repos (see base_repo_files)
+keep those layers in docker's cache, for all repos to share.
+"""
+import hashlib
+import os
+import re
+import stat
+import tempfile
+
+import repo2docker
+
+# files repo2docker's buildpacks read to build the environment
+ENV_FILES = [
+    "apt.txt",
+    "default.nix",
+    "DESCRIPTION",
+    "environment.yml",
+    "install.R",
+    "JuliaManifest.toml",
+    "JuliaProject.toml",
+    "Manifest.toml",
+    "Pipfile",
+    "Pipfile.lock",
+    "Project.toml",
+    "REQUIRE",
+    "requirements.txt",
+    "runtime.txt",
+    "start",
+]
+
+# files that make the environment depend on the whole repo,
+# e.g. `pip install .`, a Dockerfile that can COPY anything,
+# or a postBuild script that can run anything
+WHOLE_REPO_FILES = [
+    "Dockerfile",
+    "postBuild",
+    "pyproject.toml",
+    "setup.py",
+]
+
+# requirements files can include or constrain with other files
+_included_requirements = re.compile(
+    r"^(?:-r|--requirement|-c|--constraint)(?:\s*=\s*|\s+)(\S+)"
+)
+# editable installs, e.g. `-e .`
+_editable = re.compile(r"^(?:-e|--editable)(?:\s*=\s*|\s+)")
+
+
+def config_dir(checkout_path):
+    """The directory where repo2docker looks for config files
+
+    binder/ or .binder/ if present, otherwise the root of the repo
+    """
+    for name in ("binder", ".binder"):
+        path = os.path.join(checkout_path, name)
+        if os.path.isdir(path):
+            return path
+    return checkout_path
+
+
+def _is_local(spec):
+    """Whether a requirement installs from a path, e.g. `.`, `./pkg` or `-e ..`"""
+    spec = _editable.sub("", spec).split(";", 1)[0].strip()
+    if "://" in spec or spec.startswith("git+"):
+        return False
+    return spec.startswith((".", "/", "~", "file:")) or "/" in spec
+
+
+def requirements_inputs(path, _seen=None):
+    """Find the files a requirements file depends on
+
+    Returns the paths of requirements files it includes (-r) or is constrained by (-c),
+    recursively, or None if it installs anything from local paths
+    (e.g. `-e .` or `./mypkg`).
+    Lines of an environment.yml's dependencies are checked the same way.
+    """
+    if _seen is None:
+        _seen = {os.path.abspath(path)}
+    inputs = []
+    base = os.path.dirname(path)
+    for line in _read(path).splitlines():
+        line = line.split(" #", 1)[0].strip()
+        if path.endswith((".yml", ".yaml")):
+            # only list items of environment.yml can be requirements
+            if not line.startswith("- "):
+                continue
+            line = line[2:].strip()
+        if not line or line.startswith("#"):
+            continue
+        match = _included_requirements.match(line)
+        if match:
+            included = os.path.abspath(os.path.join(base, match.group(1)))
+            if included in _seen:
+                continue
+            _seen.add(included)
+            inputs.append(included)
+            nested = requirements_inputs(included, _seen)
+            if nested is None:
+                return None
+            inputs.extend(nested)
+        elif line.startswith("-") and not _editable.match(line):
+            # other options, e.g. --index-url
+            continue
+        elif _is_local(line):
+            return None
+    return inputs
+
+
+def env_hash(checkout_path):
+    """Hash the inputs to a repo's environment
+
+    Covers the buildpack config files (and requirements files they include)
+    and the repo2docker version.
+    Returns None if the environment may depend on other files in the repo,
+    in which case it can't be reused across commits:
+    a Dockerfile, postBuild or python package (in the config directory or the root),
+    or requirements installed from local paths.
+    """
+    path = config_dir(checkout_path)
+    for name in WHOLE_REPO_FILES:
+        if any(os.path.exists(os.path.join(d, name)) for d in {path, checkout_path}):
+            return None
+    if re.search(r"^\s*path\s*=", _read(os.path.join(path, "Pipfile")), re.MULTILINE):
+        # Pipfile packages installed from local paths
+        return None
+    included = []
+    for name in ("requirements.txt", "environment.yml"):
+        fpath = os.path.join(path, name)
+        if not os.path.isfile(fpath):
+            continue
+        inputs = requirements_inputs(fpath)
+        if inputs is None:
+            return None
+        included.extend(inputs)
+
+    h = hashlib.sha256()
+    h.update(f"repo2docker={repo2docker.__version__}\0".encode("utf8"))
+    # include the location of config files, which can change their meaning
+    h.update(f"{os.path.relpath(path, checkout_path)}\0".encode("utf8"))
+    for name in ENV_FILES:
+        fpath = os.path.join(path, name)
+        if not os.path.isfile(fpath):
+            continue
+        # start only runs if executable
+        executable = bool(os.stat(fpath).st_mode & stat.S_IXUSR)
+        h.update(f"{name}\0{executable}\0".encode("utf8"))
+        with open(fpath, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    for fpath in included:
+        h.update(f"{os.path.relpath(fpath, checkout_path)}\0".encode("utf8"))
+        h.update(hashlib.sha256(_read(fpath).encode("utf8")).digest())
+    return h.hexdigest()[:40]
+
+
+def overlay_image(client, base_image_id, checkout_path, image_id, log_w):
+    """Build image_id from base_image_id with the repo contents replaced
+
+    Removes the earlier commit's files from the working directory of the base image
+    (where repo2docker puts the repo) and copies checkout_path there,
+    as the image's user, so files deleted since are gone.
+    Hidden files and directories are kept,
+    since the environment's build may put files there too (e.g. ~/.local).
+    Build output is written to the LogWriter log_w.
+    """
+    base = client.images.get(base_image_id)
+    config = base.attrs["Config"]
+    workdir = config.get("WorkingDir") or "/"
+    user = config.get("User") or "root"
+    dockerfile = f"FROM {base_image_id}\n"
+    if workdir != "/":
+        dockerfile += (
+            f"RUN find {workdir} -mindepth 1 -maxdepth 1 ! -name '.*'"
+            " -exec rm -rf {} +\n"
+        )
+    dockerfile += f"COPY --chown={user} . {workdir}\n"
+    with tempfile.TemporaryDirectory() as td:
+        dockerfile_path = os.path.join(td, "Dockerfile")
+        with open(dockerfile_path, "w") as f:
+            f.write(dockerfile)
+        log_w.write(dockerfile)
+        for chunk in client.api.build(
+            path=checkout_path,
+            dockerfile=dockerfile_path,
+            tag=image_id,
+            rm=True,
+            decode=True,
+        ):
+            if "stream" in chunk:
+                log_w.write(chunk["stream"])
+            if "error" in chunk:
+                raise RuntimeError(f"Error building {image_id}: {chunk['error']}")
+
+
+# prefix of pre-warmed base images, which are not subject to pruning
+BASE_PREFIX = "r2d-base-"
+
+
+def _read(path):
+    """Read a text file, or return "" if it doesn't exist"""
+    try:
+        with open(path, encoding="utf8", errors="replace") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def detect_buildpack(checkout_path):
+    """Detect which of repo2docker's buildpacks builds a repo
+
+    Follows repo2docker's order of buildpack detection.
+    Returns the buildpack's name:
+    docker, julia, nix, r, conda, pipfile, or python (the default).
+    """
+    path = config_dir(checkout_path)
+
+    def exists(name):
+        return os.path.exists(os.path.join(path, name))
+
+    if exists("Dockerfile"):
+        return "docker"
+    if exists("JuliaProject.toml") or exists("Project.toml") or exists("REQUIRE"):
+        return "julia"
+    if exists("default.nix"):
+        return "nix"
+    runtime = _read(os.path.join(path, "runtime.txt")).strip()
+    if runtime.startswith("r-") or exists("install.R") or exists("DESCRIPTION"):
+        return "r"
+    if exists("environment.yml"):
+        return "conda"
+    if exists("Pipfile") or exists("Pipfile.lock"):
+        return "pipfile"
+    return "python"
+
+
+# buildpacks built on repo2docker's conda base environment
+BASE_BUILDPACKS = ("conda", "pipfile", "python")
+
+
+def detect_base(checkout_path):
+    """Detect the base environment a repo's image is built on
+
+    Returns (buildpack, python_version) for repos built on
+    repo2docker's conda base environment (see BASE_BUILDPACKS),
+    where python_version is "" for repo2docker's default version.
+    Returns None for other buildpacks.
+    """
+    buildpack = detect_buildpack(checkout_path)
+    if buildpack not in BASE_BUILDPACKS:
+        return None
+    path = config_dir(checkout_path)
+    if buildpack == "conda":
+        match = re.search(
+            r"^\s*-\s*python\s*[=<>]*\s*(\d+\.\d+)",
+            _read(os.path.join(path, "environment.yml")),
+            re.MULTILINE,
+        )
+    else:
+        match = re.match(
+            r"python-(\d+\.\d+)", _read(os.path.join(path, "runtime.txt")).strip()
+        )
+    return (buildpack, match.group(1) if match else "")
+
+
+def base_tag():
+    """The tag of pre-warmed base images: the repo2docker version"""
+    return re.sub(r"[^A-Za-z0-9_.-]", "-", repo2docker.__version__)
+
+
+def base_image_id(base):
+    """The image id of a pre-warmed base, for the current repo2docker version"""
+    buildpack, python_version = base
+    return f"{BASE_PREFIX}{buildpack}-py{python_version or 'default'}:{base_tag()}"
+
+
+def base_repo_files(base):
+    """The files of a minimal repo whose image has the base environment of base
+
+    Returns a dict of {filename: content}.
+    """
+    buildpack, python_version = base
+    if buildpack == "conda":
+        dependencies = f"\n  - python={python_version}" if python_version else " []"
+        return {"environment.yml": f"dependencies:{dependencies}\n"}
+    files = {}
+    if python_version:
+        files["runtime.txt"] = f"python-{python_version}\n"
+    if buildpack == "pipfile":
+        files["Pipfile"] = "[packages]\n"
+    else:
+        files["requirements.txt"] = ""
+    return files
+
+
+def layer_reuse(client, image_id, base_image_id):
+    """How much of an image was reused from a base image's layers
+
+    Returns a dict with the number and size in bytes of the layers the image
+    shares with the base (the layers they start with in common),
+    and of all the image's layers.
+    Sizes come from the image's history, so are approximate.
+    """
+    image = client.images.get(image_id)
+    base = client.images.get(base_image_id)
+    layers = image.attrs["RootFS"]["Layers"]
+    shared = 0
+    for layer, base_layer in zip(layers, base.attrs["RootFS"]["Layers"]):
+        if layer != base_layer:
+            break
+        shared += 1
+    # history is newest first, and has entries for steps that add no layer,
+    # marked #(nop) (steps that add a layer may still add 0 bytes)
+    sizes = [
+        entry["Size"]
+        for entry in reversed(image.history())
+        if "#(nop)" not in entry.get("CreatedBy", "")
+    ]
+    return {
+        "base_layers": shared,
+        "layers": len(layers),
+        "base_bytes": sum(sizes[:shared]),
+        "bytes": image.attrs.get("Size", sum(sizes)),
+    }
@@ -9,27 +9,82 @@ Result types:
 
 """
 import argparse
-import csv
+import fcntl
+import json
 import logging
 import os
+import shutil
 import sys
 import tempfile
+import time
 import traceback
+from collections import Counter
 from collections import defaultdict
-from collections import namedtuple
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
 from subprocess import CalledProcessError
 from subprocess import check_output
 from subprocess import run
 from subprocess import STDOUT
-from threading import Thread
+from threading import BoundedSemaphore
+from threading import Lock
 from urllib.parse import urlparse
+from uuid import uuid4
 
 import docker
 import repo2docker
 import tornado.log
-from repo2docker.contentproviders.git import Git
+from docker.utils import parse_bytes
+
+from .analysis import analyze
+from .analysis import load_package_index
+from .buildcache import base_image_id
+from .buildcache import base_repo_files
+from .buildcache import detect_base
+from .buildcache import env_hash
+from .buildcache import layer_reuse
+from .buildcache import overlay_image
+from .coordinator import RemoteQueue
+from .discovery import DEFAULT_PRIORITY
+from .discovery import find_notebooks
+from .discovery import parse_priority
+from .discovery import PRIORITY_KEYS
+from .engine import Engine
+from .failures import classify
+from .failures import classify_log
+from .failures import is_transient
+from .failures import TAIL_BYTES
+from .gitcache import GitCache
+from .logstream import copy_log
+from .logstream import LogWriter
+from .logstream import open_log
+from .logstream import OutputLimitExceeded
+from .logstream import tee
+from .migrate import main as migrate_main
+from .planner import main as plan_main
+from .prune import CONTAINER_LABEL
+from .prune import main as prune_main
+from .prune import owner_labels
+from .prune import POLICIES
+from .prune import prune_images
+from .prune import remove_orphaned_containers
+from .prune import remove_stale_bases
+from .prune import touch_image
+from .report import main as report_main
+from .results import CSVResults
+from .results import main as results_main
+from .results import read_csv
+from .results import SQLiteResults
+from .results import TestResult
+from .testcache import cache_keys
+from .testcache import TestCache
+from .trace import read_trace
+from .trace import Tracer
+from .workqueue import JobQueue
+from .workqueue import main as queue_main
+from .workqueue import work
 
 here = os.path.abspath(os.path.dirname(__file__))
 log = logging.getLogger(__name__)
@@ -38,9 +93,131 @@ now = datetime.now()
 timestamp = now.isoformat()
 run_id = os.environ.get("RUN_ID", now.strftime("%Y-%m-%dT%H.%M"))
 notebook_limit = 5
+# which notebooks to test first, when there are more than notebook_limit
+notebook_priority = DEFAULT_PRIORITY
 quiet = False
+# resource limits for each test container (similar to mybinder.org)
+test_mem_limit = "2G"
+test_cpus = 1.0
+# max test containers running at once (0: fit to the docker host's resources)
+test_parallel = 0
+# max tests to run in one container (0: all of a repo's tests in one container)
+tests_per_container = 0
+# known package names (see analysis.load_package_index), if any
+package_index = None
+# build repos even if analysis finds they can't be tested
+build_untestable = False
+# kill test containers that run for longer than this many seconds (0: no limit)
+test_timeout = 0
+# stop notebooks that take longer than this many seconds in total (0: no limit)
+notebook_timeout = 0
+# number of slowest notebook cells to show in each repo's summary
+slowest_cells_shown = 5
+# gzip build and test logs (and executed notebooks)
+compress_logs = False
+# keep only the first and last half of this many bytes of each log (0: no limit)
+log_max_bytes = 0
+# drop images and other non-text outputs from executed notebooks
+strip_notebook_outputs = False
+# kill test containers that output more than this many bytes (0: no limit)
+test_output_limit = 0
+# echo at most this many bytes per second of each build or test to stderr (0: no limit)
+echo_rate = 0
+# retries of builds and tests that failed for transient reasons (see failures.py)
+retries = 2
+# seconds to wait before the first retry, doubling for each retry after that
+retry_delay = 30
+# build base images for base environments (see buildcache.detect_base)
+# used by at least this many of the repos to check (0: don't)
+prewarm_min_repos = 0
+# pre-warmed base images, by base environment (set by prewarm_bases)
+base_images = {}
+# passing results of unchanged tests, carried forward instead of running them again
+# (a testcache.TestCache, if any)
+test_cache = None
+# run all tests, even those with results in test_cache (which are still updated)
+force_tests = False
+
+# limit how many repos can be in each stage at once
+# set via set_stage_limits
+_stage_semaphores = {}
+
+
+def set_stage_limits(**limits):
+    """Set the number of repos allowed in each stage at once
+
+    e.g. set_stage_limits(clone=4, build=2, test=2)
+    """
+    for name, limit in limits.items():
+        _stage_semaphores[name] = BoundedSemaphore(limit)
+
+
+@contextmanager
+def stage(name):
+    """Context manager for a stage (clone, build, test) of checking a repo
+
+    Blocks until there is room in the stage's pool, if it is limited.
+    """
+    semaphore = _stage_semaphores.get(name)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
 
-CHUNK_SIZE = 2
+
+_docker_client = None
+_engine = None
+_docker_lock = Lock()
+
+
+def docker_client():
+    """The docker client shared by all threads"""
+    global _docker_client
+    with _docker_lock:
+        if _docker_client is None:
+            _docker_client = docker.from_env()
+    return _docker_client
+
+
+def engine():
+    """The Engine running all test containers, from one event loop"""
+    global _engine
+    with _docker_lock:
+        if _engine is None:
+            _engine = Engine()
+    return _engine
+
+
+_test_slots = None
+_test_slots_lock = Lock()
+
+
+def test_slots():
+    """Semaphore limiting the number of test containers running at once
+
+    Shared by all repos. Unless test_parallel is set,
+    the size is the number of test containers that fit
+    in the docker host's CPUs and memory,
+    given test_cpus and test_mem_limit.
+    """
+    global _test_slots
+    with _test_slots_lock:
+        if _test_slots is None:
+            if test_parallel:
+                n = test_parallel
+            else:
+                info = docker_client().info()
+                n = info.get("NCPU") or os.cpu_count() or 1
+                if test_cpus:
+                    n = int(n // test_cpus)
+                mem_total = info.get("MemTotal")
+                if test_mem_limit and mem_total:
+                    n = min(n, mem_total // parse_bytes(test_mem_limit))
+            n = max(n, 1)
+            log.info(f"Running up to {n} test containers at once")
+            _test_slots = BoundedSemaphore(n)
+    return _test_slots
 
 
 @contextmanager
@@ -60,55 +237,57 @@ def echo(text):
     sys.stderr.write(text)
 
 
-def _tee(fd, fname):
-    """The part of tee that runs in a background thread"""
-    with open(fname, "w") as log_f:
-        with os.fdopen(fd, "r") as pipe_f:
-            while True:
-                chunk = pipe_f.read(CHUNK_SIZE)
-                if not chunk:
-                    return
-                echo(chunk)
-                log_f.write(chunk)
+# SQLiteResults storing results of all repos, if any
+results_db = None
 
+# local cache of git mirrors, used by clone_repo
+git_cache = GitCache(max_bytes=parse_bytes("20G"), echo=echo)
 
-def tee(fname):
-    """Like command-line tee, but in Python"""
-    reader, writer = os.pipe()
-    Thread(target=_tee, args=(reader, fname), daemon=True).start()
-    return os.fdopen(writer, "w")
+# timing spans of each phase (see trace.py), only written if tracer.path is set
+tracer = Tracer()
 
 
 def clone_repo(repo, ref):
-    """Clone a repo, return checkout path and resolved ref"""
-    slug = repo_slug(repo)
+    """Clone a repo, return checkout path and resolved ref
 
-    td = tempfile.mkdtemp(prefix=f"r2d-test-{run_id}")
-    checkout_path = os.path.join(td, slug)
-    log.info(f"Cloning {repo}@{ref} to {checkout_path}")
-    try:
-        os.makedirs(checkout_path)
-    except FileExistsError:
-        pass
-
-    cp = Git()
-    spec = cp.detect(repo, ref=ref)
-    for line in cp.fetch(spec, output_dir=checkout_path, yield_output=echo):
-        echo(line)
+    Uses the local git cache, so only new commits are fetched.
+    Call remove_checkout when done with the checkout.
+    """
+    slug = repo_slug(repo)
 
-    resolved_ref = cp.content_id or ref
-    with cd(checkout_path):
-        output = check_output(["git", "log", "-1", "--date=iso-strict", "--format=%ad"])
-        timestamp = output.decode("utf8").strip()
+    log.info(f"Cloning {repo}@{ref}")
+    checkout_path, sha = git_cache.checkout(
+        repo, slug, ref, prefix=f"r2d-test-{run_id}"
+    )
+    # short sha, like repo2docker's content_id
+    resolved_ref = sha[:7]
+    # use cwd instead of cd, which isn't threadsafe
+    output = check_output(
+        ["git", "log", "-1", "--date=iso-strict", "--format=%ad"], cwd=checkout_path
+    )
+    timestamp = output.decode("utf8").strip()
     log.info(f"Cloned {repo}@{ref}: commit {resolved_ref} at {timestamp}")
     return checkout_path, resolved_ref, timestamp
 
 
-def build_repo(repo, resolved_ref, checkout_path, build_log_file, force_build=False):
-    """build one repo"""
+def remove_checkout(checkout_path):
+    """Remove a checkout created by clone_repo"""
+    git_cache.remove_checkout(checkout_path)
+
+
+def build_image(repo, resolved_ref, checkout_path, build_log_file, force_build=False):
+    """Build the image for one repo, reusing previous builds where possible
+
+    Returns (image_id, cache), where cache records how the image was made:
+
+    - "image": the image for this commit was already built
+    - "env": the image of an earlier commit with the same environment
+      (see buildcache.env_hash) was reused, with the repo contents updated
+    - "miss": the image was built from scratch
+    """
 
     image_id = make_image_id(repo, resolved_ref)
-    d = docker.from_env()
+    d = docker_client()
     try:
         image = d.images.get(image_id)
     except docker.errors.ImageNotFound:
@@ -117,14 +296,137 @@ def build_repo(repo, resolved_ref, checkout_path, build_log_file, force_build=Fa
     else:
         log.info(f"Already have image {image_id}")
         if not force_build:
-            with open(build_log_file, "w") as f:
+            touch_image(image_id)
+            with open_log(build_log_file, "w") as f:
                 f.write(f"Image {image_id} already built")
-            return image_id, checkout_path
+            return image_id, "image"
+
+    env_id = env_hash(checkout_path)
+    env_image_id = make_image_id(repo, f"env-{env_id}") if env_id else None
+    if env_image_id and not force_build:
+        try:
+            d.images.get(env_image_id)
+        except docker.errors.ImageNotFound:
+            pass
+        else:
+            log.info(f"Reusing environment {env_image_id} for {repo}@{resolved_ref}")
+            with LogWriter(
+                build_log_file,
+                echo=not quiet,
+                max_bytes=log_max_bytes,
+                echo_rate=echo_rate,
+            ) as log_w:
+                log_w.write(f"Reusing image {env_image_id} with the same environment\n")
+                overlay_image(d, env_image_id, checkout_path, image_id, log_w)
+            touch_image(image_id, env_image_id)
+            return image_id, "env"
 
     log.info(f"Building image {image_id} for {repo}@{resolved_ref}")
 
-    with tee(build_log_file) as stdout:
+    with tee(
+        build_log_file, echo=not quiet, max_bytes=log_max_bytes, echo_rate=echo_rate
+    ) as stdout:
+        run(
+            [
+                "jupyter-repo2docker",
+                "--no-run",
+                "--no-clean",
+                "--image-name",
+                image_id,
+                checkout_path,
+            ],
+            stdout=stdout,
+            stderr=STDOUT,
+            check=True,
+        )
+    touch_image(image_id)
+    if env_image_id:
+        # tag the environment for reuse by later commits
+        repository, tag = env_image_id.rsplit(":", 1)
+        d.images.get(image_id).tag(repository, tag)
+        touch_image(env_image_id)
+    return image_id, "miss"
+
+
+def inspect_repos(repo_refs, inspect, jobs=1):
+    """Clone repos and call inspect(checkout_path) on each
+
+    Clones go through the git cache, so checking the repos later is cheap.
+    Returns the results in the order of repo_refs,
+    None for repos that couldn't be cloned.
+    """
+
+    def inspect_one(repo_ref):
+        repo, ref = repo_ref
+        try:
+            checkout_path, resolved_ref, timestamp = clone_repo(repo, ref)
+        except Exception as e:
+            log.warning(f"Failed to clone {repo}@{ref}: {e}")
+            return None
+        try:
+            return inspect(checkout_path)
+        finally:
+            remove_checkout(checkout_path)
+
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        return list(pool.map(inspect_one, repo_refs))
+
+
+def prewarm_bases(repo_refs, run_dir, jobs=1):
+    """Build base images shared by the repos about to be checked
+
+    Each repo is cloned (filling the git cache for checking it later)
+    to detect the base environment its image is built on
+    (see buildcache.detect_base).
+    Bases used by at least prewarm_min_repos repos are built once
+    per repo2docker version, from a minimal repo,
+    so the builds of each repo only add their own layers.
+
+    Returns a Counter of how many repos use each base.
+    """
+    bases = inspect_repos(repo_refs, detect_base, jobs=jobs)
+    counts = Counter(base for base in bases if base)
+
+    d = docker_client()
+    for base, count in counts.most_common():
+        if count < prewarm_min_repos:
+            continue
+        image_id = base_image_id(base)
         try:
+            d.images.get(image_id)
+        except docker.errors.ImageNotFound:
+            pass
+        else:
+            log.info(f"Already have base image {image_id}")
+            base_images[base] = image_id
+            continue
+        build_log_file = os.path.join(
+            run_dir,
+            "bases",
+            log_file_name(f"build-{image_id.replace(':', '-')}-{run_id}.txt"),
+        )
+        os.makedirs(os.path.dirname(build_log_file), exist_ok=True)
+        log.info(f"Building base image {image_id}, used by {count} repos")
+        try:
+            with tracer.span("build_base", image=image_id, repos=count):
+                build_base_image(base, image_id, build_log_file)
+        except Exception:
+            log.exception(f"Failed to build base image {image_id}")
+            continue
+        base_images[base] = image_id
+    return counts
+
+
+def build_base_image(base, image_id, build_log_file):
+    """Build a base image from a minimal repo with the base environment"""
+    with tempfile.TemporaryDirectory() as td:
+        for name, content in base_repo_files(base).items():
+            with open(os.path.join(td, name), "w") as f:
+                f.write(content)
+        with tee(
+            build_log_file, echo=not quiet, max_bytes=log_max_bytes, echo_rate=echo_rate
+        ) as stdout:
+            # same arguments as build_image, so the layers match
             run(
                 [
                     "jupyter-repo2docker",
@@ -132,112 +434,441 @@ def build_repo(repo, resolved_ref, checkout_path, build_log_file, force_build=Fa
                     "--no-clean",
                     "--image-name",
                     image_id,
-                    checkout_path,
+                    td,
                 ],
                 stdout=stdout,
                 stderr=STDOUT,
                 check=True,
             )
-        finally:
-            stdout.flush()
+
+
+def report_base_reuse(image_id, checkout_path, build_log_file):
+    """Report how much of a new build was reused from its pre-warmed base
+
+    Writes a line to the build log,
+    and returns the numbers (see buildcache.layer_reuse), if there's a base.
+    """
+    if not base_images:
+        return {}
+    base = detect_base(checkout_path)
+    if base not in base_images:
+        return {}
+    try:
+        reuse = layer_reuse(docker_client(), image_id, base_images[base])
+    except Exception as e:
+        log.warning(f"Failed to compare {image_id} with {base_images[base]}: {e}")
+        return {}
+    message = (
+        f"Reused {reuse['base_layers']}/{reuse['layers']} layers"
+        f" ({reuse['base_bytes']}/{reuse['bytes']} bytes)"
+        f" of base image {base_images[base]}"
+    )
+    log.info(f"{image_id}: {message}")
+    with open_log(build_log_file, "a") as f:
+        f.write(f"\n{message}\n")
+    return dict(base=base_images[base], **reuse)
+
+
+def build_repo(repo, resolved_ref, checkout_path, build_log_file, force_build=False):
+    """build one repo
+
+    Returns (image_id, checkout_path).
+    See build_image for details.
+    """
+    image_id, cache = build_image(
+        repo, resolved_ref, checkout_path, build_log_file, force_build=force_build
+    )
     return image_id, checkout_path
 
 
-def find_notebooks(path):
-    """Yield all the notebooks in a directory
+def _run_container(image, args, run_dir, log_w):
+    """Run inrepo.py in a container of the image, with the given arguments
 
-    Yields the path relative to the given directory
+    Mounts run_dir as /io.
+    Container output is written to the LogWriter log_w.
+    Timing spans from inside the container are added to the trace.
+    Returns the container's exit status.
     """
-    for parent, dirs, files in os.walk(path):
-        if ".ipynb_checkpoints" in parent.split(os.path.sep):
-            # skip accidentally committed checkpoints
-            continue
-        for fname in files:
-            if fname.endswith(".ipynb"):
-                yield os.path.relpath(os.path.join(parent, fname), path)
+    trace_name = f"trace-{uuid4().hex}.jsonl"
+    trace_path = os.path.join(run_dir, trace_name)
+    if tracer.path:
+        args = ["--trace", f"/io/{trace_name}"] + args
+    if notebook_timeout:
+        args = ["--notebook-timeout", str(notebook_timeout)] + args
+    if compress_logs:
+        args = ["--compress-notebooks"] + args
+    if strip_notebook_outputs:
+        args = ["--strip-outputs"] + args
+    # profiles of each run are kept apart, for slowest_cells
+    args = ["--profile-dir", f"profiles/{run_id}"] + args
+    try:
+        return _run_inrepo(image, args, run_dir, log_w)
+    finally:
+        if os.path.exists(trace_path):
+            tracer.write(*read_trace(trace_path))
+            os.remove(trace_path)
+
+
+def _run_inrepo(image, args, run_dir, log_w):
+    """The part of _run_container that runs the container"""
+    host_config = {
+        "Binds": [f"{here}:/src:ro", f"{os.path.abspath(run_dir)}:/io:rw"],
+    }
+    if test_mem_limit:
+        host_config["Memory"] = parse_bytes(test_mem_limit)
+    if test_cpus:
+        host_config["NanoCpus"] = int(test_cpus * 1e9)
+    config = {
+        "Image": image,
+        "Cmd": ["python3", "-u", "/src/inrepo.py", "--output-dir", "/io"] + args,
+        "Labels": {CONTAINER_LABEL: "test", **owner_labels()},
+        "HostConfig": host_config,
+    }
+    status = engine().run_container(config, log_w, timeout=test_timeout or None)
+    message = f"\nContainer exited with status: {status}\n"
+    log_w.write(message)
+    return status
+
+
+def _run_limited(image, args, run_dir, log_w):
+    """_run_container, killing the container if it exceeds log_w's output limit"""
+    try:
+        return _run_container(image, args, run_dir, log_w)
+    except OutputLimitExceeded as e:
+        # the container has been removed, which kills it
+        message = f"{e}, container killed"
+        log.warning(f"{image} {' '.join(args)}: {message}")
+        log_w.write(f"\n{message}\n")
+        return {"StatusCode": None, "Error": {"Message": message}}
 
 
 def run_one_test(image, kind, argument, run_dir, log_file):
     """Run a single test in a container
 
     Calls inrepo with the given test and input in the image,
-    mounting run_dir as a volume
+    mounting run_dir as a volume.
+    Failures are classified from the end of the test's output.
     """
-    d = docker.from_env()
-    with open(log_file, "w") as log_f:
+    with tracer.span("run_one_test", kind=kind, test_id=argument) as span:
+        with LogWriter(
+            log_file,
+            echo=not quiet,
+            max_bytes=log_max_bytes,
+            keep_tail=TAIL_BYTES,
+            echo_rate=echo_rate,
+            limit=test_output_limit,
+        ) as log_w:
+            status = _run_limited(image, [kind, argument], run_dir, log_w)
+        span["log_bytes"] = log_w.bytes_written
+
+    success = status["StatusCode"] == 0
+    return {
+        "kind": "notebook",
+        "success": success,
+        "test_id": argument,
+        "path": log_file,
+        "duration": span["duration"],
+        "failure_reason": "" if success else classify(log_w.tail),
+    }
+
+
+def run_batch(image, tests, run_dir, log_files):
+    """Run a batch of tests in a single container
+
+    tests is a list of (kind, argument) pairs,
+    log_files the log file to write for each test.
+
+    Calls inrepo in batch mode, then splits its per-test records
+    back into one result and log file per test.
+    Tests with no record (e.g. the container died)
+    are failures, with the container's output as their log.
+    The container's output is also kept as a log of its own,
+    for output that isn't in any test's log (e.g. kernel stderr).
+
+    test_output_limit applies to each test, not the whole batch.
+    If a test exceeds it, only that test fails (with reason output-limit),
+    and the tests after it, which never ran, are run in a new batch.
+    """
+    batch_id = uuid4().hex
+    batch_dir = os.path.join(run_dir, "batch", batch_id)
+    os.makedirs(batch_dir)
+    with open(os.path.join(batch_dir, "manifest.json"), "w") as f:
+        json.dump([list(test) for test in tests], f)
+    batch_log_file = os.path.join(batch_dir, "container.log")
+    results_path = os.path.join(batch_dir, "results.jsonl")
+
+    try:
+        with tracer.span("run_batch", tests=len(tests)) as span:
+            with LogWriter(
+                batch_log_file,
+                echo=not quiet,
+                echo_rate=echo_rate,
+                limit=test_output_limit,
+            ) as log_w:
+                output = _BatchOutput(log_w, results_path)
+                _run_limited(
+                    image,
+                    ["batch", f"/io/batch/{batch_id}/manifest.json"],
+                    run_dir,
+                    output,
+                )
+            span["log_bytes"] = log_w.bytes_written
+        # output outside logging (e.g. kernel stderr, tracebacks)
+        # is only in the container's log, which is kept with the test logs
+        container_log = os.path.join(
+            os.path.dirname(log_files[0]),
+            log_file_name(f"test-batch-{batch_id}-{run_id}.txt"),
+        )
+        copy_log(batch_log_file, container_log, max_bytes=log_max_bytes)
+
+        records = {}
+        if os.path.exists(results_path):
+            with open(results_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # truncated line if the container died mid-write
+                        continue
+                    records[record["index"]] = record
+
+        missing = [i for i in range(len(tests)) if i not in records]
+        # the test running when the output limit was hit is to blame,
+        # the tests after it never ran
+        blamed = missing[0] if output.exceeded and missing else len(tests)
+        results = []
+        for i, ((kind, argument), log_file) in enumerate(zip(tests, log_files)):
+            if i > blamed:
+                break
+            record = records.get(i)
+            failure_reason = ""
+            if record is None:
+                log.error(f"No result for {kind} test {argument} in batch {batch_id}")
+                copy_log(batch_log_file, log_file, max_bytes=log_max_bytes)
+                success = False
+                duration = ""
+                if i == blamed:
+                    failure_reason = "output-limit"
+            else:
+                copy_log(
+                    os.path.join(batch_dir, record["log"]),
+                    log_file,
+                    max_bytes=log_max_bytes,
+                )
+                with open_log(log_file, "a") as f:
+                    f.write(
+                        "\nOther output of this test's batch container"
+                        f" is in {os.path.basename(container_log)}\n"
+                    )
+                success = record["success"]
+                duration = record.get("duration", "")
+            result = {
+                "kind": kind,
+                "success": success,
+                "test_id": argument,
+                "path": log_file,
+                "duration": duration,
+            }
+            if failure_reason:
+                result["failure_reason"] = failure_reason
+            results.append(result)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+    rest = slice(blamed + 1, len(tests))
+    if tests[rest]:
+        log.info(
+            f"Running {len(tests[rest])} tests that didn't run in batch {batch_id}"
+        )
+        results.extend(run_batch(image, tests[rest], run_dir, log_files[rest]))
+    return results
 
-        def write(text):
-            """write text to both stderr and the log file
 
-            decodes bytes if not already text
-            """
-            if isinstance(text, bytes):
-                text = text.decode("utf8", "replace")
+class _BatchOutput:
+    """The output of a batch container, with test_output_limit for each test
 
-            log_f.write(text)
-            echo(text)
+    Writes to a LogWriter, moving its limit along
+    as inrepo appends a record to results.jsonl for each finished test.
+    exceeded is set if a test went over the limit.
+    """
 
+    def __init__(self, log_w, results_path):
+        self.log_w = log_w
+        self.results_path = results_path
+        self.exceeded = False
+        self._results_size = 0
+
+    def write(self, data):
+        if self.log_w.limit:
+            try:
+                size = os.stat(self.results_path).st_size
+            except FileNotFoundError:
+                size = 0
+            if size != self._results_size:
+                # a test finished, the next one gets a fresh allowance
+                self._results_size = size
+                self.log_w.limit = self.log_w.bytes_written + test_output_limit
         try:
-            container = d.containers.run(
-                image,
-                detach=True,
-                volumes={
-                    here: {"bind": "/src", "mode": "ro"},
-                    os.path.abspath(run_dir): {"bind": "/io", "mode": "rw"},
-                },
-                command=[
-                    "python3",
-                    "-u",
-                    "/src/inrepo.py",
-                    "--output-dir",
-                    "/io",
-                    kind,
-                    argument,
-                ],
-            )
-        except docker.errors.ContainerError as e:
-            write(e.stderr)
-            e.container.remove()
+            self.log_w.write(data)
+        except OutputLimitExceeded:
+            self.exceeded = True
             raise
 
-        for chunk in container.logs(stdout=True, stderr=True, follow=True, stream=True):
-            write(chunk)
 
-        status = container.wait()
-        message = f"\nContainer exited with status: {status}\n"
-        write(message)
-        container.remove(force=True)
+def log_file_name(name):
+    """The name of a log file, with .gz if logs are compressed"""
+    return name + ".gz" if compress_logs else name
+
+
+def test_log_file(run_dir, kind, test_id):
+    """The log file for one test"""
+    return os.path.join(
+        run_dir,
+        "logs",
+        log_file_name(f"test-{kind}-{test_id.replace('/', '-')}-{run_id}.txt"),
+    )
 
-    return {
-        "kind": "notebook",
-        "success": status["StatusCode"] == 0,
-        "test_id": argument,
-        "path": log_file,
-    }
 
+def _run_test_batch(image, notebooks, run_dir):
+    """Run a batch of notebook tests, waiting for a free test slot
 
-def run_tests(image, checkout_path, run_dir):
-    """Find tests to run and run them"""
-    notebooks = list(find_notebooks(checkout_path))
+    Errors are recorded as failed tests
+    """
+    log_files = [test_log_file(run_dir, "notebook", nb_path) for nb_path in notebooks]
+    with test_slots():
+        try:
+            if len(notebooks) == 1:
+                return [
+                    run_one_test(image, "notebook", notebooks[0], run_dir, log_files[0])
+                ]
+            return run_batch(
+                image,
+                [("notebook", nb_path) for nb_path in notebooks],
+                run_dir,
+                log_files,
+            )
+        except Exception:
+            log.exception(f"Error running tests {notebooks}")
+            return [
+                {
+                    "kind": "notebook",
+                    "success": False,
+                    "test_id": nb_path,
+                    "path": log_file,
+                    "duration": "",
+                }
+                for nb_path, log_file in zip(notebooks, log_files)
+            ]
+
+
+def run_tests(image, checkout_path, run_dir, skip=(), repo=None):
+    """Find tests to run and run them
+
+    Tests are run in batches of tests_per_container in one container each.
+    Batches run concurrently, limited by test_slots(),
+    but results are yielded in the order the tests were found.
+
+    skip is a collection of (kind, test_id) already run, e.g. when resuming.
+
+    If there is a test_cache, the repo's tests that are unchanged
+    since they last passed (see testcache.py) are not run,
+    and their results (with cache="result") are yielded first,
+    unless force_tests is set.
+
+    Tests are run in the "test" stage (see stage()).
+    Failed tests get a failure_reason.
+    Tests that failed for transient reasons are retried in the same image,
+    up to `retries` times, outside the stage and test slots while waiting.
+    """
+    notebooks = list(find_notebooks(checkout_path, priority=notebook_priority))
     count = len(notebooks)
     log.info(f"Found {count} to test")
     if notebook_limit and count > notebook_limit:
         log.info(f"Limiting to first {notebook_limit}/{count} notebooks")
         notebooks = notebooks[:notebook_limit]
-    for nb_path in notebooks:
-        test_log_file = os.path.join(
-            run_dir, "logs", f"test-notebook-{nb_path.replace('/', '-')}-{run_id}.txt"
-        )
-        try:
-            yield run_one_test(image, "notebook", nb_path, run_dir, test_log_file)
-        except Exception:
-            log.exception(f"Error running test {nb_path}")
+    # skip after limiting, so resuming picks the same notebooks
+    skipped = [nb_path for nb_path in notebooks if ("notebook", nb_path) in skip]
+    if skipped:
+        log.info(f"Skipping {len(skipped)} notebooks already tested")
+        notebooks = [nb_path for nb_path in notebooks if nb_path not in skipped]
+    keys = {}
+    if test_cache is not None and repo:
+        keys = cache_keys(repo, checkout_path, notebooks)
+    if keys and not force_tests:
+        to_run = []
+        for nb_path in notebooks:
+            cached = test_cache.get(keys[nb_path]) if nb_path in keys else None
+            if cached is None:
+                to_run.append(nb_path)
+                continue
+            log.info(f"Test {nb_path} unchanged since it passed in {cached['run_id']}")
             yield {
                 "kind": "notebook",
-                "success": False,
+                "success": True,
                 "test_id": nb_path,
-                "path": test_log_file,
+                "path": cached["path"],
+                "cache": "result",
             }
+        notebooks = to_run
+    for attempt in range(retries + 1):
+        if not notebooks:
+            return
+        if attempt:
+            wait_to_retry(f"{len(notebooks)} tests in {image}", attempt)
+        retry = []
+        # leave the test stage while waiting to retry
+        with stage("test"):
+            for result in _run_notebooks(image, notebooks, run_dir):
+                if result["success"]:
+                    reason = ""
+                else:
+                    reason = result.get("failure_reason") or classify_log(
+                        result["path"]
+                    )
+                result["failure_reason"] = reason
+                if attempt < retries and is_transient(reason):
+                    log.warning(
+                        f"Test {result['test_id']} failed ({reason}), will retry"
+                    )
+                    retry.append(result["test_id"])
+                    continue
+                if result["test_id"] in keys:
+                    if result["success"]:
+                        test_cache.add(
+                            keys[result["test_id"]],
+                            repo,
+                            result["test_id"],
+                            result["path"],
+                            result.get("duration", ""),
+                            run_id,
+                        )
+                    else:
+                        test_cache.discard(repo, result["test_id"])
+                yield result
+        notebooks = retry
+
+
+def _run_notebooks(image, notebooks, run_dir):
+    """Run notebook tests in batches of tests_per_container
+
+    Yields results in the order of notebooks.
+    """
+    batch_size = tests_per_container or len(notebooks)
+    batches = [
+        notebooks[i : i + batch_size] for i in range(0, len(notebooks), batch_size)
+    ]
+    with ThreadPoolExecutor(len(batches)) as pool:
+        futures = [
+            pool.submit(_run_test_batch, image, batch, run_dir) for batch in batches
+        ]
+        for future in futures:
+            yield from future.result()
+
+
+def wait_to_retry(what, attempt):
+    """Wait before retry number `attempt` (from 1), with exponential backoff"""
+    delay = retry_delay * 2 ** (attempt - 1)
+    log.info(f"Retrying {what} in {delay}s (retry {attempt}/{retries})")
+    time.sleep(delay)
 
 
 def repo_slug(url):
@@ -246,7 +877,24 @@ def repo_slug(url):
         # strip redundant .git extension
         url = url[:-4]
     urlinfo = urlparse(url)
-    return f"{urlinfo.hostname}{urlinfo.path}"
+    # file:// urls have no hostname
+    return f"{urlinfo.hostname or 'localhost'}{urlinfo.path}"
+
+
+def parse_repo_ref(repo):
+    """Parse a repo[@ref] argument into (repo_url, ref)
+
+    Allows org/repo shortcuts for GitHub.
+    """
+    if "://" not in repo:
+        # allow a/b shortcuts for github
+        repo = "https://github.com/" + repo
+
+    if "@" in repo:
+        repo, ref = repo.split("@")
+    else:
+        ref = "master"
+    return repo, ref
 
 
 def make_image_id(repo, ref):
@@ -255,25 +903,16 @@ def make_image_id(repo, ref):
     return f"r2d-test-{slug}:{ref}"
 
 
-TestResult = namedtuple(
-    "TestResult",
-    (
-        "repo",
-        "ref",
-        "resolved_ref",
-        "last_modified",
-        "kind",
-        "test_id",
-        "success",
-        "path",
-        "timestamp",
-        "run_id",
-        "repo2docker_version",
-    ),
-)
+class InProgress(Exception):
+    """Raised when another process is checking the same repo for the same run"""
 
 
 def test_one_repo(repo, ref="master", run_dir="./runs", force_build=False):
+    """Check one repo@ref, recording results in run_dir
+
+    Runs are resumable: rerunning with the same run_id
+    skips repos that are already done, and tests with results recorded.
+    """
     slug = repo_slug(repo).lower()
     slug_parts = slug.split("/")
     path = "/".join([slug_parts[0], slug_parts[1][0]] + slug_parts[1:])
@@ -286,87 +925,255 @@ def test_one_repo(repo, ref="master", run_dir="./runs", force_build=False):
         except FileExistsError:
             pass
     result_file = os.path.join(result_dir, f"results-{ref}-{run_id}.csv")
-    with open(result_file, "w") as f:
-        writer = csv.writer(f)
-        writer.writerow(TestResult._fields)
-    build_log_file = os.path.join(log_dir, f"build-{ref}-{run_id}.txt")
-
-    checkout_path, resolved_ref, last_modified = clone_repo(repo, ref)
-
-    log.info(f"Building {repo}@{ref} in {repo_run_dir} with run id {run_id}")
-    results = []
+    build_log_file = os.path.join(log_dir, log_file_name(f"build-{ref}-{run_id}.txt"))
+    # result_file is complete when done_file exists
+    done_file = os.path.join(result_dir, f"results-{ref}-{run_id}.done")
+    with open(os.path.join(result_dir, f"results-{ref}-{run_id}.lock"), "a") as lock_f:
+        # only one process checks a repo@ref per run,
+        # so several can share a run directory
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise InProgress(f"{repo}@{ref} is being checked by another process")
+        if os.path.exists(done_file):
+            log.info(f"Already checked {repo}@{ref} in run {run_id}")
+            return result_file, list(read_csv(result_file))
+
+        with CSVResults(result_file, append=True) as csv_results:
+            # results recorded before the last run with this run id was interrupted
+            previous = list(read_csv(result_file))
+            try:
+                result = _test_one_repo(
+                    repo,
+                    ref,
+                    run_dir,
+                    repo_run_dir,
+                    build_log_file,
+                    csv_results,
+                    force_build,
+                    previous,
+                )
+            finally:
+                if results_db is not None:
+                    results_db.flush()
+        with open(done_file, "w"):
+            pass
+        return result
+
+
+def _test_one_repo(
+    repo,
+    ref,
+    run_dir,
+    repo_run_dir,
+    build_log_file,
+    csv_results,
+    force_build,
+    previous=(),
+):
+    """The part of test_one_repo after setting up the run directory
+
+    previous are results already recorded for this run,
+    which are not run again.
+    """
+    result_file = csv_results.path
+    results = list(previous)
+    previous_build = [r for r in previous if r.kind == "build"]
+    previous_analysis = [r for r in previous if r.kind == "analysis"]
+    if previous_build and not previous_build[0].success:
+        # interrupted after recording a failed build, nothing left to do
+        return result_file, results
+    if previous_analysis and not previous_build and not build_untestable:
+        # interrupted after finding the repo can't be tested
+        return result_file, results
+    if results:
+        log.info(f"Resuming {repo}@{ref} with {len(results)} results recorded")
+    with stage("clone"), tracer.span("clone_repo", repo=repo, ref=ref):
+        checkout_path, resolved_ref, last_modified = clone_repo(repo, ref)
 
-    def add_result(kind, test_id, success, path):
-        path = os.path.relpath(path, run_dir)
-        log.info(
-            f"Recording test result: repo={repo}, kind={kind}, test_id={test_id}, {'success' if success else 'failure'}"
-        )
-        result = TestResult(
-            repo,
-            ref,
-            resolved_ref,
-            last_modified,
-            kind,
-            test_id,
-            success,
-            path,
-            timestamp,
-            run_id,
-            repo2docker.__version__,
-        )
-        results.append(result)
+    try:
+        log.info(f"Building {repo}@{ref} in {repo_run_dir} with run id {run_id}")
+
+        def add_result(
+            kind, test_id, success, path, cache="", duration="", failure_reason=""
+        ):
+            path = os.path.relpath(path, run_dir)
+            log.info(
+                f"Recording test result: repo={repo}, kind={kind}, test_id={test_id}, {'success' if success else 'failure'}"
+            )
+            result = TestResult(
+                repo,
+                ref,
+                resolved_ref,
+                last_modified,
+                kind,
+                test_id,
+                success,
+                path,
+                timestamp,
+                run_id,
+                repo2docker.__version__,
+                cache,
+                duration,
+                failure_reason,
+            )
+            results.append(result)
+            csv_results.add(result)
+            if results_db is not None:
+                results_db.add(result)
+
+        with tracer.span("analyze", repo=repo, ref=ref) as span:
+            analysis = analyze(
+                checkout_path,
+                package_index=package_index,
+                notebook_priority=notebook_priority,
+            )
+            span["reason"] = analysis["reason"]
+        if analysis["reason"] and not previous_analysis:
+            analysis_file = os.path.join(
+                os.path.dirname(build_log_file), f"analysis-{ref}-{run_id}.json"
+            )
+            with open(analysis_file, "w") as f:
+                json.dump(analysis, f, indent=1)
+            add_result(
+                kind="analysis",
+                test_id=analysis["reason"],
+                success=False,
+                path=analysis_file,
+                duration=span["duration"],
+                failure_reason=analysis["reason"],
+            )
+        if analysis["reason"] and not build_untestable:
+            log.info(f"Not building {repo}@{ref}: {analysis['reason']}")
+            return result_file, results
+
+        for attempt in range(retries + 1):
+            if attempt:
+                # docker's layer cache keeps what was built before the failure
+                wait_to_retry(f"build of {repo}@{ref}", attempt)
+            try:
+                with stage("build"), tracer.span(
+                    "build", repo=repo, ref=ref, attempt=attempt
+                ) as span:
+                    try:
+                        image, build_cache = build_image(
+                            repo,
+                            resolved_ref=resolved_ref,
+                            checkout_path=checkout_path,
+                            build_log_file=build_log_file,
+                            # the image was already built before resuming
+                            force_build=force_build and not previous_build,
+                        )
+                        span["cache"] = build_cache
+                        if build_cache == "miss":
+                            span.update(
+                                report_base_reuse(image, checkout_path, build_log_file)
+                            )
+                    finally:
+                        if os.path.exists(build_log_file):
+                            span["log_bytes"] = os.path.getsize(build_log_file)
+            except Exception as e:
+                # log errors that won't be in the build log
+                # (these will usually be bugs in our script!)
+                if not isinstance(e, CalledProcessError):
+                    log.exception("Build failure")
+                    with open_log(build_log_file, "a") as f:
+                        traceback.print_exc(file=f)
+                reason = classify_log(build_log_file)
+                if attempt < retries and is_transient(reason):
+                    log.warning(f"Build of {repo}@{ref} failed ({reason}), will retry")
+                    continue
+                # record build failure
+                add_result(
+                    kind="build",
+                    test_id="build",
+                    success=False,
+                    path=build_log_file,
+                    duration=span["duration"],
+                    failure_reason=reason,
+                )
+                return result_file, results
+            else:
+                break
+
+        if not previous_build:
+            add_result(
+                kind="build",
+                test_id="build",
+                success=True,
+                path=build_log_file,
+                cache=build_cache,
+                duration=span["duration"],
+            )
 
-        with open(result_file, "a") as f:
-            writer = csv.writer(f)
-            writer.writerow(result)
+        done = {(r.kind, r.test_id) for r in previous}
+        for result in run_tests(
+            image, checkout_path, repo_run_dir, skip=done, repo=repo
+        ):
+            add_result(**result)
 
-    try:
-        image, checkout_path = build_repo(
-            repo,
-            resolved_ref=resolved_ref,
-            checkout_path=checkout_path,
-            build_log_file=build_log_file,
-            force_build=force_build,
-        )
-    except Exception:
-        # log errors that won't be in the build log
-        # (these will usually be bugs in our script!)
-        if not isinstance(Exception, CalledProcessError):
-            log.exception("Build failure")
-            with open(build_log_file, "a") as f:
-                traceback.print_exc(file=f)
-        # record build failure
-        add_result(kind="build", test_id="build", success=False, path=build_log_file)
         return result_file, results
-    else:
-        add_result(kind="build", test_id="build", success=True, path=build_log_file)
+    finally:
+        remove_checkout(checkout_path)
+
 
-    for result in run_tests(image, checkout_path, repo_run_dir):
-        add_result(**result)
+def slowest_cells(repo_run_dir, notebooks, n=5):
+    """The n slowest cells of the given notebooks
 
-    return result_file, results
+    Reads the cell profiles written by inrepo.run_notebook
+    to profiles/{run_id}/ in the repo's run directory,
+    so notebooks not run in this run (e.g. with results carried forward) are skipped.
+    Returns a list of (notebook, cell profile) tuples, slowest first.
+    """
+    cells = []
+    for nb_path in notebooks:
+        profile_path = os.path.join(repo_run_dir, "profiles", run_id, nb_path + ".json")
+        try:
+            with open(profile_path) as f:
+                profile = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        cells.extend((nb_path, cell) for cell in profile["cells"])
+    cells.sort(key=lambda nb_cell: nb_cell[1]["duration"], reverse=True)
+    return cells[:n]
 
 
 def print_summary(results, result_file, run_dir):
     """Print a summary of th"""
-    build_result = results[0]
-    print(
-        f"Result summary for {build_result.repo}@{build_result.ref}-{build_result.resolved_ref}:"
-    )
+    first = results[0]
+    print(f"Result summary for {first.repo}@{first.ref}-{first.resolved_ref}:")
     print(f"  Result file: {result_file}")
+    for result in results:
+        if result.kind == "analysis":
+            print(
+                f"  Can't be tested ({result.test_id}),"
+                f" see {os.path.join(run_dir, result.path)} for details"
+            )
+    builds = [r for r in results if r.kind == "build"]
+    if not builds:
+        print("  Not built")
+        return
+    build_result = builds[0]
     if not build_result.success:
+        reason = (
+            f" ({build_result.failure_reason})" if build_result.failure_reason else ""
+        )
         print(
-            f"Build failed, see {os.path.join(run_dir, build_result.path)} for details"
+            f"Build failed{reason}, see {os.path.join(run_dir, build_result.path)} for details"
         )
         return
 
-    if len(results) == 1:
+    if build_result.cache and build_result.cache != "miss":
+        print(f"  Build skipped (cached {build_result.cache})")
+
+    tests = [r for r in results if r.kind not in {"analysis", "build"}]
+    if not tests:
         print("  No tests found!")
         return
 
     counters = defaultdict(int)
     failures = []
-    for result in results[1:]:
+    for result in tests:
         key = f"{result.kind}:{'ok' if result.success else 'fail'}"
         counters[key] += 1
         if not result.success:
@@ -374,17 +1181,143 @@ def print_summary(results, result_file, run_dir):
     print("  test:status: count")
     for key, count in sorted(counters.items()):
         print(f"  {key}: {count}")
+    carried = sum(1 for r in tests if r.cache == "result")
+    if carried:
+        print(f"  {carried} unchanged since they last passed, not run again")
     if failures:
         print(f"  {len(failures)} failure{'s' if len(failures) != 1 else ''}:")
         for r in failures:
-            print(f"    {r.kind} {r.test_id}: {os.path.join(run_dir, r.path)}")
+            reason = f" ({r.failure_reason})" if r.failure_reason else ""
+            print(f"    {r.kind} {r.test_id}{reason}: {os.path.join(run_dir, r.path)}")
     else:
         print("OK!")
 
+    repo_run_dir = os.path.dirname(os.path.dirname(result_file))
+    notebooks = [r.test_id for r in results if r.kind == "notebook"]
+    cells = slowest_cells(repo_run_dir, notebooks, n=slowest_cells_shown)
+    if cells:
+        print("  Slowest cells:")
+        for nb_path, cell in cells:
+            busy = "" if cell["busy"] is None else f", kernel busy {cell['busy']:.1f}s"
+            status = "" if cell["status"] == "ok" else f" ({cell['status']})"
+            print(
+                f"    {nb_path} cell {cell['index']}{status}: {cell['duration']:.1f}s{busy}"
+            )
+
+
+def push_results(result_file, run_dir, dest_dir):
+    """Copy a repo's results and logs from run_dir to the same place in dest_dir"""
+    repo_run_dir = os.path.dirname(os.path.dirname(result_file))
+    dest_repo_dir = os.path.join(dest_dir, os.path.relpath(repo_run_dir, run_dir))
+    for parent, dirs, files in os.walk(repo_run_dir):
+        dest_parent = os.path.join(dest_repo_dir, os.path.relpath(parent, repo_run_dir))
+        os.makedirs(dest_parent, exist_ok=True)
+        for fname in files:
+            if fname.endswith(".lock"):
+                continue
+            shutil.copy2(os.path.join(parent, fname), os.path.join(dest_parent, fname))
+
+
+def _remove_orphaned_containers():
+    try:
+        remove_orphaned_containers(docker_client())
+    except Exception:
+        log.exception("Error removing orphaned containers")
+
+
+def _prune_images(max_image_bytes, policy):
+    try:
+        client = docker_client()
+        remove_stale_bases(client)
+        prune_images(client, max_image_bytes, policy=policy)
+    except Exception:
+        log.exception("Error pruning docker images")
+
+
+def check_queue(job_queue, run_dir, jobs=1, force_build=False, after_repo=None):
+    """Check repos from a queue, as one of several workers
+
+    Results and logs are written to run_dir, and pushed to the queue's directory
+    (with its results database).
+    For a JobQueue on this host, they are copied there if run_dir is elsewhere,
+    e.g. a scratch directory per worker.
+    Like the queue, the queue's directory is on a local filesystem
+    (see workqueue.network_filesystem), so its results database is safe to share.
+    For a RemoteQueue, they are uploaded to its coordinator.
+    """
+    push_db = None
+    push_dir = None
+    if isinstance(job_queue, JobQueue):
+        push_dir = os.path.dirname(os.path.abspath(job_queue.path))
+        if os.path.abspath(run_dir) != push_dir:
+            push_db = SQLiteResults(os.path.join(push_dir, "results.sqlite"))
+
+    def run_job(job):
+        result_file, results = test_one_repo(
+            job.repo, ref=job.ref, run_dir=run_dir, force_build=force_build
+        )
+        print_summary(results, result_file, run_dir)
+        if push_db is not None:
+            push_results(result_file, run_dir, push_dir)
+            push_db.add_many(results)
+            push_db.flush()
+        elif push_dir is None:
+            job_queue.push_results(result_file, run_dir)
+        if after_repo:
+            after_repo()
+        return os.path.relpath(result_file, run_dir)
+
+    try:
+        work(job_queue, run_job, jobs=jobs)
+    finally:
+        if push_db is not None:
+            push_db.close()
+
+
+# subcommands of repo2docker-checker, which otherwise takes repos to check
+subcommands = {
+    "migrate": migrate_main,
+    "plan": plan_main,
+    "prune": prune_main,
+    "queue": queue_main,
+    "report": report_main,
+    "results": results_main,
+}
+
 
 def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in subcommands:
+        return subcommands[argv[0]](argv[1:])
+    check_repos(argv)
+
+
+def check_repos(argv=None):
+    global run_id
     global notebook_limit
+    global notebook_priority
     global quiet
+    global test_mem_limit
+    global test_cpus
+    global test_parallel
+    global tests_per_container
+    global notebook_timeout
+    global test_timeout
+    global package_index
+    global build_untestable
+    global compress_logs
+    global log_max_bytes
+    global strip_notebook_outputs
+    global retries
+    global retry_delay
+    global test_output_limit
+    global echo_rate
+    global prewarm_min_repos
+    global results_db
+    global test_cache
+    global force_tests
+    global _test_slots
 
     tornado.log.enable_pretty_logging()
     parser = argparse.ArgumentParser(description=__doc__)
@@ -407,33 +1340,340 @@ def main(argv=None):
         type=int,
         help="Limit to this many notebook tests per repo",
     )
+    parser.add_argument(
+        "--notebook-priority",
+        default=notebook_priority,
+        help=f"""Which notebooks to test first (and keep, with --limit).
+        Comma-separated keys from {', '.join(sorted(PRIORITY_KEYS))},
+        prefix a key with '-' to reverse it, e.g. 'depth,-size'
+        for top-level notebooks first, then biggest first.""",
+    )
+    parser.add_argument(
+        "--test-mem-limit",
+        default=test_mem_limit,
+        help="Memory limit for each test container (e.g. 2G, empty for no limit)",
+    )
+    parser.add_argument(
+        "--test-cpus",
+        default=test_cpus,
+        type=float,
+        help="CPU limit for each test container (0 for no limit)",
+    )
+    parser.add_argument(
+        "--test-parallel",
+        default=test_parallel,
+        type=int,
+        help="""Max number of test containers to run at once, across all repos.
+        Default: as many as fit in the docker host's CPUs and memory
+        with the given --test-mem-limit and --test-cpus""",
+    )
+    parser.add_argument(
+        "--tests-per-container",
+        default=tests_per_container,
+        type=int,
+        help="""Max number of tests to run in one container.
+        Default (0) runs all of a repo's tests in a single container.
+        Use 1 to run each test in its own container, in parallel.""",
+    )
+    parser.add_argument(
+        "--test-timeout",
+        default=test_timeout,
+        type=float,
+        help="""Kill test containers that run for longer than this many seconds.
+        Default: no limit""",
+    )
+    parser.add_argument(
+        "--test-output-limit",
+        default="0",
+        help="""Kill test containers when a test outputs more than this (e.g. 100M),
+        failing it with reason output-limit (tests after it in the same container
+        are run again in a new one). 0 for no limit.""",
+    )
+    parser.add_argument(
+        "--echo-rate",
+        default="0",
+        help="""Echo at most this much output per second (e.g. 100K)
+        of each build or test to stderr, skipping the rest.
+        Logs are complete either way. 0 for no limit.""",
+    )
+    parser.add_argument(
+        "--notebook-timeout",
+        default=notebook_timeout,
+        type=int,
+        help="""Stop notebooks that take longer than this many seconds in total
+        (each cell also has a 600s timeout). Default: no limit""",
+    )
+    parser.add_argument(
+        "--retries",
+        default=retries,
+        type=int,
+        help="""Max number of times to retry builds and tests
+        that failed for transient reasons (e.g. network errors)""",
+    )
+    parser.add_argument(
+        "--retry-delay",
+        default=retry_delay,
+        type=float,
+        help="Seconds to wait before the first retry, doubling for each retry after",
+    )
+    parser.add_argument(
+        "--compress-logs",
+        action="store_true",
+        help="Gzip build and test logs, and executed notebooks",
+    )
+    parser.add_argument(
+        "--log-max-bytes",
+        default="0",
+        help="""Max size of each build or test log (e.g. 10M).
+        Longer logs keep their first and last halves. 0 for no limit.""",
+    )
+    parser.add_argument(
+        "--strip-notebook-outputs",
+        action="store_true",
+        help="Drop images and other non-text outputs from executed notebooks",
+    )
+    parser.add_argument(
+        "--git-cache-dir",
+        default=git_cache.path,
+        help="Directory in which to keep git mirrors of checked repos",
+    )
+    parser.add_argument(
+        "--git-cache-size",
+        default="20G",
+        help="Max size of the git cache. Least-recently-used mirrors are removed first.",
+    )
+    parser.add_argument(
+        "--max-image-bytes",
+        default="0",
+        help="""After each repo, remove test images until they fit in this size
+        (e.g. 100G). 0 for no limit.""",
+    )
+    parser.add_argument(
+        "--prune-policy",
+        choices=POLICIES,
+        default="lru",
+        help="Which test images to remove first when over --max-image-bytes",
+    )
+    parser.add_argument(
+        "--results-db",
+        default=None,
+        help="""SQLite database in which to also store results
+        (default: results.sqlite in --run-dir). Set to '' to only write CSV files.""",
+    )
+    parser.add_argument(
+        "--test-cache",
+        default=None,
+        help="""SQLite database of passing tests, whose results are carried forward
+        while their notebook, the rest of the repo and the environment are unchanged
+        (default: test-cache.sqlite in --run-dir). Set to '' to run all tests
+        without recording them.""",
+    )
+    parser.add_argument(
+        "--force-tests",
+        action="store_true",
+        help="Run all tests, even those unchanged since they last passed",
+    )
+    parser.add_argument(
+        "--trace-file",
+        default=None,
+        help="""File in which to record timing spans of each phase, in Chrome trace format
+        (default: trace-{run_id}.json in --run-dir). Set to '' to disable.""",
+    )
+    parser.add_argument(
+        "--package-index",
+        help="""File listing known package names, one per line (e.g. all names on PyPI).
+        Repos requiring packages that aren't listed are not built.""",
+    )
+    parser.add_argument(
+        "--build-untestable",
+        action="store_true",
+        help="""Build repos even if they have no notebooks or broken requirements
+        (for build-only statistics)""",
+    )
+    parser.add_argument(
+        "--prewarm",
+        type=int,
+        default=prewarm_min_repos,
+        metavar="N",
+        help="""Before checking, build base images for the base environments
+        (buildpack and python version) used by at least N of the repos,
+        shared by all their builds. 0 to disable.""",
+    )
     parser.add_argument(
         "--force-build",
         action="store_true",
         help="Force rebuild of images, even if an image already exists",
     )
-    parser.add_argument("repos", nargs="+", help="repos to test")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="Number of repos to check concurrently",
+    )
+    for stage_name, resource in [
+        ("clone", "network"),
+        ("build", "docker daemon and CPU"),
+        ("test", "container"),
+    ]:
+        parser.add_argument(
+            f"--{stage_name}-jobs",
+            type=int,
+            help=f"""Number of repos allowed in the {stage_name} stage at once
+            ({resource}-bound). Default: same as --jobs""",
+        )
+    parser.add_argument(
+        "--queue",
+        help="""Check repos from this queue (see `repo2docker-checker queue`)
+        instead of the command line, as one of several workers.
+        Either a queue database on a local filesystem, for workers on its host,
+        or the http(s) URL of a coordinator serving a queue (`queue serve`),
+        for workers on other hosts.
+        Results and logs are copied to the queue's directory.""",
+    )
+    parser.add_argument(
+        "--queue-token",
+        default=os.environ.get("QUEUE_TOKEN"),
+        help="Token for the coordinator serving --queue (default: $QUEUE_TOKEN)",
+    )
+    parser.add_argument("repos", nargs="*", help="repos to test")
     opts = parser.parse_args(argv)
+    if opts.queue and opts.repos:
+        parser.error("Give repos to check or --queue, not both")
+    if not opts.queue and not opts.repos:
+        parser.error("Give repos to check, or a --queue to take them from")
+    job_queue = None
+    if opts.queue and opts.queue.startswith(("http://", "https://")):
+        try:
+            job_queue = RemoteQueue(opts.queue, token=opts.queue_token)
+        except (OSError, RuntimeError) as e:
+            parser.error(f"Couldn't connect to queue {opts.queue}: {e}")
+        run_id = job_queue.run_id or run_id
+    elif opts.queue:
+        if not os.path.exists(opts.queue):
+            parser.error(f"No such queue {opts.queue}")
+        try:
+            job_queue = JobQueue(opts.queue)
+        except ValueError as e:
+            parser.error(str(e))
+        run_id = job_queue.run_id or run_id
+    try:
+        parse_priority(opts.notebook_priority)
+    except ValueError as e:
+        parser.error(str(e))
+    # these are only set here, before any workers start
     quiet = opts.quiet
     notebook_limit = opts.limit
+    notebook_priority = opts.notebook_priority
+    test_mem_limit = opts.test_mem_limit
+    test_cpus = opts.test_cpus
+    test_parallel = opts.test_parallel
+    tests_per_container = opts.tests_per_container
+    notebook_timeout = opts.notebook_timeout
+    test_timeout = opts.test_timeout
+    package_index = (
+        load_package_index(opts.package_index) if opts.package_index else None
+    )
+    build_untestable = opts.build_untestable
+    compress_logs = opts.compress_logs
+    log_max_bytes = parse_bytes(opts.log_max_bytes)
+    strip_notebook_outputs = opts.strip_notebook_outputs
+    retries = opts.retries
+    retry_delay = opts.retry_delay
+    test_output_limit = parse_bytes(opts.test_output_limit)
+    echo_rate = parse_bytes(opts.echo_rate)
+    prewarm_min_repos = opts.prewarm
+    git_cache.path = opts.git_cache_dir
+    git_cache.max_bytes = parse_bytes(opts.git_cache_size)
+    max_image_bytes = parse_bytes(opts.max_image_bytes)
+    if opts.results_db is None:
+        opts.results_db = os.path.join(opts.run_dir, "results.sqlite")
+    if opts.results_db:
+        os.makedirs(os.path.dirname(os.path.abspath(opts.results_db)), exist_ok=True)
+        results_db = SQLiteResults(opts.results_db)
+    if opts.test_cache is None:
+        opts.test_cache = os.path.join(opts.run_dir, "test-cache.sqlite")
+    if opts.test_cache:
+        os.makedirs(os.path.dirname(os.path.abspath(opts.test_cache)), exist_ok=True)
+        test_cache = TestCache(opts.test_cache)
+    force_tests = opts.force_tests
+    if opts.trace_file is None:
+        opts.trace_file = os.path.join(opts.run_dir, f"trace-{run_id}.json")
+    if opts.trace_file:
+        os.makedirs(os.path.dirname(os.path.abspath(opts.trace_file)), exist_ok=True)
+    tracer.path = opts.trace_file
+    _test_slots = None
+    set_stage_limits(
+        clone=opts.clone_jobs or opts.jobs,
+        build=opts.build_jobs or opts.jobs,
+        test=opts.test_jobs or opts.jobs,
+    )
 
+    repo_refs = []
     for repo in opts.repos:
-        if "://" not in repo:
-            # allow a/b shortcuts for github
-            repo = "https://github.com/" + repo
+        repo_ref = parse_repo_ref(repo)
+        # each (repo, ref) has one result file, so only check it once
+        if repo_ref not in repo_refs:
+            repo_refs.append(repo_ref)
+
+    def after_repo():
+        # containers left behind by failed tests are always removed,
+        # images only when asked to
+        _remove_orphaned_containers()
+        if max_image_bytes:
+            _prune_images(max_image_bytes, opts.prune_policy)
 
-        if "@" in repo:
-            repo, ref = repo.split("@")
-        else:
-            ref = "master"
-        try:
-            result_file, results = test_one_repo(
-                repo, ref=ref, run_dir=opts.run_dir, force_build=opts.force_build
+    try:
+        if prewarm_min_repos:
+            if job_queue is not None:
+                pending = [
+                    (job["repo"], job["ref"]) for job in job_queue.jobs("pending")
+                ]
+            else:
+                pending = repo_refs
+            prewarm_bases(pending, opts.run_dir, jobs=opts.jobs)
+        if job_queue is not None:
+            check_queue(
+                job_queue,
+                opts.run_dir,
+                jobs=opts.jobs,
+                force_build=opts.force_build,
+                after_repo=after_repo,
             )
-        except Exception:
-            log.exception(f"Error testing {repo}@{ref}")
-        else:
-            print_summary(results, result_file, opts.run_dir)
+            return
+        with ThreadPoolExecutor(max(opts.jobs, 1)) as pool:
+            futures = {
+                pool.submit(
+                    test_one_repo,
+                    repo,
+                    ref=ref,
+                    run_dir=opts.run_dir,
+                    force_build=opts.force_build,
+                ): (repo, ref)
+                for repo, ref in repo_refs
+            }
+            # report results as each repo finishes
+            for future in as_completed(futures):
+                repo, ref = futures[future]
+                try:
+                    result_file, results = future.result()
+                except InProgress as e:
+                    log.warning(f"Skipping {repo}@{ref}: {e}")
+                except Exception:
+                    log.exception(f"Error testing {repo}@{ref}")
+                else:
+                    print_summary(results, result_file, opts.run_dir)
+                after_repo()
+
+    finally:
+        if results_db is not None:
+            results_db.close()
+            results_db = None
+        if test_cache is not None:
+            test_cache.close()
+            test_cache = None
+        if job_queue is not None:
+            job_queue.close()
 
 
 if __name__ == "__main__":
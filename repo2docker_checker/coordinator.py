@@ -0,0 +1,292 @@
+"""Serving a queue to workers on other hosts
+
+The coordinator owns the queue's SQLite database (on its local filesystem),
+and hands out leases on jobs over HTTP, with the same lease and heartbeat
+logic as workers on the queue's own host.
+Workers upload each repo's results and logs to the coordinator when they're done,
+which stores them in the queue's directory and its results database,
+like workers on the same host copy them there.
+
+    repo2docker-checker queue serve --queue runs/queue.sqlite --ip 0.0.0.0 --port 8765
+
+and on each worker host:
+
+    repo2docker-checker --queue http://coordinator:8765 --run-dir /tmp/runs --jobs 2
+
+If a token is set (--token, or $QUEUE_TOKEN on both ends),
+requests without it are refused.
+Requests are not encrypted, so only serve queues on trusted networks.
+"""
+import io
+import json
+import logging
+import os
+import socket
+import tarfile
+from threading import get_ident
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request
+from urllib.request import urlopen
+
+import tornado.ioloop
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+from .results import read_csv
+from .results import SQLiteResults
+from .workqueue import BaseQueue
+from .workqueue import Job
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+
+# the largest upload of a repo's results and logs
+MAX_UPLOAD_BYTES = 1024**3
+
+
+def _safe_relpath(path):
+    """Normalize a relative path, raising ValueError if it leaves its directory"""
+    path = os.path.normpath(path)
+    if os.path.isabs(path) or path == ".." or path.startswith(".." + os.sep):
+        raise ValueError(f"Not a relative path: {path}")
+    return path
+
+
+def pack_results(result_file, run_dir):
+    """A gzipped tarball of a repo's run directory, for upload to a coordinator
+
+    Returns (result_file relative to run_dir, tarball bytes).
+    """
+    repo_run_dir = os.path.dirname(os.path.dirname(result_file))
+    arcname = os.path.relpath(repo_run_dir, run_dir)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+        tf.add(
+            repo_run_dir,
+            arcname=arcname,
+            filter=lambda info: None if info.name.endswith(".lock") else info,
+        )
+    return os.path.relpath(result_file, run_dir), buf.getvalue()
+
+
+def unpack_results(result_file, data, run_dir):
+    """Unpack a tarball from pack_results into run_dir
+
+    Only regular files and directories in the result file's repo directory
+    are extracted.
+    Returns the path of the result file.
+    """
+    result_file = _safe_relpath(result_file)
+    repo_dir = os.path.dirname(os.path.dirname(result_file))
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tf:
+        members = []
+        for member in tf.getmembers():
+            name = _safe_relpath(member.name)
+            if name != repo_dir and not name.startswith(repo_dir + os.sep):
+                raise ValueError(f"{member.name} is not in {repo_dir}")
+            if not (member.isfile() or member.isdir()):
+                raise ValueError(f"{member.name} is not a file or directory")
+            members.append(member)
+        tf.extractall(run_dir, members=members)
+    return os.path.join(run_dir, result_file)
+
+
+class QueueHandler(tornado.web.RequestHandler):
+    """Base handler for the coordinator's API: JSON in and out, with a token"""
+
+    def initialize(self, job_queue, run_dir, results_db, token):
+        self.job_queue = job_queue
+        self.run_dir = run_dir
+        self.results_db = results_db
+        self.token = token
+
+    def prepare(self):
+        if self.token and self.request.headers.get("Authorization") != (
+            f"token {self.token}"
+        ):
+            raise tornado.web.HTTPError(403)
+
+    def get_json_body(self):
+        try:
+            return json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid JSON")
+
+    def get_job(self):
+        """The Job in the request body"""
+        try:
+            return Job(**self.get_json_body()["job"])
+        except (KeyError, TypeError):
+            raise tornado.web.HTTPError(400, "Missing job")
+
+    def write_json(self, data):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+
+class StatusHandler(QueueHandler):
+    def get(self):
+        self.write_json(
+            {
+                "run_id": self.job_queue.run_id,
+                "lease_seconds": self.job_queue.lease_seconds,
+                "counts": self.job_queue.counts(),
+            }
+        )
+
+
+class JobsHandler(QueueHandler):
+    def get(self):
+        state = self.get_argument("state", None)
+        self.write_json(self.job_queue.jobs(state))
+
+
+class LeaseHandler(QueueHandler):
+    def post(self):
+        worker = self.get_json_body().get("worker") or self.request.remote_ip
+        job = self.job_queue.lease(worker=f"{worker}")
+        self.write_json({"job": job._asdict() if job else None})
+
+
+class RenewHandler(QueueHandler):
+    def post(self):
+        self.write_json({"renewed": self.job_queue.renew(self.get_job())})
+
+
+class CompleteHandler(QueueHandler):
+    def post(self):
+        body = self.get_json_body()
+        self.job_queue.complete(self.get_job(), body.get("result_file"))
+        self.write_json({})
+
+
+class FailHandler(QueueHandler):
+    def post(self):
+        self.job_queue.fail(self.get_job(), self.get_json_body().get("error", ""))
+        self.write_json({})
+
+
+class ResultsHandler(QueueHandler):
+    async def put(self):
+        result_file = self.get_argument("result_file")
+        try:
+            count = await tornado.ioloop.IOLoop.current().run_in_executor(
+                None, self._store, result_file, self.request.body
+            )
+        except (ValueError, tarfile.TarError) as e:
+            raise tornado.web.HTTPError(400, f"Invalid results: {e}")
+        self.write_json({"results": count})
+
+    def _store(self, result_file, data):
+        """Unpack uploaded results, and add them to the results database"""
+        path = unpack_results(result_file, data, self.run_dir)
+        results = list(read_csv(path))
+        self.results_db.add_many(results)
+        self.results_db.flush()
+        log.info(f"Received {len(results)} results in {result_file}")
+        return len(results)
+
+
+def make_app(job_queue, run_dir, results_db, token=None):
+    """The coordinator's tornado Application"""
+    settings = dict(
+        job_queue=job_queue, run_dir=run_dir, results_db=results_db, token=token
+    )
+    return tornado.web.Application(
+        [
+            (r"/api/queue", StatusHandler, settings),
+            (r"/api/jobs", JobsHandler, settings),
+            (r"/api/lease", LeaseHandler, settings),
+            (r"/api/renew", RenewHandler, settings),
+            (r"/api/complete", CompleteHandler, settings),
+            (r"/api/fail", FailHandler, settings),
+            (r"/api/results", ResultsHandler, settings),
+        ]
+    )
+
+
+def serve(job_queue, ip="", port=DEFAULT_PORT, token=None):
+    """Serve a queue to workers, until interrupted
+
+    Results are stored in the queue's directory.
+    """
+    run_dir = os.path.dirname(os.path.abspath(job_queue.path))
+    results_db = SQLiteResults(os.path.join(run_dir, "results.sqlite"))
+    app = make_app(job_queue, run_dir, results_db, token=token)
+    server = HTTPServer(app, max_body_size=MAX_UPLOAD_BYTES)
+    server.listen(port, ip)
+    log.info(f"Serving queue {job_queue.path} at http://{ip or '*'}:{port}")
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        server.stop()
+        results_db.close()
+
+
+class RemoteQueue(BaseQueue):
+    """A queue served by a coordinator, for workers on other hosts
+
+    Has the methods of JobQueue used by workers (see workqueue.work),
+    plus push_results to upload a repo's results to the coordinator.
+    """
+
+    def __init__(self, url, token=None, timeout=60):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        status = self._request("GET", "/api/queue")
+        self.run_id = status["run_id"]
+        self.lease_seconds = status["lease_seconds"]
+
+    def _request(self, method, path, body=None, data=None, params=None):
+        """Make a request to the coordinator, return the parsed JSON response"""
+        url = self.url + path
+        if params:
+            url += "?" + urlencode(params)
+        headers = {}
+        if self.token:
+            headers["Authorization"] = f"token {self.token}"
+        if body is not None:
+            data = json.dumps(body).encode("utf8")
+            headers["Content-Type"] = "application/json"
+        request = Request(url, data=data, headers=headers, method=method)
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except HTTPError as e:
+            raise RuntimeError(f"{method} {url} failed: {e.code} {e.reason}") from e
+
+    def close(self):
+        pass
+
+    def counts(self):
+        return self._request("GET", "/api/queue")["counts"]
+
+    def jobs(self, state=None):
+        return self._request("GET", "/api/jobs", params={"state": state or ""})
+
+    def lease(self, worker=None):
+        worker = worker or f"{self.worker_id}-{get_ident()}"
+        job = self._request("POST", "/api/lease", {"worker": worker})["job"]
+        return None if job is None else Job(**job)
+
+    def renew(self, job):
+        return self._request("POST", "/api/renew", {"job": job._asdict()})["renewed"]
+
+    def complete(self, job, result_file=None):
+        self._request(
+            "POST", "/api/complete", {"job": job._asdict(), "result_file": result_file}
+        )
+
+    def fail(self, job, error):
+        self._request("POST", "/api/fail", {"job": job._asdict(), "error": error})
+
+    def push_results(self, result_file, run_dir):
+        """Upload a repo's results and logs in run_dir to the coordinator"""
+        rel_path, data = pack_results(result_file, run_dir)
+        self._request(
+            "PUT", "/api/results", data=data, params={"result_file": rel_path}
+        )
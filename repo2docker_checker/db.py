@@ -0,0 +1,48 @@
+"""SQLite databases shared by threads and processes
+
+Results, the test cache, the job queue and migration journals
+are all SQLite databases that several threads
+(and several processes on the same host) may use at once.
+"""
+import sqlite3
+from contextlib import contextmanager
+from contextlib import nullcontext
+
+
+def connect(path, journal_mode="WAL"):
+    """Connect to a SQLite database, to share across threads
+
+    Rows are sqlite3.Row.
+    Transactions are explicit (see transaction), not started implicitly,
+    and wait up to a minute for other processes' locks.
+
+    The default WAL journal lets readers and a writer work concurrently.
+    Use journal_mode="DELETE" (the rollback journal) for a database
+    that should be a single file, consistent whenever it isn't locked.
+    """
+    db = sqlite3.connect(
+        path, timeout=60, check_same_thread=False, isolation_level=None
+    )
+    db.row_factory = sqlite3.Row
+    db.execute(f"PRAGMA journal_mode={journal_mode}")
+    return db
+
+
+@contextmanager
+def transaction(db, lock=None):
+    """A write transaction, committed unless the block raises
+
+    BEGIN IMMEDIATE takes the write lock up front,
+    waiting for other writers (see connect), instead of failing on first write.
+    lock, if given, is held for the transaction,
+    e.g. a threading.Lock for a connection shared across threads.
+    """
+    with lock or nullcontext():
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        else:
+            db.execute("COMMIT")
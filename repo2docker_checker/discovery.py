@@ -0,0 +1,150 @@
+"""Finding notebooks to test in a checkout
+
+Notebooks are listed from the git index when the checkout is a git repo,
+which never touches untracked or ignored files.
+Otherwise, the checkout is walked,
+skipping hidden directories and directories that are never worth testing
+(dependencies, caches, checkpoints).
+
+Notebooks are sorted by priority, so that when only the first few
+are tested, they are the most useful ones.
+"""
+import logging
+import os
+from subprocess import CalledProcessError
+from subprocess import check_output
+from subprocess import DEVNULL
+
+log = logging.getLogger(__name__)
+
+# directories never searched for notebooks
+# (hidden directories, e.g. .git and .ipynb_checkpoints, are also skipped)
+SKIP_DIRS = {
+    "__pycache__",
+    "bower_components",
+    "node_modules",
+    "site-packages",
+    "venv",
+}
+
+
+def _skipped(rel_path):
+    """Whether a notebook is in a directory that should be skipped"""
+    for part in rel_path.split(os.path.sep)[:-1]:
+        if part.startswith(".") or part in SKIP_DIRS:
+            return True
+    return False
+
+
+def git_notebooks(path):
+    """List notebooks tracked by git in path, including in submodules
+
+    Returns None if path is not a git repo.
+    """
+    try:
+        out = check_output(
+            ["git", "ls-files", "-z", "--cached", "--recurse-submodules", "*.ipynb"],
+            cwd=path,
+            stderr=DEVNULL,
+        )
+    except (CalledProcessError, FileNotFoundError):
+        return None
+    notebooks = []
+    for rel_path in out.decode("utf8", "replace").split("\0"):
+        if not rel_path.endswith(".ipynb"):
+            continue
+        rel_path = os.path.normpath(rel_path)
+        if not _skipped(rel_path):
+            notebooks.append(rel_path)
+    return notebooks
+
+
+def walk_notebooks(path):
+    """List notebooks in path, skipping hidden and SKIP_DIRS directories
+
+    Does not follow symlinks to directories.
+    """
+    notebooks = []
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(path, rel_dir)) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            name = entry.name
+            if name.endswith(".ipynb") and entry.is_file():
+                notebooks.append(os.path.join(rel_dir, name))
+            elif (
+                not name.startswith(".")
+                and name not in SKIP_DIRS
+                and entry.is_dir(follow_symlinks=False)
+            ):
+                stack.append(os.path.join(rel_dir, name))
+    return notebooks
+
+
+def _size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+# keys for sorting notebooks: (path, relative path) -> sortable value
+PRIORITY_KEYS = {
+    # top-level notebooks first
+    "depth": lambda path, rel_path: rel_path.count(os.path.sep),
+    # smallest notebooks first
+    "size": lambda path, rel_path: _size(os.path.join(path, rel_path)),
+    # alphabetical
+    "name": lambda path, rel_path: rel_path,
+}
+
+DEFAULT_PRIORITY = "depth,name"
+
+
+def parse_priority(priority):
+    """Parse a comma-separated priority, e.g. 'depth,-size'
+
+    Returns a list of (key, reverse) pairs.
+    A leading '-' reverses a key (e.g. '-size' for biggest first).
+    """
+    keys = []
+    for key in priority.split(","):
+        key = key.strip()
+        if not key:
+            continue
+        reverse = key.startswith("-")
+        key = key.lstrip("-")
+        if key not in PRIORITY_KEYS:
+            raise ValueError(
+                f"Unknown notebook priority {key!r}, not in {sorted(PRIORITY_KEYS)}"
+            )
+        keys.append((key, reverse))
+    return keys
+
+
+def rank_notebooks(path, notebooks, priority=DEFAULT_PRIORITY):
+    """Sort notebooks (relative to path) by priority, most useful first"""
+    keys = parse_priority(priority)
+    # sort by each key in turn, least significant first (sort is stable)
+    notebooks = sorted(notebooks)
+    for key, reverse in reversed(keys):
+        key_f = PRIORITY_KEYS[key]
+        notebooks.sort(key=lambda rel_path: key_f(path, rel_path), reverse=reverse)
+    return notebooks
+
+
+def find_notebooks(path, priority=DEFAULT_PRIORITY):
+    """Find the notebooks in a directory, most useful first
+
+    Returns paths relative to the given directory
+    """
+    notebooks = git_notebooks(path)
+    if notebooks is None:
+        log.info(f"{path} is not a git repo, searching for notebooks")
+        notebooks = walk_notebooks(path)
+    return rank_notebooks(path, notebooks, priority)
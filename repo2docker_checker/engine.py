@@ -0,0 +1,413 @@
+"""Asynchronous docker engine for running test containers
+
+All test containers are run from one event loop, in a background thread,
+which streams their logs, waits for them to exit,
+and applies timeouts and cancellation to each container,
+instead of a blocked thread per running container.
+
+The loop talks to the docker API directly, over a small pool of
+keep-alive connections (plus one connection per log stream).
+
+Blocking wrappers (Engine.run, Engine.run_container)
+run coroutines on the loop from other threads.
+
+Container output is written to its log in a small pool of threads,
+one write at a time for each container,
+so writing logs (compression, a slow disk, echo to stderr)
+doesn't hold up other containers.
+"""
+import asyncio
+import json
+import logging
+import os
+import ssl
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from urllib.parse import quote
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HOST = "unix:///var/run/docker.sock"
+
+# read streamed responses in blocks of this many bytes
+BLOCK_SIZE = 64 * 1024
+
+# threads for writing container output to logs
+LOG_THREADS = 4
+
+
+class DockerAPIError(Exception):
+    """An error response from the docker API"""
+
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+def _tls_from_env():
+    """An SSLContext from DOCKER_TLS_VERIFY/DOCKER_CERT_PATH, or None"""
+    if not os.environ.get("DOCKER_TLS_VERIFY"):
+        return None
+    cert_path = os.environ.get("DOCKER_CERT_PATH") or os.path.expanduser("~/.docker")
+    context = ssl.create_default_context(cafile=os.path.join(cert_path, "ca.pem"))
+    context.load_cert_chain(
+        os.path.join(cert_path, "cert.pem"), os.path.join(cert_path, "key.pem")
+    )
+    return context
+
+
+async def _read_headers(reader):
+    """Read HTTP response headers, return a dict with lowercase keys"""
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        key, _, value = line.decode("latin1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+
+async def _read_body(reader, status, headers):
+    """Yield chunks of an HTTP response body"""
+    if status in (204, 304):
+        return
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            data = await reader.readexactly(size)
+            await reader.readexactly(2)
+            yield data
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining:
+            data = await reader.read(min(remaining, BLOCK_SIZE))
+            if not data:
+                raise ConnectionResetError("Connection closed mid-response")
+            remaining -= len(data)
+            yield data
+    else:
+        # until the connection is closed
+        while True:
+            data = await reader.read(BLOCK_SIZE)
+            if not data:
+                return
+            yield data
+
+
+async def demux(chunks):
+    """Demultiplex a docker log stream into its payloads
+
+    Output of containers without a tty is framed with an 8-byte header:
+    stream type (stdout/stderr), 3 bytes of padding, payload size.
+    The payloads of all complete frames in a chunk are yielded together.
+    """
+    buf = bytearray()
+    async for chunk in chunks:
+        buf += chunk
+        start = 0
+        payloads = []
+        while len(buf) - start >= 8:
+            stream_type, size = struct.unpack_from(">BxxxL", buf, start)
+            if len(buf) - start - 8 < size:
+                break
+            payloads.append(buf[start + 8 : start + 8 + size])
+            start += 8 + size
+        del buf[:start]
+        data = b"".join(payloads)
+        if data:
+            yield data
+
+
+async def _close(writer):
+    """Close a connection and wait for it to be closed"""
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, OSError):
+        pass
+
+
+class AsyncDockerClient:
+    """A minimal asyncio client for the docker API
+
+    Only what's needed to run test containers.
+    Must be used from a single event loop.
+
+    base_url: the docker host (default: $DOCKER_HOST or the local socket)
+    max_idle: max number of idle connections to keep for reuse
+    """
+
+    def __init__(self, base_url=None, max_idle=4):
+        self.base_url = base_url or os.environ.get("DOCKER_HOST") or DEFAULT_HOST
+        self.max_idle = max_idle
+        self._ssl = _tls_from_env()
+        self._idle = []
+
+    async def _connect(self):
+        url = urlparse(self.base_url)
+        if url.scheme in {"unix", "http+unix"}:
+            return await asyncio.open_unix_connection(url.path)
+        elif url.scheme in {"tcp", "http", "https"}:
+            port = url.port or (2376 if self._ssl else 2375)
+            return await asyncio.open_connection(url.hostname, port, ssl=self._ssl)
+        raise ValueError(f"Unsupported docker host {self.base_url}")
+
+    async def _send(self, method, path, params=None, body=None):
+        """Send a request, return (status, headers, reader, writer)
+
+        Uses an idle connection if there is one, unless it has been closed.
+        If the daemon closes an idle connection as the request is sent on it,
+        before any response arrives, the request is sent once more
+        on a fresh connection.
+        Other errors are raised, so requests aren't repeated
+        (e.g. creating two containers).
+        """
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        data = b"" if body is None else json.dumps(body).encode("utf8")
+        request = (
+            f"{method} {path} HTTP/1.1\r\n"
+            "Host: docker\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "\r\n"
+        ).encode("latin1") + data
+        status_line = None
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                # closed by the server while idle
+                writer.close()
+                continue
+            try:
+                status_line = await self._send_request(reader, writer, request)
+            except ConnectionError:
+                log.debug(f"Idle connection closed, retrying {method} {path}")
+            break
+        if status_line is None:
+            reader, writer = await self._connect()
+            status_line = await self._send_request(reader, writer, request)
+        status = int(status_line.split()[1])
+        headers = await _read_headers(reader)
+        return status, headers, reader, writer
+
+    async def _send_request(self, reader, writer, request):
+        """Send a request on a connection, return the response's status line
+
+        The connection is closed on errors.
+        """
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Connection closed")
+        except BaseException:
+            writer.close()
+            raise
+        return status_line
+
+    def _release(self, reader, writer, headers):
+        """Keep a connection for reuse after reading a complete response"""
+        if (
+            headers.get("connection", "").lower() != "close"
+            and len(self._idle) < self.max_idle
+            and ("content-length" in headers or "transfer-encoding" in headers)
+        ):
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def request(self, method, path, params=None, body=None):
+        """Make an API request, return the parsed JSON response (or None)
+
+        Raises DockerAPIError for error responses.
+        """
+        status, headers, reader, writer = await self._send(method, path, params, body)
+        try:
+            data = b"".join(
+                [chunk async for chunk in _read_body(reader, status, headers)]
+            )
+        except BaseException:
+            writer.close()
+            raise
+        self._release(reader, writer, headers)
+        content = json.loads(data) if data else None
+        if status >= 400:
+            message = content.get("message") if isinstance(content, dict) else data
+            raise DockerAPIError(status, message)
+        return content
+
+    async def stream(self, method, path, params=None):
+        """Make an API request, yield chunks of the response body as they arrive
+
+        The connection is closed afterwards.
+        """
+        status, headers, reader, writer = await self._send(method, path, params)
+        try:
+            if status >= 400:
+                data = b"".join(
+                    [chunk async for chunk in _read_body(reader, status, headers)]
+                )
+                raise DockerAPIError(status, data.decode("utf8", "replace"))
+            async for chunk in _read_body(reader, status, headers):
+                yield chunk
+        finally:
+            await _close(writer)
+
+    async def close(self):
+        """Close idle connections"""
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(_close(writer) for reader, writer in idle))
+
+    async def create_container(self, config):
+        """Create a container, return its id"""
+        response = await self.request("POST", "/containers/create", body=config)
+        return response["Id"]
+
+    async def start(self, container_id):
+        await self.request("POST", f"/containers/{quote(container_id)}/start")
+
+    async def wait(self, container_id):
+        """Wait for a container to exit, return its status"""
+        return await self.request("POST", f"/containers/{quote(container_id)}/wait")
+
+    async def kill(self, container_id):
+        """Kill a container, if it's still running"""
+        try:
+            await self.request("POST", f"/containers/{quote(container_id)}/kill")
+        except DockerAPIError as e:
+            # already stopped or removed
+            if e.status not in {404, 409}:
+                raise
+
+    async def remove(self, container_id):
+        """Force-remove a container"""
+        try:
+            await self.request(
+                "DELETE", f"/containers/{quote(container_id)}", {"force": "1"}
+            )
+        except DockerAPIError as e:
+            if e.status != 404:
+                raise
+
+    async def logs(self, container_id):
+        """Yield a container's output (stdout and stderr) until it exits"""
+        chunks = self.stream(
+            "GET",
+            f"/containers/{quote(container_id)}/logs",
+            {"follow": "1", "stdout": "1", "stderr": "1"},
+        )
+        try:
+            async for data in demux(chunks):
+                yield data
+        finally:
+            # close the connection now, even if not read to the end
+            await chunks.aclose()
+
+    async def run_container(self, config, log_w, timeout=None):
+        """Run a container to completion, writing its output to log_w
+
+        config is the body of the container create API request.
+        Returns the container's exit status, as from the wait API.
+        If it runs for longer than timeout seconds, it is killed,
+        and the status has a StatusCode of None and an Error message.
+        The container is always removed, even if cancelled.
+
+        Output is written to log_w in the loop's executor, one write at a time,
+        and the last write has finished when this returns.
+        """
+        loop = asyncio.get_event_loop()
+        last_write = None
+
+        async def write(data):
+            nonlocal last_write
+            last_write = loop.run_in_executor(None, log_w.write, data)
+            # if cancelled, the write still finishes before the next one starts
+            await asyncio.shield(last_write)
+
+        async def finish_writing():
+            if last_write is not None:
+                await asyncio.wait([last_write])
+
+        container_id = await self.create_container(config)
+        try:
+            await self.start(container_id)
+
+            async def follow():
+                logs = self.logs(container_id)
+                try:
+                    async for data in logs:
+                        await write(data)
+                finally:
+                    await logs.aclose()
+                return await self.wait(container_id)
+
+            try:
+                return await asyncio.wait_for(follow(), timeout)
+            except asyncio.TimeoutError:
+                await self.kill(container_id)
+                message = f"Container timed out after {timeout}s"
+                await finish_writing()
+                await write(f"\n{message}\n")
+                return {"StatusCode": None, "Error": {"Message": message}}
+        finally:
+            # finish removing the container, even if cancelled
+            await asyncio.shield(self.remove(container_id))
+            await finish_writing()
+
+
+class Engine:
+    """An event loop in a background thread, with a shared AsyncDockerClient
+
+    The loop's default executor (for writing logs) has LOG_THREADS threads.
+    Safe to use from any number of threads.
+    """
+
+    def __init__(self, client=None):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(LOG_THREADS, thread_name_prefix="docker-logs")
+        )
+        self._thread = Thread(
+            target=self.loop.run_forever, name="docker-engine", daemon=True
+        )
+        self._thread.start()
+        self.client = client or AsyncDockerClient()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop, return a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and wait for its result
+
+        If waiting is interrupted (e.g. KeyboardInterrupt),
+        the coroutine is cancelled.
+        """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def run_container(self, config, log_w, timeout=None):
+        """Blocking wrapper for AsyncDockerClient.run_container"""
+        return self.run(self.client.run_container(config, log_w, timeout=timeout))
+
+    def close(self):
+        """Close connections and stop the loop"""
+        self.run(self.client.close())
+        self.run(self.loop.shutdown_asyncgens())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
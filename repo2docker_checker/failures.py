@@ -0,0 +1,153 @@
+"""Classifying build and test failures
+
+Failures are classified by known patterns in the tail of their log,
+so that transient failures (network, docker daemon) can be retried,
+and real failures (missing packages, out of memory, errors in notebooks)
+can be told apart in results without reading every log.
+
+The last lines of a log, where the error that ended the build or test is,
+are searched first. Network errors earlier in the log are only a fallback,
+since they are often warnings that were recovered from.
+"""
+import os
+import re
+
+from .logstream import BLOCK_SIZE
+from .logstream import open_log
+
+# failure reason for failures that don't match any pattern
+UNKNOWN = "unknown"
+
+# only the end of a log is searched
+TAIL_BYTES = 256 * 1024
+
+# the lines at the end of a log searched before the rest of the tail
+ERROR_LINES = 20
+
+# (reason, transient, pattern), checked in order: the first match wins.
+# Tests killed for too much output (see LogWriter.limit) come first,
+# since their output could match anything.
+# Network errors come next, because in the last lines they cause other errors
+# (e.g. pip's "No matching distribution" when it can't reach PyPI).
+PATTERNS = [
+    (
+        "output-limit",
+        False,
+        r"Output limit of \d+ bytes exceeded",
+    ),
+    (
+        "dns",
+        True,
+        r"Temporary failure in name resolution|Could not resolve host"
+        r"|Name or service not known|getaddrinfo failed",
+    ),
+    (
+        "network-timeout",
+        True,
+        r"Read timed out|ReadTimeoutError|ConnectTimeoutError|Connection timed out"
+        r"|TLS handshake timeout|i/o timeout",
+    ),
+    (
+        "connection",
+        True,
+        r"Connection reset by peer|Connection aborted|Connection refused"
+        r"|RemoteDisconnected|Connection broken|CondaHTTPError",
+    ),
+    # errors from the daemon that aren't about the image or container itself,
+    # not any 500 Server Error (e.g. an OCI runtime error for a missing command)
+    (
+        "docker-daemon",
+        True,
+        r"Cannot connect to the Docker daemon|Is the docker daemon running"
+        r"|toomanyrequests|error pulling image"
+        r"|received unexpected HTTP status: 5\d\d|context deadline exceeded",
+    ),
+    (
+        "oom",
+        False,
+        r"'StatusCode': 137\b|OOMKilled|MemoryError|^Killed\s*$",
+    ),
+    (
+        "timeout",
+        False,
+        r"Container timed out after|CellTimeoutError|TimeoutError",
+    ),
+    (
+        "no-distribution",
+        False,
+        r"No matching distribution found|Could not find a version that satisfies"
+        r"|PackagesNotFoundError|ResolvePackageNotFound|UnsatisfiableError",
+    ),
+    (
+        "kernel-died",
+        False,
+        r"DeadKernelError|Kernel died",
+    ),
+]
+
+_patterns = [
+    (reason, re.compile(pattern.encode("utf8"), re.MULTILINE))
+    for reason, transient, pattern in PATTERNS
+]
+
+# reasons worth retrying
+TRANSIENT = {reason for reason, transient, pattern in PATTERNS if transient}
+
+# pip's warnings about requests it is going to retry.
+# Only the last retry (total=0) may have failed for good.
+_retried = re.compile(rb"^.*Retrying \(Retry\(total=[1-9].*\n?", re.MULTILINE)
+
+
+def is_transient(reason):
+    """Whether a failure reason is worth retrying"""
+    return reason in TRANSIENT
+
+
+def read_tail(path, tail_bytes=None):
+    """Read the last tail_bytes (default: TAIL_BYTES) of a (possibly compressed) log file"""
+    if tail_bytes is None:
+        tail_bytes = TAIL_BYTES
+    if not path.endswith(".gz"):
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - tail_bytes))
+            return f.read()
+    # compressed logs can only be read from the start
+    tail = b""
+    with open_log(path) as f:
+        while True:
+            chunk = f.read(BLOCK_SIZE)
+            if not chunk:
+                return tail
+            tail = (tail + chunk)[-tail_bytes:]
+
+
+def classify(text):
+    """Classify a failure from its log output (bytes)
+
+    Returns the reason of the first pattern matching the last ERROR_LINES lines,
+    or else the first non-transient pattern matching anywhere, then the first
+    transient one, or UNKNOWN.
+    Warnings about requests pip retried are ignored.
+    """
+    text = _retried.sub(b"", text)
+    last_lines = b"\n".join(text.splitlines()[-ERROR_LINES:])
+    for reason, pattern in _patterns:
+        if pattern.search(last_lines):
+            return reason
+    fallback = UNKNOWN
+    for reason, pattern in _patterns:
+        if pattern.search(text):
+            if not is_transient(reason):
+                return reason
+            if fallback == UNKNOWN:
+                fallback = reason
+    return fallback
+
+
+def classify_log(path):
+    """Classify a failure from the tail of its log file"""
+    try:
+        text = read_tail(path)
+    except OSError:
+        return UNKNOWN
+    return classify(text)
@@ -0,0 +1,269 @@
+"""Persistent cache of git mirrors
+
+Each repo is cloned once into a bare mirror in the cache directory,
+named by a hash of its slug.
+Later checks of the same repo only fetch what's new,
+and checkouts are local clones of the mirror,
+with objects hardlinked instead of downloaded.
+
+Checkouts are full clones (not worktrees) because they are used
+as the docker build context, so their .git must be self-contained.
+They are made in the cache's checkouts/ directory,
+on the same filesystem as the mirrors, so objects can be hardlinked.
+
+Mirrors are evicted least-recently-used first
+when the cache grows past its size limit.
+The size of each mirror is recorded in {mirror}.size whenever it changes,
+so the cache's size is known without walking every mirror.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from subprocess import check_output
+from subprocess import STDOUT
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    """The default location of the git cache"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "repo2docker-checker", "git")
+
+
+def dir_size(path):
+    """Total size in bytes of files in a directory"""
+    total = 0
+    for parent, dirs, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.lstat(os.path.join(parent, fname)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class GitCache:
+    """A directory of bare git mirrors, keyed by repo slug
+
+    max_bytes: evict least-recently-used mirrors
+        when the cache is bigger than this (0 for no limit)
+    echo: callable to receive output from git commands
+    """
+
+    def __init__(self, path=None, max_bytes=0, echo=None):
+        self.path = path or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.echo = echo
+        # checkout path: temporary directory containing it
+        self._checkouts = {}
+        self._stale_checkouts_removed = False
+
+    def _git(self, *args, cwd=None):
+        """Run a git command, return its output"""
+        out = check_output(("git",) + args, cwd=cwd, stderr=STDOUT)
+        out = out.decode("utf8", "replace")
+        if self.echo and out:
+            self.echo(out)
+        return out
+
+    def mirror_path(self, slug):
+        """The path to the mirror of the repo with a given slug"""
+        key = hashlib.sha256(slug.encode("utf8")).hexdigest()[:32]
+        return os.path.join(self.path, f"{key}.git")
+
+    @contextmanager
+    def _lock(self, mirror, blocking=True):
+        """Lock a mirror against concurrent use, across threads and processes
+
+        Yields False if blocking is False and the mirror is already locked.
+        Locking a mirror marks it as used for LRU eviction.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(f"{mirror}.lock", "a") as f:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                if blocking:
+                    os.utime(f.name)
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _record_size(self, mirror):
+        """Record the size of a mirror, after it has changed"""
+        size = dir_size(mirror)
+        tmp_path = f"{mirror}.size.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(str(size))
+        os.replace(tmp_path, f"{mirror}.size")
+        return size
+
+    def mirror_size(self, mirror):
+        """The recorded size of a mirror, measuring it if there is no record"""
+        try:
+            with open(f"{mirror}.size") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return self._record_size(mirror)
+
+    def _resolve(self, mirror, ref):
+        """Resolve a ref to a full commit sha in a mirror, or None"""
+        try:
+            out = check_output(
+                ["git", "rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}"],
+                cwd=mirror,
+                stderr=STDOUT,
+            )
+        except Exception:
+            return None
+        return out.decode("utf8").strip()
+
+    def _update(self, repo, slug, ref):
+        """Create or update the mirror for a repo
+
+        Returns the mirror path and the full sha of ref.
+        Must be called with the mirror locked.
+        """
+        mirror = self.mirror_path(slug)
+        if not os.path.exists(mirror):
+            log.info(f"Creating git mirror of {repo} in {mirror}")
+            # clone to a temporary location, so we never see a partial mirror
+            tmp_mirror = tempfile.mkdtemp(dir=self.path, prefix=".tmp-")
+            try:
+                self._git("clone", "--mirror", repo, tmp_mirror)
+                os.rename(tmp_mirror, mirror)
+            finally:
+                shutil.rmtree(tmp_mirror, ignore_errors=True)
+            self._record_size(mirror)
+        else:
+            sha = self._resolve(mirror, ref)
+            if sha and re.match(r"^[0-9a-f]{7,40}$", ref) and sha.startswith(ref):
+                # ref is a commit we already have, no need to fetch
+                log.info(f"Found {repo}@{ref} in git cache")
+                return mirror, sha
+            log.info(f"Updating git mirror of {repo} in {mirror}")
+            self._git("fetch", "--prune", "origin", cwd=mirror)
+            self._record_size(mirror)
+        sha = self._resolve(mirror, ref)
+        if sha is None:
+            raise ValueError(f"No such ref {ref} in {repo}")
+        return mirror, sha
+
+    def checkout(self, repo, slug, ref, prefix="r2d-test-"):
+        """Check out a repo at a ref, using the cache
+
+        Returns (checkout_path, sha), where sha is the full commit sha.
+        Call remove_checkout when done with the checkout.
+        """
+        mirror = self.mirror_path(slug)
+        self._remove_stale_checkouts(prefix)
+        with self._lock(mirror):
+            mirror, sha = self._update(repo, slug, ref)
+            td = tempfile.mkdtemp(
+                prefix=f"{prefix}{os.getpid()}-", dir=self.checkouts_path
+            )
+            checkout_path = os.path.join(td, slug)
+            self._checkouts[checkout_path] = td
+            log.info(f"Checking out {repo}@{ref} to {checkout_path}")
+            try:
+                # --local hardlinks objects from the mirror instead of copying
+                self._git("clone", "--local", "--no-checkout", mirror, checkout_path)
+                # checkout should look like it came from the original repo
+                self._git("remote", "set-url", "origin", repo, cwd=checkout_path)
+                self._git("checkout", "--detach", sha, cwd=checkout_path)
+            except Exception:
+                self.remove_checkout(checkout_path)
+                raise
+        if os.path.exists(os.path.join(checkout_path, ".gitmodules")):
+            self._git("submodule", "update", "--init", "--recursive", cwd=checkout_path)
+        self.evict()
+        return checkout_path, sha
+
+    @property
+    def checkouts_path(self):
+        """The directory checkouts are made in"""
+        path = os.path.join(self.path, "checkouts")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _remove_stale_checkouts(self, prefix):
+        """Remove checkouts left behind by processes that have exited
+
+        Checked once, before the first checkout.
+        """
+        if self._stale_checkouts_removed:
+            return
+        self._stale_checkouts_removed = True
+        for name in os.listdir(self.checkouts_path):
+            if not name.startswith(prefix):
+                continue
+            pid = name[len(prefix) :].split("-", 1)[0]
+            if not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                log.info(f"Removing stale checkout {name}")
+                shutil.rmtree(
+                    os.path.join(self.checkouts_path, name), ignore_errors=True
+                )
+            except PermissionError:
+                # another user's process
+                pass
+
+    def remove_checkout(self, checkout_path):
+        """Remove a checkout created by checkout()"""
+        td = self._checkouts.pop(checkout_path, checkout_path)
+        log.info(f"Removing checkout {checkout_path}")
+        shutil.rmtree(td, ignore_errors=True)
+
+    def evict(self):
+        """Remove least-recently-used mirrors until the cache fits in max_bytes
+
+        Mirrors that are currently locked are never removed.
+        """
+        if not self.max_bytes or not os.path.exists(self.path):
+            return
+        mirrors = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(".git"):
+                continue
+            mirror = os.path.join(self.path, name)
+            size = self.mirror_size(mirror)
+            try:
+                last_used = os.stat(f"{mirror}.lock").st_mtime
+            except FileNotFoundError:
+                last_used = 0
+            mirrors.append((last_used, size, mirror))
+            total += size
+
+        for last_used, size, mirror in sorted(mirrors):
+            if total <= self.max_bytes:
+                break
+            with self._lock(mirror, blocking=False) as locked:
+                if not locked:
+                    continue
+                age = time.time() - last_used
+                log.info(
+                    f"Evicting git mirror {mirror} ({size} bytes, last used {age:.0f}s ago)"
+                )
+                shutil.rmtree(mirror)
+                try:
+                    os.remove(f"{mirror}.size")
+                except FileNotFoundError:
+                    pass
+            total -= size
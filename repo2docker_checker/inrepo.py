@@ -1,20 +1,89 @@
 #!/usr/bin/env python3
 """Commands to run within a repo2docker image
 
-Runs a single test
+Runs a single test, or a batch of tests
 """
 import argparse
+import gzip
 import importlib
+import json
 import logging
 import os
+import resource
+import sys
 import tempfile
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 
 import tornado.log
 
 log = logging.getLogger(__name__)
 
+# timeout (seconds) for each notebook cell
+cell_timeout = 600
+# if set, stop notebooks that take longer than this in total
+notebook_timeout = 0
 
-def import_test(modname):
+# save executed notebooks gzipped, as {nb_path}.gz
+compress_notebooks = False
+# drop images and other non-text outputs from executed notebooks
+strip_outputs = False
+# where to write cell profiles, relative to the output dir
+# (set by --profile-dir, e.g. profiles/{run_id})
+profile_dir = "profiles"
+
+# file to write timing spans to, in Chrome's trace event format
+# (set by --trace, see repo2docker_checker.trace)
+trace_file = None
+
+
+def max_rss():
+    """Peak resident memory in bytes of this process and its exited children
+
+    Children include kernels, once they have been shut down.
+    """
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+@contextmanager
+def span(name, **args):
+    """Record a timing span in trace_file
+
+    Yields the span's args, which the block can add to.
+    max_rss_increase is how much max_rss() rose during the span.
+    """
+    start = time.time()
+    tic = time.perf_counter()
+    peak = max_rss()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - tic
+        args["duration"] = round(duration, 3)
+        args["max_rss_increase"] = max_rss() - peak
+        if trace_file:
+            event = {
+                "name": name,
+                "cat": "container",
+                "ph": "X",
+                "ts": int(start * 1e6),
+                "dur": int(duration * 1e6),
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": args,
+            }
+            with open(trace_file, "a") as f:
+                f.write(json.dumps(event) + "\n")
+
+
+def import_test(modname, output_dir=None):
     """Run an import test
 
     Just check if it imports!
@@ -23,25 +92,23 @@ def import_test(modname):
     importlib.import_module(modname)
 
 
-def run_notebook(nb_path, output_dir):
-    """Run a notebook tests
+@lru_cache()
+def kernel_specs():
+    """All installed kernel specs, found once"""
+    from jupyter_client.kernelspec import KernelSpecManager
 
-    executes the notebook and stores the output in a file
-    """
+    return KernelSpecManager().get_all_specs()
 
-    import nbformat
-    from jupyter_client.kernelspec import KernelSpecManager
-    from nbconvert.preprocessors.execute import executenb
 
-    log.info(f"Testing notebook {nb_path}")
-    with open(nb_path) as f:
-        nb = nbformat.read(f, as_version=4)
+@lru_cache()
+def resolve_kernel_name(kernel_name, kernel_language):
+    """Resolve a notebook's kernel name to an installed kernel
 
-    kernel_specs = KernelSpecManager().get_all_specs()
-    kernel_info = nb.metadata.get("kernelspec") or {}
-    kernel_name = kernel_info.get("name", "")
-    kernel_language = kernel_info.get("language") or ""
-    if kernel_name in kernel_specs:
+    Falls back on a kernel for the same language,
+    if there's no kernel with the given name.
+    """
+    specs = kernel_specs()
+    if kernel_name in specs:
         log.info(f"Found kernel {kernel_name}")
     elif kernel_language:
         log.warning(
@@ -51,7 +118,7 @@ def run_notebook(nb_path, output_dir):
         # no exact name match, re-implement js notebook fallback,
         # using kernel language instead
         # nbconvert does not implement this, but it should
-        for kernel_spec_name, kernel_info in kernel_specs.items():
+        for kernel_spec_name, kernel_info in specs.items():
             if (
                 kernel_info.get("spec", {}).get("language", "").lower()
                 == kernel_language
@@ -67,25 +134,318 @@ def run_notebook(nb_path, output_dir):
             )
             summary_specs = [
                 f"name={name}, language={info['spec'].get('language')}"
-                for name, info in kernel_specs.items()
+                for name, info in specs.items()
             ]
             log.warning(f"Found kernel specs: {'; '.join(summary_specs)}")
+    return kernel_name
+
+
+def _shutdown_kernel(km):
+    """Shut down a kernel, if it's still running"""
+    try:
+        if km.has_kernel:
+            km.shutdown_kernel(now=True)
+    except Exception:
+        log.exception("Error shutting down kernel")
 
-    exported = executenb(
-        nb, cwd=os.path.dirname(nb_path), kernel_name=kernel_name, timeout=600
+
+class KernelPool:
+    """Kernels started ahead of the notebooks that will use them
+
+    Starting a kernel only launches its process,
+    so a kernel started before running a notebook
+    boots while that notebook runs, ready for the next one.
+    Each kernel is used for a single notebook.
+
+    Kernels are keyed by (kernel_name, cwd), since a kernel's cwd
+    is the notebook's directory. At most `size` kernels are kept waiting:
+    the next notebook's kernel is started before the current one is taken.
+    """
+
+    def __init__(self, size=2):
+        self.size = size
+        self._kernels = []
+
+    def start(self, kernel_name, cwd):
+        """Start a kernel for a later get(kernel_name, cwd)"""
+        if len(self._kernels) >= self.size:
+            return
+        from jupyter_client.manager import KernelManager
+
+        log.info(f"Starting kernel {kernel_name} in {cwd} for the next notebook")
+        km = KernelManager(kernel_name=kernel_name)
+        try:
+            km.start_kernel(cwd=cwd or None)
+        except Exception:
+            log.exception(f"Failed to start kernel {kernel_name}")
+            return
+        self._kernels.append(((kernel_name, cwd), km))
+
+    def start_for(self, nb_path):
+        """Start a kernel for the notebook at nb_path"""
+        import nbformat
+
+        try:
+            with open(nb_path) as f:
+                nb = nbformat.read(f, as_version=4)
+        except Exception:
+            # it will fail when it's run
+            return
+        kernel_info = nb.metadata.get("kernelspec") or {}
+        kernel_name = resolve_kernel_name(
+            kernel_info.get("name", ""), kernel_info.get("language") or ""
+        )
+        self.start(kernel_name, os.path.dirname(nb_path))
+
+    def get(self, kernel_name, cwd):
+        """Take a started kernel's manager out of the pool, or None
+
+        The kernel started first is taken first.
+        """
+        for i, (key, km) in enumerate(self._kernels):
+            if key == (kernel_name, cwd):
+                del self._kernels[i]
+                return km
+        return None
+
+    def shutdown(self):
+        """Shut down kernels that weren't used"""
+        for key, km in self._kernels:
+            _shutdown_kernel(km)
+        self._kernels = []
+
+
+kernel_pool = KernelPool()
+
+
+def _parse_time(timestamp):
+    """Parse an ISO8601 timestamp from cell execution metadata to seconds"""
+    from datetime import datetime
+
+    try:
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def _profiling_preprocessor(**kwargs):
+    """An ExecutePreprocessor that records how long each cell takes
+
+    Returns the preprocessor, with a `cells` list of one dict per cell run:
+    index, start, end (seconds since the epoch), duration,
+    busy (seconds the kernel was busy, if the kernel reports it),
+    output_bytes, and status (ok, error or timeout).
+
+    If notebook_timeout is set, cell timeouts are shortened
+    so the whole notebook stops after notebook_timeout seconds.
+    """
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    class ProfilingExecutePreprocessor(ExecutePreprocessor):
+        def preprocess(self, nb, resources=None, km=None):
+            self.cells = []
+            self.deadline = time.time() + notebook_timeout if notebook_timeout else 0
+            self.cell_timeout = self.timeout
+            return super().preprocess(nb, resources, km=km)
+
+        def preprocess_cell(self, cell, resources, index, **kwargs):
+            if cell.cell_type != "code":
+                return cell, resources
+            if self.deadline:
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"Notebook timeout ({notebook_timeout}s) before cell {index}"
+                    )
+                self.timeout = max(
+                    1, int(min(self.cell_timeout or remaining, remaining))
+                )
+            profile = {"index": index, "start": time.time()}
+            tic = time.perf_counter()
+            status = "error"
+            try:
+                result = super().preprocess_cell(cell, resources, index, **kwargs)
+                status = "ok"
+                return result
+            except TimeoutError:
+                status = "timeout"
+                raise
+            finally:
+                profile["end"] = time.time()
+                profile["duration"] = round(time.perf_counter() - tic, 3)
+                # kernel status timestamps, recorded by nbclient
+                execution = cell.metadata.get("execution", {})
+                busy = _parse_time(execution.get("iopub.status.busy"))
+                idle = _parse_time(execution.get("iopub.status.idle"))
+                profile["busy"] = round(idle - busy, 3) if busy and idle else None
+                profile["output_bytes"] = len(json.dumps(cell.get("outputs", [])))
+                profile["status"] = status
+                self.cells.append(profile)
+
+    return ProfilingExecutePreprocessor(**kwargs)
+
+
+def _strip_outputs(nb):
+    """Remove non-text outputs (images, etc.) from a notebook, in place
+
+    Keeps text/plain (and other text/*) representations,
+    so the notebook still shows what each cell produced.
+    """
+    for cell in nb.cells:
+        cell.pop("attachments", None)
+        for output in cell.get("outputs", []):
+            data = output.get("data")
+            if not data:
+                continue
+            stripped = [mime for mime in data if not mime.startswith("text/")]
+            for mime in stripped:
+                del data[mime]
+            if stripped and "text/plain" not in data:
+                data["text/plain"] = f"<{', '.join(stripped)} output stripped>"
+
+
+def run_notebook(nb_path, output_dir):
+    """Run a notebook tests
+
+    executes the notebook and stores the output in a file
+    (notebooks/{nb_path}, or notebooks/{nb_path}.gz if compress_notebooks),
+    and the time taken by each cell in {profile_dir}/{nb_path}.json
+    """
+
+    import nbformat
+
+    log.info(f"Testing notebook {nb_path}")
+    with open(nb_path) as f:
+        nb = nbformat.read(f, as_version=4)
+
+    kernel_info = nb.metadata.get("kernelspec") or {}
+    kernel_name = resolve_kernel_name(
+        kernel_info.get("name", ""), kernel_info.get("language") or ""
     )
+    cwd = os.path.dirname(nb_path)
+    # a kernel started while the previous notebook ran, if any
+    km = kernel_pool.get(kernel_name, cwd)
+
     rel_path = os.path.relpath(nb_path, os.getcwd())
+    ep = _profiling_preprocessor(
+        kernel_name=kernel_name,
+        timeout=cell_timeout,
+        # kernels are never reused, no need to wait for them to shut down
+        shutdown_kernel="immediate",
+    )
+    try:
+        with span(
+            "run_notebook",
+            notebook=nb_path,
+            kernel_name=kernel_name,
+            prestarted=km is not None,
+        ) as args:
+            exported, resources = ep.preprocess(nb, {"metadata": {"path": cwd}}, km=km)
+            args["cells"] = len(exported.cells)
+    finally:
+        if km is not None:
+            # a fresh kernel for each notebook
+            _shutdown_kernel(km)
+        profile_path = os.path.join(output_dir, profile_dir, rel_path + ".json")
+        os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+        with open(profile_path, "w") as f:
+            json.dump(
+                {"notebook": rel_path, "kernel_name": kernel_name, "cells": ep.cells},
+                f,
+                indent=1,
+            )
+    if strip_outputs:
+        _strip_outputs(exported)
     dest_path = os.path.join(output_dir, "notebooks", rel_path)
+    if compress_notebooks:
+        dest_path += ".gz"
     log.info(f"Saving exported notebook to {dest_path}")
     try:
         os.makedirs(os.path.dirname(dest_path))
     except FileExistsError:
         pass
 
-    with open(dest_path, "w") as f:
+    if compress_notebooks:
+        f = gzip.open(dest_path, "wt", encoding="utf8", compresslevel=6)
+    else:
+        f = open(dest_path, "w", encoding="utf8")
+    with f:
         nbformat.write(exported, f)
 
 
+def run_batch(manifest_path, output_dir):
+    """Run a batch of tests in one process
+
+    The manifest is a JSON list of [kind, argument] pairs.
+
+    Each test's log is written to {i}.log next to the manifest,
+    and one JSON record per test is appended to results.jsonl
+    as soon as the test finishes,
+    so results of completed tests survive a crash of the container.
+
+    Returns True if all tests succeeded.
+    """
+    batch_dir = os.path.dirname(manifest_path)
+    with open(manifest_path) as f:
+        tests = json.load(f)
+    try:
+        return _run_batch(tests, batch_dir, output_dir)
+    finally:
+        kernel_pool.shutdown()
+
+
+def _run_batch(tests, batch_dir, output_dir):
+    """The part of run_batch after reading the manifest"""
+    results_path = os.path.join(batch_dir, "results.jsonl")
+    root_logger = logging.getLogger()
+    all_ok = True
+    kernels_started = set()
+    for i, (kind, argument) in enumerate(tests):
+        # start this notebook's kernel, if it wasn't started already,
+        # and the next notebook's kernel, to boot while this test runs.
+        # Kernels are taken in the order they were started,
+        # so this notebook gets the older kernel.
+        for j in (i, i + 1):
+            if (
+                j < len(tests)
+                and tests[j][0] == "notebook"
+                and j not in kernels_started
+            ):
+                kernels_started.add(j)
+                kernel_pool.start_for(tests[j][1])
+        log.info(f"Running test {i + 1}/{len(tests)}: {kind} {argument}")
+        log_name = f"{i}.log"
+        handler = logging.FileHandler(os.path.join(batch_dir, log_name))
+        handler.setFormatter(
+            logging.Formatter("[%(levelname)1.1s %(asctime)s %(name)s] %(message)s")
+        )
+        root_logger.addHandler(handler)
+        try:
+            with span("test", kind=kind, test_id=argument) as args:
+                test_functions[kind](argument, output_dir)
+        except Exception:
+            log.exception(f"Test failed: {kind} {argument}")
+            success = False
+        else:
+            log.info(f"Test passed: {kind} {argument}")
+            success = True
+        finally:
+            root_logger.removeHandler(handler)
+            handler.close()
+        all_ok = all_ok and success
+        record = {
+            "index": i,
+            "kind": kind,
+            "test_id": argument,
+            "success": success,
+            "log": log_name,
+            "duration": args["duration"],
+        }
+        with open(results_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    return all_ok
+
+
 test_functions = {
     "import": import_test,
     "notebook": run_notebook,
@@ -93,6 +453,9 @@ test_functions = {
 
 
 def main():
+    global cell_timeout, notebook_timeout, trace_file
+    global compress_notebooks, strip_outputs, profile_dir
+
     tornado.log.enable_pretty_logging()
     logging.getLogger().setLevel(logging.INFO)
 
@@ -103,11 +466,58 @@ def main():
         default=tempfile.gettempdir(),
         help="Directory to store test results",
     )
-    parser.add_argument("test_type", choices=sorted(test_functions))
-    parser.add_argument("test", type=str)
+    parser.add_argument(
+        "--cell-timeout",
+        type=int,
+        default=cell_timeout,
+        help="Timeout (seconds) for each notebook cell",
+    )
+    parser.add_argument(
+        "--notebook-timeout",
+        type=int,
+        default=notebook_timeout,
+        help="Timeout (seconds) for a whole notebook (0 for no limit)",
+    )
+    parser.add_argument(
+        "--compress-notebooks",
+        action="store_true",
+        help="Save executed notebooks gzipped",
+    )
+    parser.add_argument(
+        "--strip-outputs",
+        action="store_true",
+        help="Drop non-text outputs (e.g. images) from executed notebooks",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default="",
+        help="File to write timing spans to",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default=profile_dir,
+        help="Directory in --output-dir to write cell profiles to",
+    )
+    parser.add_argument("test_type", choices=sorted(test_functions) + ["batch"])
+    parser.add_argument(
+        "test", type=str, help="The test to run (path to manifest for batch)"
+    )
     opts = parser.parse_args()
+    cell_timeout = opts.cell_timeout
+    notebook_timeout = opts.notebook_timeout
+    trace_file = opts.trace
+    compress_notebooks = opts.compress_notebooks
+    strip_outputs = opts.strip_outputs
+    profile_dir = opts.profile_dir
+    if opts.test_type == "batch":
+        if not run_batch(opts.test, opts.output_dir):
+            sys.exit(1)
+        return
     test_f = test_functions[opts.test_type]
-    test_f(opts.test, opts.output_dir)
+    with span("test", kind=opts.test_type, test_id=opts.test):
+        test_f(opts.test, opts.output_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,283 @@
+"""Streaming log capture
+
+Fans out raw output from builds and test containers
+to a log file and (optionally) stderr.
+
+Output is handled as bytes in large blocks,
+and never decoded on the way to the log file.
+
+Log files can be gzip-compressed (if their name ends with .gz)
+and capped in size, keeping the beginning and end of the output.
+Use open_log to read them either way.
+"""
+import gzip
+import os
+import sys
+import time
+from contextlib import contextmanager
+from threading import Lock
+from threading import Thread
+
+# read output in blocks of this many bytes
+BLOCK_SIZE = 64 * 1024
+
+# compression level for .gz logs (lower is faster, logs compress well anyway)
+GZIP_LEVEL = 6
+
+# serialize writes to stderr from concurrent writers
+_stderr_lock = Lock()
+
+
+def _write_stderr(data):
+    """Write bytes to stderr"""
+    with _stderr_lock:
+        sys.stderr.flush()
+        buffer = getattr(sys.stderr, "buffer", None)
+        if buffer is None:
+            sys.stderr.write(data.decode("utf8", "replace"))
+        else:
+            buffer.write(data)
+            buffer.flush()
+
+
+def open_log(fname, mode="rb"):
+    """Open a log file, compressed with gzip if its name ends with .gz"""
+    if fname.endswith(".gz"):
+        if "b" not in mode:
+            return gzip.open(fname, mode + "t", encoding="utf8", errors="replace")
+        return gzip.open(fname, mode, compresslevel=GZIP_LEVEL)
+    if "b" not in mode:
+        return open(fname, mode, encoding="utf8", errors="replace")
+    return open(fname, mode)
+
+
+class OutputLimitExceeded(Exception):
+    """Raised by LogWriter.write when output exceeds its limit"""
+
+
+class LogWriter:
+    """Write output to a log file, echoing complete lines to stderr
+
+    Output is written to the log file as-is, in the blocks it arrives in,
+    compressed if fname ends with .gz.
+    Echo to stderr is line-buffered,
+    so output from concurrent builds and tests isn't interleaved mid-line,
+    and multi-byte characters aren't split across writes.
+    If echo_rate is set, echo is limited to that many bytes per second
+    (with bursts of up to one second's worth),
+    and lines over the rate are skipped, with a note of how much.
+
+    If max_bytes is set, only the first and last max_bytes / 2
+    of the output are kept in the log file,
+    with a note of how much was truncated in between.
+    Everything is still echoed (unless over echo_rate).
+    bytes_written counts all output, including truncated output.
+
+    The last keep_tail bytes of output are kept in memory, as tail,
+    e.g. to classify failures without reading the log file back.
+
+    If limit is set, write raises OutputLimitExceeded when output
+    goes over limit bytes, after writing output up to the limit.
+    The limit is then lifted, so a note about it can be written.
+    """
+
+    def __init__(
+        self, fname, echo=True, max_bytes=0, keep_tail=0, echo_rate=0, limit=0
+    ):
+        self.fname = fname
+        self.echo = echo
+        self.max_bytes = max_bytes
+        self.keep_tail = keep_tail
+        self.echo_rate = echo_rate
+        self.limit = limit
+        self.bytes_written = 0
+        self._f = open_log(fname, "wb")
+        self._partial = b""
+        self._head_bytes = max_bytes - max_bytes // 2
+        self._tail_bytes = max_bytes // 2
+        # the end of the output, for both the log file's tail and self.tail
+        self._keep = max(self._tail_bytes, keep_tail)
+        self._tail = bytearray()
+        self._echo_allowance = echo_rate
+        self._echo_time = time.monotonic()
+        self._echo_skipped = 0
+
+    @property
+    def raw(self):
+        """Whether output goes straight to the log file (not compressed or capped)"""
+        return not (self.max_bytes or self.keep_tail or self.fname.endswith(".gz"))
+
+    @property
+    def tail(self):
+        """The last keep_tail bytes of output"""
+        if not self.keep_tail:
+            return b""
+        return bytes(self._tail[-self.keep_tail :])
+
+    def write(self, data):
+        """Write a chunk of output
+
+        Accepts bytes or text
+        """
+        if isinstance(data, str):
+            data = data.encode("utf8", "replace")
+        if not data:
+            return
+        over_limit = self.limit and self.bytes_written + len(data) > self.limit
+        if over_limit:
+            data = data[: self.limit - self.bytes_written]
+        if self.max_bytes:
+            head = self._head_bytes - self.bytes_written
+            if head > 0:
+                self._f.write(data[:head])
+        else:
+            self._f.write(data)
+        self.bytes_written += len(data)
+        if self._keep:
+            self._tail += data
+            excess = len(self._tail) - self._keep
+            # trim in large steps, not on every write
+            if excess > max(self._keep, BLOCK_SIZE):
+                del self._tail[:excess]
+        if self.echo:
+            self._echo(data)
+        if over_limit:
+            limit, self.limit = self.limit, 0
+            raise OutputLimitExceeded(f"Output limit of {limit} bytes exceeded")
+
+    def _echo(self, data):
+        """Echo complete lines, holding on to any trailing partial line"""
+        data = self._partial + data
+        end = data.rfind(b"\n") + 1
+        if len(data) - end > BLOCK_SIZE:
+            # don't hold on to arbitrarily long lines
+            end = len(data)
+        self._partial = data[end:]
+        if end:
+            self._echo_lines(data[:end])
+
+    def _echo_lines(self, lines):
+        """Echo complete lines to stderr, within echo_rate"""
+        if self.echo_rate:
+            now = time.monotonic()
+            self._echo_allowance = min(
+                self.echo_rate,
+                self._echo_allowance + (now - self._echo_time) * self.echo_rate,
+            )
+            self._echo_time = now
+            if len(lines) > self._echo_allowance:
+                self._echo_skipped += len(lines)
+                return
+            self._echo_allowance -= len(lines)
+            if self._echo_skipped:
+                lines = self._skipped_note() + lines
+        _write_stderr(lines)
+
+    def _skipped_note(self):
+        """Note output that wasn't echoed, and reset the count"""
+        note = f"[... {self._echo_skipped} bytes not echoed ...]\n".encode("utf8")
+        self._echo_skipped = 0
+        return note
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._partial:
+            self._echo_lines(self._partial)
+            self._partial = b""
+        if self._echo_skipped:
+            _write_stderr(self._skipped_note())
+        if self.max_bytes:
+            # output after the head
+            rest = max(0, self.bytes_written - self._head_bytes)
+            tail = min(rest, self._tail_bytes)
+            if rest > tail:
+                self._f.write(
+                    f"\n[... {rest - tail} bytes truncated ...]\n".encode("utf8")
+                )
+            if tail:
+                self._f.write(self._tail[len(self._tail) - tail :])
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _splice(fd, log_w):
+    """Move all data from a pipe to the log file without copying to userspace
+
+    Returns False if splice isn't available for this pair of files,
+    in which case nothing has been read.
+    """
+    if not hasattr(os, "splice") or not log_w.raw:
+        return False
+    log_w.flush()
+    out_fd = log_w.fileno()
+    while True:
+        try:
+            n = os.splice(fd, out_fd, BLOCK_SIZE)
+        except OSError:
+            if log_w.bytes_written:
+                raise
+            # e.g. EINVAL if the log file's filesystem doesn't support splice
+            return False
+        if not n:
+            return True
+        log_w.bytes_written += n
+
+
+def _tee(fd, log_w):
+    """The part of tee that runs in a background thread
+
+    Copies everything from fd to the LogWriter until EOF
+    """
+    if not log_w.echo and _splice(fd, log_w):
+        return
+    while True:
+        chunk = os.read(fd, BLOCK_SIZE)
+        if not chunk:
+            return
+        log_w.write(chunk)
+
+
+def copy_log(src, dest, max_bytes=0):
+    """Copy a log file into a (possibly compressed or capped) log file"""
+    with open_log(src) as f, LogWriter(dest, echo=False, max_bytes=max_bytes) as log_w:
+        while True:
+            chunk = f.read(BLOCK_SIZE)
+            if not chunk:
+                return
+            log_w.write(chunk)
+
+
+@contextmanager
+def tee(fname, echo=True, max_bytes=0, echo_rate=0):
+    """Like command-line tee, but in Python
+
+    Yields a writable file to pass as stdout to a subprocess.
+    Everything written to it ends up in `fname`
+    (see LogWriter for compression and max_bytes),
+    and on stderr if `echo` is True (at up to echo_rate bytes per second).
+
+    All output has been written to the log file
+    by the time the context exits.
+    """
+    reader, writer = os.pipe()
+    with LogWriter(fname, echo=echo, max_bytes=max_bytes, echo_rate=echo_rate) as log_w:
+        t = Thread(target=_tee, args=(reader, log_w), daemon=True)
+        t.start()
+        try:
+            with os.fdopen(writer, "wb") as pipe_w:
+                yield pipe_w
+        finally:
+            t.join()
+            os.close(reader)
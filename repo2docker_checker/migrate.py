@@ -0,0 +1,398 @@
+"""Migrating the layout of run directories
+
+A migration moves repos' run directories to new paths
+(e.g. github.com/Org/RePo -> github.com/o/org/repo),
+and rewrites the paths of logs in their results to match.
+
+Moves are planned before anything is moved, and recorded in a journal
+(a SQLite database in the run directory).
+They are then carried out by a pool of processes,
+and marked done in the journal as they finish.
+Each move can be safely repeated (result files are replaced atomically),
+so an interrupted migration picks up where it left off when it's run again:
+
+    repo2docker-checker migrate --run-dir runs slugs
+
+Only the top levels of the tree (host/org/repo) are listed,
+never the logs in each repo's directory,
+and moves are read from the journal in batches,
+so memory doesn't grow with the number of repos or log files.
+"""
+import argparse
+import csv
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from threading import Lock
+
+import tornado.log
+
+from .db import connect
+from .db import transaction
+
+log = logging.getLogger(__name__)
+
+# move states
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+def _listdirs(path):
+    """Yield the names of subdirectories of path, without listing them all at once"""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.name
+
+
+# what's in a repo's run directory
+REPO_RUN_DIR = {"results", "logs", "notebooks"}
+
+
+def _just_results(path):
+    """Whether a directory has nothing but a repo's results in it"""
+    with os.scandir(path) as entries:
+        return all(entry.name in REPO_RUN_DIR for entry in entries)
+
+
+def slug_moves(run_dir):
+    """Moves from the old host/Org/RePo layout to host/o/org/repo
+
+    Skips what update-slugs.py always skipped:
+    one-letter orgs (already migrated)
+    and 'orgs' with only a repo's results in them.
+    """
+    for host in _listdirs(run_dir):
+        for org in _listdirs(os.path.join(run_dir, host)):
+            if len(org) == 1:
+                # already migrated
+                continue
+            org_dir = os.path.join(run_dir, host, org)
+            if _just_results(org_dir):
+                continue
+            for repo in _listdirs(org_dir):
+                src = "/".join([host, org, repo])
+                dest = "/".join([host, org[0], org, repo]).lower()
+                yield src, dest
+
+
+# migrations by name: functions yielding (src, dest) moves
+# of repo run directories, relative to the run directory
+MIGRATIONS = {
+    "slugs": slug_moves,
+}
+
+
+class Journal:
+    """The planned moves of a migration, and how far it has got
+
+    A SQLite database, so moves don't need to fit in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self.db = connect(path)
+        with self._transaction() as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS moves (
+                id INTEGER PRIMARY KEY,
+                src TEXT NOT NULL UNIQUE,
+                dest TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                error TEXT
+                )"""
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS moves_state ON moves (state, id)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def _transaction(self):
+        """A write transaction"""
+        return transaction(self.db, self._lock)
+
+    def close(self):
+        self.db.close()
+
+    def plan(self, migration, moves, batch_size=1000):
+        """Record the planned moves of a migration, if not already planned
+
+        Returns the number of moves planned, including earlier plans.
+        Planning is finished before anything is moved,
+        so an interrupted plan is simply started again.
+        """
+        planned = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'migration'"
+        ).fetchone()
+        if planned is not None:
+            if planned["value"] != migration:
+                raise ValueError(
+                    f"{self.path} is the journal of migration {planned['value']},"
+                    f" not {migration}"
+                )
+            log.info(f"Resuming migration {migration} from {self.path}")
+        else:
+            moves = iter(moves)
+            while True:
+                batch = list(islice(moves, batch_size))
+                if not batch:
+                    break
+                with self._transaction() as db:
+                    db.executemany(
+                        "INSERT OR IGNORE INTO moves (src, dest) VALUES (?, ?)", batch
+                    )
+            with self._transaction() as db:
+                db.execute(
+                    "INSERT INTO meta (key, value) VALUES ('migration', ?)",
+                    (migration,),
+                )
+        return self.db.execute("SELECT COUNT(*) FROM moves").fetchone()[0]
+
+    def pending(self, batch_size=1000):
+        """Yield batches of pending moves, as (id, src, dest) tuples"""
+        last_id = 0
+        while True:
+            batch = [
+                tuple(row)
+                for row in self.db.execute(
+                    "SELECT id, src, dest FROM moves"
+                    " WHERE state = ? AND id > ? ORDER BY id LIMIT ?",
+                    (PENDING, last_id, batch_size),
+                )
+            ]
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1][0]
+
+    def finish(self, outcomes):
+        """Record the outcomes of moves: (id, error) pairs, error is empty if done"""
+        with self._transaction() as db:
+            db.executemany(
+                "UPDATE moves SET state = ?, error = ? WHERE id = ?",
+                [
+                    (FAILED if error else DONE, error or None, move_id)
+                    for move_id, error in outcomes
+                ],
+            )
+
+    def retry_failed(self):
+        """Put failed moves back to pending, returns how many"""
+        with self._transaction() as db:
+            return db.execute(
+                "UPDATE moves SET state = ?, error = NULL WHERE state = ?",
+                (PENDING, FAILED),
+            ).rowcount
+
+    def dest_of(self, src):
+        """The destination of a finished move from src, or None"""
+        row = self.db.execute(
+            "SELECT dest FROM moves WHERE src = ? AND state = ?", (src, DONE)
+        ).fetchone()
+        return None if row is None else row["dest"]
+
+    def counts(self):
+        counts = {state: 0 for state in (PENDING, DONE, FAILED)}
+        for row in self.db.execute(
+            "SELECT state, COUNT(*) AS n FROM moves GROUP BY state"
+        ):
+            counts[row["state"]] = row["n"]
+        return counts
+
+    def failed(self):
+        """Yield (src, dest, error) of failed moves"""
+        for row in self.db.execute(
+            "SELECT src, dest, error FROM moves WHERE state = ? ORDER BY id",
+            (FAILED,),
+        ):
+            yield tuple(row)
+
+
+def _move_path(path, src, dest):
+    """Rewrite a run-dir relative path in src to be in dest"""
+    if path.startswith(src + "/"):
+        return dest + path[len(src) :]
+    return path
+
+
+def rewrite_result_file(path, src, dest):
+    """Rewrite the paths of logs in a results CSV file from src to dest
+
+    The file is streamed to a temporary file, which replaces it,
+    so it is never left half-rewritten.
+    Returns whether the file was changed.
+    """
+    tmp_path = path + ".migrating"
+    changed = False
+    with open(path, newline="") as f_in, open(tmp_path, "w", newline="") as f_out:
+        reader = csv.reader(f_in)
+        writer = csv.writer(f_out)
+        header = next(reader, None)
+        if header is not None and "path" in header:
+            writer.writerow(header)
+            path_column = header.index("path")
+            for row in reader:
+                if len(row) > path_column:
+                    new_path = _move_path(row[path_column], src, dest)
+                    if new_path != row[path_column]:
+                        row[path_column] = new_path
+                        changed = True
+                writer.writerow(row)
+        if changed:
+            f_out.flush()
+            os.fsync(f_out.fileno())
+    if changed:
+        os.replace(tmp_path, path)
+    else:
+        os.remove(tmp_path)
+    return changed
+
+
+def apply_move(run_dir, src, dest):
+    """Move a repo's run directory from src to dest, and rewrite its results
+
+    Safe to repeat after an interruption:
+    if src has already been moved, only the results are (re)written.
+    Returns an error message, or "" on success.
+    """
+    src_dir = os.path.join(run_dir, src)
+    dest_dir = os.path.join(run_dir, dest)
+    try:
+        if os.path.exists(src_dir):
+            if os.path.exists(dest_dir):
+                return f"{dest} already exists"
+            os.makedirs(os.path.dirname(dest_dir), exist_ok=True)
+            os.rename(src_dir, dest_dir)
+        elif not os.path.isdir(dest_dir):
+            return f"{src} does not exist"
+        result_dir = os.path.join(dest_dir, "results")
+        if os.path.isdir(result_dir):
+            with os.scandir(result_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".csv"):
+                        rewrite_result_file(entry.path, src, dest)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return ""
+
+
+def rewrite_results_db(db_path, journal, batch_size=10000):
+    """Rewrite paths in a results database for finished moves
+
+    Returns the number of results changed.
+    """
+    db = connect(db_path)
+    count = 0
+    last_rowid = 0
+    try:
+        while True:
+            rows = db.execute(
+                "SELECT rowid, path FROM results WHERE rowid > ?"
+                " ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size),
+            ).fetchall()
+            if not rows:
+                return count
+            last_rowid = rows[-1][0]
+            dests = {}
+            updates = []
+            for rowid, path in rows:
+                # repo run directories are host/org/repo
+                src = "/".join((path or "").split("/")[:3])
+                if src not in dests:
+                    dests[src] = journal.dest_of(src)
+                if dests[src]:
+                    updates.append((_move_path(path, src, dests[src]), rowid))
+            if updates:
+                with transaction(db):
+                    db.executemany(
+                        "UPDATE results SET path = ? WHERE rowid = ?", updates
+                    )
+                count += len(updates)
+    finally:
+        db.close()
+
+
+def default_journal(run_dir, migration):
+    """The default journal path of a migration"""
+    return os.path.join(run_dir, f"migrate-{migration}.sqlite")
+
+
+def migrate(run_dir, migration, jobs=None, journal_path=None, batch_size=1000):
+    """Run a migration of a run directory, resuming it if it was interrupted
+
+    Moves that failed before (e.g. because the destination existed) are retried.
+    Returns the journal's counts of moves by state.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    journal = Journal(journal_path or default_journal(run_dir, migration))
+    try:
+        total = journal.plan(migration, MIGRATIONS[migration](run_dir))
+        log.info(f"Migration {migration} of {run_dir}: {total} moves planned")
+        retried = journal.retry_failed()
+        if retried:
+            log.info(f"Retrying {retried} failed moves")
+        with ProcessPoolExecutor(jobs) as pool:
+            for batch in journal.pending(batch_size):
+                errors = pool.map(
+                    apply_move,
+                    [run_dir] * len(batch),
+                    [src for move_id, src, dest in batch],
+                    [dest for move_id, src, dest in batch],
+                    chunksize=max(1, len(batch) // (4 * jobs)),
+                )
+                outcomes = []
+                for (move_id, src, dest), error in zip(batch, errors):
+                    if error:
+                        log.error(f"Failed to move {src} -> {dest}: {error}")
+                    else:
+                        log.debug(f"Moved {src} -> {dest}")
+                    outcomes.append((move_id, error))
+                journal.finish(outcomes)
+                log.info(f"Migration {migration}: {journal.counts()}")
+        db_path = os.path.join(run_dir, "results.sqlite")
+        if os.path.exists(db_path):
+            count = rewrite_results_db(db_path, journal)
+            log.info(f"Rewrote {count} paths in {db_path}")
+        return journal.counts()
+    finally:
+        journal.close()
+
+
+def main(argv=None):
+    tornado.log.enable_pretty_logging()
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(
+        prog="repo2docker-checker migrate",
+        description="Migrate the layout of a run directory",
+    )
+    parser.add_argument(
+        "migration", choices=sorted(MIGRATIONS), help="The migration to run"
+    )
+    parser.add_argument("--run-dir", default="./runs", help="The run directory")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes moving directories (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--journal",
+        help="The journal of the migration (default: RUN_DIR/migrate-MIGRATION.sqlite)",
+    )
+    opts = parser.parse_args(argv)
+    counts = migrate(opts.run_dir, opts.migration, opts.jobs, opts.journal)
+    print(f"Moved {counts['done']} repos, {counts['failed']} failed")
+    if counts["failed"]:
+        journal = Journal(opts.journal or default_journal(opts.run_dir, opts.migration))
+        for src, dest, error in journal.failed():
+            print(f"  {src} -> {dest}: {error}")
+        journal.close()
+        return 1
+
+
+if __name__ == "__main__":
+    main()
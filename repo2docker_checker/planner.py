@@ -0,0 +1,446 @@
+"""Planning which repos to check within a compute budget
+
+Given a (large) list of candidate repos and the results of past runs,
+the planner estimates what checking each candidate would cost,
+and how much new information it would give,
+and picks a schedule of repos that fits in a budget of compute time.
+
+Cost is the build time (from past builds of the repo,
+or typical builds with the same buildpack,
+and less if an image of the repo is still cached),
+plus the time to run its tests (from past runs, or typical for the buildpack).
+
+Value is highest for repos never checked before (at any ref),
+then repos whose results changed between their last two runs,
+while repos whose results are stable are only worth checking again
+once their last results are old (see information_value).
+
+With --detect, candidates are cloned to stratify them by buildpack
+(see buildcache.detect_buildpack):
+each buildpack gets a share of the budget proportional to its number of candidates,
+filled with its most valuable repos per second of cost,
+and any budget left over goes to the most valuable of the rest.
+
+    repo2docker-checker plan --budget-hours 10 --output plan.txt candidates.txt
+    repo2docker-checker $(cat plan.txt)
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+from collections import defaultdict
+from datetime import datetime
+from itertools import zip_longest
+
+import docker
+import tornado.log
+
+from .buildcache import detect_buildpack
+from .prune import IMAGE_PREFIX
+from .results import SQLiteResults
+
+log = logging.getLogger(__name__)
+
+# stratum of candidates whose buildpack isn't known
+UNKNOWN = "unknown"
+
+# estimated seconds when there's no history to go on
+DEFAULT_BUILD_SECONDS = 600
+DEFAULT_CACHED_BUILD_SECONDS = 60
+DEFAULT_TEST_SECONDS = 120
+
+# query results for this many repos at a time
+CHUNK_SIZE = 500
+
+
+def _seconds(duration):
+    """Parse a duration from the results, None if missing"""
+    try:
+        return float(duration)
+    except (TypeError, ValueError):
+        return None
+
+
+def _median(values, default=None):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else default
+
+
+def load_history(db, repo_refs):
+    """Summarize the past runs of (repo, ref) candidates' repos from a results database
+
+    Runs of a repo at any ref count, since a repo checked at another ref
+    (e.g. an older commit) isn't new.
+
+    Returns {repo: runs}, where runs is a list of dicts, oldest first,
+    with keys: ref, timestamp, build_success, build_cache, build_seconds,
+    test_seconds, passed, failed.
+    """
+    repos = sorted({repo for repo, ref in repo_refs})
+    runs = defaultdict(dict)
+    for i in range(0, len(repos), CHUNK_SIZE):
+        chunk = repos[i : i + CHUNK_SIZE]
+        rows = db.execute(
+            "SELECT repo, ref, run_id, timestamp, kind, success, duration, cache"
+            f" FROM results WHERE repo IN ({', '.join('?' for repo in chunk)})",
+            chunk,
+        )
+        for repo, ref, run_id, timestamp, kind, success, duration, cache in rows:
+            run = runs[repo].setdefault(
+                (ref, run_id),
+                {
+                    "ref": ref,
+                    "timestamp": timestamp,
+                    "build_success": None,
+                    "build_cache": "",
+                    "build_seconds": None,
+                    "test_seconds": 0.0,
+                    "passed": 0,
+                    "failed": 0,
+                },
+            )
+            run["timestamp"] = max(run["timestamp"], timestamp)
+            if kind == "build":
+                run["build_success"] = bool(success)
+                # builds from before the cache was recorded were all built
+                run["build_cache"] = cache or "miss"
+                run["build_seconds"] = _seconds(duration)
+            elif kind != "analysis":
+                run["test_seconds"] += _seconds(duration) or 0
+                run["passed" if success else "failed"] += 1
+    return {
+        repo: sorted(repo_runs.values(), key=lambda run: run["timestamp"])
+        for repo, repo_runs in runs.items()
+    }
+
+
+def information_value(runs, now, stale_days=30):
+    """How much new information checking a repo again would give, from 0 to 1
+
+    - never checked: 1
+    - results changed between the last two runs: 0.5-1
+    - checked once: 0.25-0.75
+    - same results in the last two runs: 0-0.5
+
+    growing with the age of the last run, up to stale_days.
+    """
+    if not runs:
+        return 1.0
+    try:
+        last = datetime.fromisoformat(runs[-1]["timestamp"])
+    except ValueError:
+        # no usable timestamp, treat as stale
+        age_factor = 1
+    else:
+        age_days = max(0, (now - last).total_seconds()) / (24 * 3600)
+        age_factor = min(1, age_days / stale_days) if stale_days else 1
+    if len(runs) == 1:
+        return 0.25 + 0.5 * age_factor
+
+    def outcome(run):
+        return (run["build_success"], run["passed"], run["failed"])
+
+    if outcome(runs[-1]) == outcome(runs[-2]):
+        return 0.5 * age_factor
+    return 0.5 + 0.5 * age_factor
+
+
+def estimate_costs(candidates):
+    """Estimate the seconds to check each candidate, as candidate["cost"]
+
+    From the candidate's own past runs where possible,
+    otherwise the typical cost for its buildpack, or across all candidates.
+    """
+
+    def build_seconds(runs, cached):
+        return [
+            run["build_seconds"]
+            for run in runs
+            if (run["build_cache"] != "miss") == cached
+        ]
+
+    def test_seconds(runs):
+        return [run["test_seconds"] for run in runs if run["build_success"]]
+
+    typical = {}
+    for key in [UNKNOWN] + sorted({c["buildpack"] for c in candidates}):
+        members = [c for c in candidates if key == UNKNOWN or c["buildpack"] == key]
+        all_runs = [run for c in members for run in c["runs"]]
+        typical[key] = {
+            "build": _median(build_seconds(all_runs, cached=False)),
+            "cached_build": _median(build_seconds(all_runs, cached=True)),
+            "test": _median(test_seconds(all_runs)),
+        }
+
+    def estimate(values, name, buildpack, default):
+        return _median(
+            values,
+            typical[buildpack][name] or typical[UNKNOWN][name] or default,
+        )
+
+    for c in candidates:
+        if c["cached"]:
+            build = estimate(
+                build_seconds(c["runs"], cached=True),
+                "cached_build",
+                c["buildpack"],
+                DEFAULT_CACHED_BUILD_SECONDS,
+            )
+        else:
+            build = estimate(
+                build_seconds(c["runs"], cached=False),
+                "build",
+                c["buildpack"],
+                DEFAULT_BUILD_SECONDS,
+            )
+        test = estimate(
+            test_seconds(c["runs"]), "test", c["buildpack"], DEFAULT_TEST_SECONDS
+        )
+        c["cost"] = round(build + test, 1)
+
+
+def make_schedule(candidates, budget_seconds):
+    """Pick candidates to check within budget_seconds
+
+    Candidates are dicts with buildpack, value and cost (in seconds).
+    Candidates with no value are never picked.
+    Returns the picked candidates, in the order to check them:
+    interleaved by buildpack, most valuable per second of cost first,
+    so a schedule cut short still covers each buildpack.
+    """
+
+    def priority(c):
+        return c["value"] / max(c["cost"], 1)
+
+    candidates = [c for c in candidates if c["value"] > 0]
+    strata = defaultdict(list)
+    for c in sorted(candidates, key=priority, reverse=True):
+        strata[c["buildpack"]].append(c)
+
+    picked = defaultdict(list)
+    spent = 0
+    rest = []
+    for buildpack, members in sorted(strata.items()):
+        share = budget_seconds * len(members) / len(candidates)
+        used = 0
+        for c in members:
+            if used + c["cost"] <= share:
+                picked[buildpack].append(c)
+                used += c["cost"]
+            else:
+                rest.append(c)
+        spent += used
+
+    # budget left over from strata with nothing more that fits
+    for c in sorted(rest, key=priority, reverse=True):
+        if spent + c["cost"] <= budget_seconds:
+            picked[c["buildpack"]].append(c)
+            spent += c["cost"]
+
+    schedule = []
+    for group in zip_longest(*(picked[key] for key in sorted(picked))):
+        schedule.extend(c for c in group if c is not None)
+    return schedule
+
+
+def plan(
+    repo_refs,
+    budget_seconds,
+    buildpacks=None,
+    history=None,
+    cached_images=(),
+    now=None,
+    stale_days=30,
+):
+    """Plan which repos to check within budget_seconds
+
+    repo_refs: list of candidate (repo, ref)
+    buildpacks: {(repo, ref): buildpack} (see buildcache.detect_buildpack)
+    history: past runs of candidates' repos (see load_history)
+    cached_images: image ids (repository only) of test images still in docker
+
+    Returns (schedule, candidates), both lists of candidate dicts
+    with keys: repo, ref, buildpack, cached, runs, value, cost.
+    """
+    buildpacks = buildpacks or {}
+    history = history or {}
+    now = now or datetime.now()
+    cached_images = set(cached_images)
+    candidates = []
+    for repo, ref in repo_refs:
+        runs = history.get(repo, [])
+        candidates.append(
+            {
+                "repo": repo,
+                "ref": ref,
+                "buildpack": buildpacks.get((repo, ref)) or UNKNOWN,
+                "cached": image_repository(repo) in cached_images,
+                "runs": runs,
+                "value": round(information_value(runs, now, stale_days), 3),
+            }
+        )
+    estimate_costs(candidates)
+    return make_schedule(candidates, budget_seconds), candidates
+
+
+def image_repository(repo):
+    """The repository of a repo's test images (see checker.make_image_id)"""
+    from .checker import make_image_id
+
+    return make_image_id(repo, "latest").rsplit(":", 1)[0]
+
+
+def cached_image_repositories():
+    """The repositories of test images in docker, empty if docker isn't available"""
+    try:
+        images = docker.from_env().images.list()
+    except Exception as e:
+        log.warning(f"Not checking for cached images: {e}")
+        return set()
+    return {
+        tag.rsplit(":", 1)[0]
+        for image in images
+        for tag in image.tags
+        if tag.startswith(IMAGE_PREFIX)
+    }
+
+
+def read_candidates(paths):
+    """Read repo[@ref] candidates, one per line ('-' for stdin)
+
+    Blank lines and lines starting with # are ignored.
+    Returns a list of unique (repo, ref).
+    """
+    from .checker import parse_repo_ref
+
+    repo_refs = []
+    seen = set()
+    for path in paths:
+        f = open(0 if path == "-" else path, closefd=path != "-")
+        with f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                repo_ref = parse_repo_ref(line)
+                if repo_ref not in seen:
+                    seen.add(repo_ref)
+                    repo_refs.append(repo_ref)
+    return repo_refs
+
+
+def print_plan(schedule, candidates, budget_seconds):
+    """Print a summary of a plan, by buildpack"""
+    print(
+        f"Picked {len(schedule)}/{len(candidates)} repos,"
+        f" {sum(c['cost'] for c in schedule) / 3600:.1f}"
+        f"/{budget_seconds / 3600:.1f} hours"
+    )
+    by_buildpack = defaultdict(lambda: [0, 0, 0, 0.0])
+    for c in candidates:
+        by_buildpack[c["buildpack"]][0] += 1
+    for c in schedule:
+        counts = by_buildpack[c["buildpack"]]
+        counts[1] += 1
+        counts[2] += 0 if c["runs"] else 1
+        counts[3] += c["cost"]
+    for buildpack, (total, picked, new, cost) in sorted(by_buildpack.items()):
+        print(
+            f"  {buildpack}: {picked}/{total} repos ({new} new), {cost / 3600:.1f} hours"
+        )
+
+
+def main(argv=None):
+    from .checker import inspect_repos
+
+    tornado.log.enable_pretty_logging()
+    parser = argparse.ArgumentParser(
+        prog="repo2docker-checker plan",
+        description="Plan which repos to check within a compute budget",
+    )
+    parser.add_argument(
+        "candidates",
+        nargs="+",
+        help="Files listing candidate repos, one repo[@ref] per line ('-' for stdin)",
+    )
+    parser.add_argument(
+        "--budget-hours",
+        type=float,
+        required=True,
+        help="Compute time to plan for, in hours of building and testing",
+    )
+    parser.add_argument(
+        "--db", default="./runs/results.sqlite", help="The results database"
+    )
+    parser.add_argument(
+        "--output",
+        default="-",
+        help="Where to write the plan, one repo@ref per line (default: stdout)",
+    )
+    parser.add_argument(
+        "--stale-days",
+        type=float,
+        default=30,
+        help="Age at which stable results are as worth checking as unstable ones",
+    )
+    parser.add_argument(
+        "--detect",
+        action="store_true",
+        help="""Clone candidates to detect their buildpacks,
+        to share the budget between buildpacks
+        (otherwise all candidates are in one stratum)""",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Number of repos to clone at once (--detect)",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Write the plan as JSON, with estimates"
+    )
+    opts = parser.parse_args(argv)
+
+    repo_refs = read_candidates(opts.candidates)
+    history = {}
+    if os.path.exists(opts.db):
+        store = SQLiteResults(opts.db)
+        try:
+            history = load_history(store.db, repo_refs)
+        finally:
+            store.close()
+    buildpacks = {}
+    if opts.detect:
+        detected = inspect_repos(repo_refs, detect_buildpack, jobs=opts.jobs)
+        buildpacks = dict(zip(repo_refs, detected))
+    budget_seconds = opts.budget_hours * 3600
+    schedule, candidates = plan(
+        repo_refs,
+        budget_seconds,
+        buildpacks=buildpacks,
+        history=history,
+        cached_images=cached_image_repositories(),
+        stale_days=opts.stale_days,
+    )
+
+    if opts.json:
+        output = json.dumps(
+            [
+                {key: value for key, value in c.items() if key != "runs"}
+                for c in schedule
+            ],
+            indent=1,
+        )
+    else:
+        output = "".join(f"{c['repo']}@{c['ref']}\n" for c in schedule)
+    if opts.output == "-":
+        print(output, end="")
+    else:
+        with open(opts.output, "w") as f:
+            f.write(output)
+        print_plan(schedule, candidates, budget_seconds)
+
+
+if __name__ == "__main__":
+    main()
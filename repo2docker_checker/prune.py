@@ -0,0 +1,346 @@
+"""Remove test images and containers to keep docker disk usage bounded
+
+Every checked commit leaves an r2d-test-* image behind.
+Images are evicted when their total size exceeds a budget,
+either least-recently-used first (lru),
+or older refs of each repo first (oldest-ref).
+
+Last use of each image is recorded in a small JSON file,
+since docker doesn't track when an image was last used.
+
+Pre-warmed base images (r2d-base-*, see buildcache.base_image_id)
+are never evicted, only removed once the repo2docker version changes.
+
+Run standalone with:
+
+    repo2docker-checker prune --max-image-bytes 100G
+"""
+import argparse
+import calendar
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+import docker
+import tornado.log
+from docker.utils import parse_bytes
+
+from .buildcache import BASE_PREFIX
+from .buildcache import base_tag
+
+log = logging.getLogger(__name__)
+
+IMAGE_PREFIX = "r2d-test-"
+# label applied to all containers we start
+CONTAINER_LABEL = "repo2docker-checker"
+# labels recording the process that started a container
+OWNER_HOST_LABEL = f"{CONTAINER_LABEL}.host"
+OWNER_PID_LABEL = f"{CONTAINER_LABEL}.pid"
+# container states that are never removed
+ACTIVE_STATES = {"running", "restarting", "paused"}
+
+POLICIES = ("lru", "oldest-ref")
+
+
+def default_usage_file():
+    """The default location of the image-usage file"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "repo2docker-checker", "image-usage.json")
+
+
+usage_file = default_usage_file()
+
+
+@contextmanager
+def _usage(write=False):
+    """Load image usage ({image_id: last used timestamp}), locked
+
+    If write is True, changes to the dict are saved on exit
+    """
+    os.makedirs(os.path.dirname(usage_file), exist_ok=True)
+    with open(f"{usage_file}.lock", "a") as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        try:
+            try:
+                with open(usage_file) as f:
+                    usage = json.load(f)
+            except (FileNotFoundError, ValueError):
+                usage = {}
+            yield usage
+            if write:
+                tmp_file = f"{usage_file}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(usage, f, indent=1)
+                os.replace(tmp_file, usage_file)
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+def touch_image(*image_ids):
+    """Record that images have just been used"""
+    now = time.time()
+    with _usage(write=True) as usage:
+        for image_id in image_ids:
+            usage[image_id] = now
+
+
+def _parse_created(created):
+    """Parse docker's Created timestamp to seconds since the epoch"""
+    # e.g. 2020-07-01T12:23:34.123456789Z, always UTC
+    return calendar.timegm(time.strptime(created[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def r2d_images(client):
+    """List our test images, with size and last use
+
+    Returns a list of dicts with keys:
+    id, tags, repos, size, created, last_used
+    """
+    with _usage() as usage:
+        usage = dict(usage)
+    images = []
+    for image in client.images.list():
+        tags = [tag for tag in image.tags if tag.startswith(IMAGE_PREFIX)]
+        if not tags:
+            continue
+        created = _parse_created(image.attrs["Created"])
+        last_used = max([created] + [usage.get(tag, 0) for tag in tags])
+        images.append(
+            {
+                "id": image.id,
+                "tags": tags,
+                "repos": sorted({tag.rsplit(":", 1)[0] for tag in tags}),
+                "size": image.attrs.get("Size", 0),
+                "created": created,
+                "last_used": last_used,
+            }
+        )
+    return images
+
+
+def eviction_order(images, policy="lru"):
+    """Sort images in the order they should be evicted
+
+    lru: least recently used first
+    oldest-ref: images that aren't the newest for their repo first,
+        oldest first, then the newest image of each repo by last use
+    """
+    if policy == "lru":
+        return sorted(images, key=lambda image: image["last_used"])
+    elif policy == "oldest-ref":
+        newest = {}
+        for image in images:
+            for repo in image["repos"]:
+                if repo not in newest or image["created"] > newest[repo]["created"]:
+                    newest[repo] = image
+        newest_ids = {image["id"] for image in newest.values()}
+        return sorted(
+            images,
+            key=lambda image: (
+                image["id"] in newest_ids,
+                image["last_used"] if image["id"] in newest_ids else image["created"],
+            ),
+        )
+    else:
+        raise ValueError(f"Unknown eviction policy {policy!r}, not in {POLICIES}")
+
+
+def owner_labels():
+    """Labels for containers started by this process (see remove_orphaned_containers)"""
+    return {OWNER_HOST_LABEL: socket.gethostname(), OWNER_PID_LABEL: str(os.getpid())}
+
+
+def _owner_alive(labels):
+    """Whether a container's owner is known to be alive (True), dead (False),
+    or unknown (None): not labeled, or on another host
+    """
+    if labels.get(OWNER_HOST_LABEL) != socket.gethostname():
+        return None
+    try:
+        os.kill(int(labels.get(OWNER_PID_LABEL, "")), 0)
+    except ValueError:
+        return None
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _container_age(container):
+    """Seconds since a container was created"""
+    created = container.attrs.get("Created", 0)
+    if isinstance(created, str):
+        # inspected containers have a timestamp, listed ones seconds since the epoch
+        created = _parse_created(created)
+    return time.time() - created
+
+
+def remove_orphaned_containers(client, min_age=3600, dry_run=False):
+    """Remove stopped containers left behind by our tests
+
+    e.g. when run_one_test raises before removing its container.
+
+    Containers of a process that is still running are never removed,
+    since they may be about to start, or have exited with their logs still being read
+    (e.g. other repos of the same run, with --jobs or queue workers).
+    Containers of processes on this host that have exited are removed,
+    and others (unlabeled, or from other hosts) once they are min_age seconds old.
+
+    Returns the number of containers removed.
+    """
+    removed = 0
+    for container in client.containers.list(all=True):
+        if container.status in ACTIVE_STATES:
+            continue
+        ours = CONTAINER_LABEL in container.labels or container.attrs.get(
+            "Config", {}
+        ).get("Image", "").startswith(IMAGE_PREFIX)
+        if not ours:
+            continue
+        alive = _owner_alive(container.labels)
+        if alive or (alive is None and _container_age(container) < min_age):
+            continue
+        log.info(f"Removing {container.status} container {container.name}")
+        if not dry_run:
+            try:
+                container.remove(force=True)
+            except docker.errors.APIError as e:
+                log.warning(f"Failed to remove container {container.name}: {e}")
+                continue
+        removed += 1
+    return removed
+
+
+def prune_images(client, max_bytes, policy="lru", min_age=3600, dry_run=False):
+    """Evict test images until their total size fits in max_bytes
+
+    Images used less than min_age seconds ago are never evicted,
+    so images of repos currently being checked are safe.
+
+    Sizes are as reported by docker, which counts shared layers
+    once per image, so the total is an upper bound on disk use.
+
+    Returns the list of evicted images.
+    """
+    images = r2d_images(client)
+    total = sum(image["size"] for image in images)
+    log.info(f"{len(images)} test images using up to {total} bytes")
+    now = time.time()
+    evicted = []
+    for image in eviction_order(images, policy):
+        if total <= max_bytes:
+            break
+        if now - image["last_used"] < min_age:
+            continue
+        log.info(f"Evicting {' '.join(image['tags'])} ({image['size']} bytes)")
+        if not dry_run:
+            try:
+                # remove by tag, since removing an image with several tags
+                # by id requires force, which would also remove it
+                # from under running containers
+                for tag in image["tags"]:
+                    client.images.remove(tag)
+            except docker.errors.APIError as e:
+                log.warning(f"Failed to remove image {image['id']}: {e}")
+                continue
+        total -= image["size"]
+        evicted.append(image)
+    if total > max_bytes:
+        log.warning(f"Test images still use {total} bytes > {max_bytes}")
+    if evicted and not dry_run:
+        with _usage(write=True) as usage:
+            for image in evicted:
+                for tag in image["tags"]:
+                    usage.pop(tag, None)
+    return evicted
+
+
+def remove_stale_bases(client, dry_run=False):
+    """Remove pre-warmed base images of other repo2docker versions
+
+    Returns the list of removed tags.
+    """
+    removed = []
+    current = base_tag()
+    for image in client.images.list():
+        for tag in image.tags:
+            if not tag.startswith(BASE_PREFIX) or tag.rsplit(":", 1)[1] == current:
+                continue
+            log.info(f"Removing stale base image {tag}")
+            if not dry_run:
+                try:
+                    client.images.remove(tag)
+                except docker.errors.APIError as e:
+                    log.warning(f"Failed to remove image {tag}: {e}")
+                    continue
+            removed.append(tag)
+    return removed
+
+
+def prune(client, max_bytes, policy="lru", min_age=3600, dry_run=False):
+    """Remove orphaned containers and stale bases, then evict images over the budget"""
+    remove_orphaned_containers(client, min_age=min_age, dry_run=dry_run)
+    remove_stale_bases(client, dry_run=dry_run)
+    if max_bytes:
+        return prune_images(
+            client, max_bytes, policy=policy, min_age=min_age, dry_run=dry_run
+        )
+    return []
+
+
+def main(argv=None):
+    global usage_file
+
+    tornado.log.enable_pretty_logging()
+    parser = argparse.ArgumentParser(
+        prog="repo2docker-checker prune",
+        description="Remove test images and containers left behind by repo2docker-checker",
+    )
+    parser.add_argument(
+        "--max-image-bytes",
+        default="0",
+        help="Remove test images until they fit in this size (e.g. 100G). 0 for no limit.",
+    )
+    parser.add_argument(
+        "--policy",
+        choices=POLICIES,
+        default="lru",
+        help="Which images to remove first",
+    )
+    parser.add_argument(
+        "--min-age",
+        type=float,
+        default=3600,
+        help="""Never remove images used within this many seconds,
+        or containers created within this many seconds (unless their process has exited)""",
+    )
+    parser.add_argument(
+        "--image-usage-file",
+        default=usage_file,
+        help="File recording when each image was last used",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only log what would be removed",
+    )
+    opts = parser.parse_args(argv)
+    usage_file = opts.image_usage_file
+    evicted = prune(
+        docker.from_env(),
+        parse_bytes(opts.max_image_bytes),
+        policy=opts.policy,
+        min_age=opts.min_age,
+        dry_run=opts.dry_run,
+    )
+    freed = sum(image["size"] for image in evicted)
+    print(f"Removed {len(evicted)} images, freeing up to {freed} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""Aggregate reports across all results in a results database
+
+Aggregates are cached in the database, per run,
+and updated incrementally with only the results added since the last report,
+so reports stay fast no matter how many results there are.
+
+    repo2docker-checker report --db runs/results.sqlite --runs 30
+"""
+import argparse
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from .db import transaction
+from .results import SQLiteResults
+
+log = logging.getLogger(__name__)
+
+# dimensions results are aggregated by, in addition to kind
+DIMENSIONS = ("all", "repo2docker_version", "age", "failure_reason")
+
+# age of the tested commit when it was tested: (max age in days, label)
+AGE_BUCKETS = [
+    (30, "<1 month"),
+    (182, "1-6 months"),
+    (365, "6-12 months"),
+    (730, "1-2 years"),
+    (None, ">2 years"),
+]
+
+# read this many new results at a time when updating aggregates
+CHUNK_SIZE = 10000
+
+
+def _create_tables(db):
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS report_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS report_runs (
+            run_id TEXT PRIMARY KEY,
+            first_timestamp TEXT
+        );
+        CREATE TABLE IF NOT EXISTS report_counts (
+            run_id TEXT,
+            dimension TEXT,
+            key TEXT,
+            kind TEXT,
+            passed INTEGER,
+            failed INTEGER,
+            PRIMARY KEY (run_id, dimension, key, kind)
+        );
+        CREATE TABLE IF NOT EXISTS report_tests (
+            repo TEXT,
+            resolved_ref TEXT,
+            kind TEXT,
+            test_id TEXT,
+            passed INTEGER,
+            failed INTEGER,
+            PRIMARY KEY (repo, resolved_ref, kind, test_id)
+        );
+        """
+    )
+
+
+def _parse_time(timestamp):
+    """Parse an ISO8601 timestamp to a naive local datetime, or None"""
+    try:
+        dt = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def age_bucket(last_modified, timestamp):
+    """Bucket the age of a commit at the time it was tested"""
+    committed = _parse_time(last_modified)
+    tested = _parse_time(timestamp)
+    if committed is None or tested is None:
+        return "unknown"
+    days = (tested - committed).total_seconds() / (24 * 3600)
+    for max_days, label in AGE_BUCKETS:
+        if max_days is None or days < max_days:
+            return label
+
+
+def _update_chunk(db):
+    """Add the next chunk of new results to the aggregates
+
+    Returns the number of results added.
+    Reading the watermark and updating it happen in one transaction,
+    so concurrent reports can't count results twice.
+    """
+    with transaction(db):
+        row = db.execute(
+            "SELECT value FROM report_state WHERE key = 'last_rowid'"
+        ).fetchone()
+        last_rowid = row[0] if row else 0
+        rows = db.execute(
+            "SELECT rowid, run_id, timestamp, kind, success, repo, resolved_ref,"
+            " test_id, repo2docker_version, last_modified, failure_reason"
+            " FROM results WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, CHUNK_SIZE),
+        ).fetchall()
+        counts = defaultdict(lambda: [0, 0])
+        tests = defaultdict(lambda: [0, 0])
+        runs = {}
+        for (
+            rowid,
+            run_id,
+            timestamp,
+            kind,
+            success,
+            repo,
+            resolved_ref,
+            test_id,
+            r2d_version,
+            last_modified,
+            failure_reason,
+        ) in rows:
+            col = 0 if int(success) else 1
+            keys = {
+                "all": "",
+                "repo2docker_version": r2d_version,
+                "age": age_bucket(last_modified, timestamp),
+                "failure_reason": failure_reason or "",
+            }
+            for dimension, key in keys.items():
+                counts[(run_id, dimension, key, kind)][col] += 1
+            tests[(repo, resolved_ref, kind, test_id)][col] += 1
+            if run_id not in runs or timestamp < runs[run_id]:
+                runs[run_id] = timestamp
+            last_rowid = rowid
+
+        db.executemany(
+            "INSERT INTO report_counts VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (run_id, dimension, key, kind) DO UPDATE SET"
+            " passed = passed + excluded.passed, failed = failed + excluded.failed",
+            [key + tuple(value) for key, value in counts.items()],
+        )
+        db.executemany(
+            "INSERT INTO report_tests VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (repo, resolved_ref, kind, test_id) DO UPDATE SET"
+            " passed = passed + excluded.passed, failed = failed + excluded.failed",
+            [key + tuple(value) for key, value in tests.items()],
+        )
+        db.executemany(
+            "INSERT INTO report_runs VALUES (?, ?)"
+            " ON CONFLICT (run_id) DO UPDATE SET"
+            " first_timestamp = min(first_timestamp, excluded.first_timestamp)",
+            list(runs.items()),
+        )
+        db.execute(
+            "INSERT OR REPLACE INTO report_state VALUES ('last_rowid', ?)",
+            (last_rowid,),
+        )
+    return len(rows)
+
+
+def update_aggregates(db):
+    """Add results added since the last update to the cached aggregates
+
+    Returns the number of new results processed.
+    """
+    _create_tables(db)
+    total = 0
+    while True:
+        count = _update_chunk(db)
+        if not count:
+            break
+        total += count
+    if total:
+        log.info(f"Added {total} new results to report aggregates")
+    return total
+
+
+def last_runs(db, n):
+    """The ids of the last n runs, by when they started"""
+    return [
+        row[0]
+        for row in db.execute(
+            "SELECT run_id FROM report_runs"
+            " ORDER BY first_timestamp DESC, run_id DESC LIMIT ?",
+            (n,),
+        )
+    ]
+
+
+def counts_by(db, dimension, run_ids=None, kind=None):
+    """Pass/fail counts by (key, kind) for one dimension
+
+    Returns a dict of {(key, kind): (passed, failed)}
+    """
+    sql = (
+        "SELECT key, kind, sum(passed), sum(failed) FROM report_counts"
+        " WHERE dimension = ?"
+    )
+    params = [dimension]
+    if run_ids is not None:
+        sql += f" AND run_id IN ({', '.join('?' for run_id in run_ids)})"
+        params.extend(run_ids)
+    if kind:
+        sql += " AND kind = ?"
+        params.append(kind)
+    sql += " GROUP BY key, kind ORDER BY key, kind"
+    return {
+        (key, kind): (passed, failed)
+        for key, kind, passed, failed in db.execute(sql, params)
+    }
+
+
+def flaky_tests(db, kind=None, limit=20):
+    """Tests that both passed and failed on the same commit
+
+    Returns a list of (repo, resolved_ref, kind, test_id, passed, failed),
+    most failures first
+    """
+    sql = (
+        "SELECT repo, resolved_ref, kind, test_id, passed, failed FROM report_tests"
+        " WHERE passed > 0 AND failed > 0"
+    )
+    params = []
+    if kind:
+        sql += " AND kind = ?"
+        params.append(kind)
+    sql += " ORDER BY failed DESC, passed DESC, repo, test_id LIMIT ?"
+    params.append(limit)
+    return db.execute(sql, params).fetchall()
+
+
+def make_report(db, runs=0, kind=None, flaky_limit=20):
+    """Compute a report as a dict, updating aggregates first"""
+    update_aggregates(db)
+    run_ids = last_runs(db, runs) if runs else None
+    report = {"runs": run_ids, "counts": {}}
+    for dimension in DIMENSIONS:
+        report["counts"][dimension] = [
+            {
+                dimension: key,
+                "kind": test_kind,
+                "passed": passed,
+                "failed": failed,
+                "success_rate": passed / (passed + failed),
+            }
+            for (key, test_kind), (passed, failed) in counts_by(
+                db, dimension, run_ids=run_ids, kind=kind
+            ).items()
+        ]
+    report["flaky"] = [
+        dict(zip(("repo", "resolved_ref", "kind", "test_id", "passed", "failed"), row))
+        for row in flaky_tests(db, kind=kind, limit=flaky_limit)
+    ]
+    return report
+
+
+def print_report(report):
+    """Print a report made by make_report"""
+    if report["runs"] is not None:
+        print(f"Last {len(report['runs'])} runs: {', '.join(report['runs'])}")
+    titles = {
+        "all": "Results by kind",
+        "repo2docker_version": "Results by repo2docker version",
+        "age": "Results by age of tested commit",
+    }
+    for dimension in DIMENSIONS:
+        if dimension == "failure_reason":
+            continue
+        print(f"{titles[dimension]}:")
+        for row in report["counts"][dimension]:
+            label = f"{row[dimension]} {row['kind']}".strip()
+            print(
+                f"  {label}: {row['passed']} ok, {row['failed']} failed"
+                f" ({100 * row['success_rate']:.1f}% ok)"
+            )
+    failures = [
+        row for row in report["counts"]["failure_reason"] if row["failure_reason"]
+    ]
+    if failures:
+        print("Failures by reason:")
+        for row in failures:
+            print(f"  {row['failure_reason']} {row['kind']}: {row['failed']} failed")
+    if report["flaky"]:
+        print("Flaky tests (passed and failed on the same commit):")
+        for row in report["flaky"]:
+            print(
+                f"  {row['repo']}@{row['resolved_ref']} {row['kind']} {row['test_id']}:"
+                f" {row['passed']} ok, {row['failed']} failed"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="repo2docker-checker report",
+        description="Report aggregate results across runs",
+    )
+    parser.add_argument(
+        "--db", default="./runs/results.sqlite", help="The results database"
+    )
+    parser.add_argument(
+        "--runs", type=int, default=0, help="Only include the last N runs"
+    )
+    parser.add_argument("--kind", help="Only include results of this kind")
+    parser.add_argument(
+        "--flaky-limit", type=int, default=20, help="Max number of flaky tests to show"
+    )
+    parser.add_argument("--json", action="store_true", help="Output the report as JSON")
+    opts = parser.parse_args(argv)
+    store = SQLiteResults(opts.db)
+    try:
+        report = make_report(
+            store.db, runs=opts.runs, kind=opts.kind, flaky_limit=opts.flaky_limit
+        )
+    finally:
+        store.close()
+    if opts.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""Storing test results
+
+Results of each repo and ref are written to a CSV file
+(results/results-{ref}-{run_id}.csv in the repo's run directory),
+and can also be stored in a SQLite database,
+indexed for queries across repos and runs.
+
+Import existing CSV results into a database with:
+
+    repo2docker-checker results import --db runs/results.sqlite runs
+
+and export (a subset of) a database back to CSV with:
+
+    repo2docker-checker results export --db runs/results.sqlite --run-id RUN_ID out.csv
+"""
+import argparse
+import csv
+import logging
+import os
+from collections import namedtuple
+from threading import Lock
+
+import tornado.log
+
+from .db import connect
+from .db import transaction
+
+log = logging.getLogger(__name__)
+
+TestResult = namedtuple(
+    "TestResult",
+    (
+        "repo",
+        "ref",
+        "resolved_ref",
+        "last_modified",
+        "kind",
+        "test_id",
+        "success",
+        "path",
+        "timestamp",
+        "run_id",
+        "repo2docker_version",
+        # how the build was avoided, if it was (see checker.build_image),
+        # or "result" for test results carried forward (see testcache.py)
+        "cache",
+        # seconds taken by the build or test
+        "duration",
+        # why it failed (see failures.classify), if it did
+        "failure_reason",
+    ),
+    defaults=("", "", ""),
+)
+
+# columns of TestResult that can be used to filter queries
+INDEXED_FIELDS = ("repo", "run_id", "kind", "success")
+
+
+def _from_row(row):
+    """Make a TestResult from a CSV or database row (a dict)
+
+    Columns missing from older results get their default values.
+    """
+    values = {}
+    for field in TestResult._fields:
+        if field in row:
+            values[field] = row[field]
+        elif field in TestResult._field_defaults:
+            values[field] = TestResult._field_defaults[field]
+        else:
+            values[field] = ""
+    success = values["success"]
+    if isinstance(success, str):
+        success = success == "True"
+    values["success"] = bool(success)
+    return TestResult(**values)
+
+
+def _truncate_partial_line(path):
+    """Remove an incomplete last line, left by a crash mid-write"""
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            log.warning(f"Removing incomplete last line of {path}")
+            f.truncate(end)
+
+
+class CSVResults:
+    """Write results to a CSV file
+
+    The file is kept open and flushed after each result.
+    If append is True, results are added to an existing file,
+    e.g. when resuming an interrupted run.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        # only write the header to a new or empty file
+        new = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new:
+            _truncate_partial_line(path)
+        self._f = open(path, "w" if new else "a", newline="")
+        self._writer = csv.writer(self._f)
+        if new:
+            self._writer.writerow(TestResult._fields)
+            self._f.flush()
+
+    def add(self, result):
+        self._writer.writerow(result)
+        self._f.flush()
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_csv(path):
+    """Read TestResults from a CSV file"""
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield _from_row(row)
+
+
+class SQLiteResults:
+    """Store results in a SQLite database
+
+    Results are written in batches of batch_size, in one transaction,
+    and on flush() or close().
+    Safe to share across threads,
+    and for several processes to write to the same database.
+
+    A result is stored once per (run_id, repo, ref, kind, test_id),
+    so adding the same results again (e.g. importing twice) is harmless.
+    """
+
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = Lock()
+        self._pending = []
+        self.db = connect(path)
+        self._create_tables()
+
+    def _create_tables(self):
+        columns = ",\n".join(
+            f"{field} INTEGER" if field == "success" else f"{field} TEXT"
+            for field in TestResult._fields
+        )
+        with self._lock:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS results (\n{columns}\n)")
+            existing = {
+                row["name"] for row in self.db.execute("PRAGMA table_info(results)")
+            }
+            for field in TestResult._fields:
+                # add columns added to TestResult since the database was created
+                if field not in existing:
+                    default = TestResult._field_defaults.get(field, "")
+                    self.db.execute(
+                        f"ALTER TABLE results ADD COLUMN {field} TEXT DEFAULT '{default}'"
+                    )
+            self.db.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS results_key"
+                " ON results (run_id, repo, ref, kind, test_id)"
+            )
+            for field in INDEXED_FIELDS:
+                self.db.execute(
+                    f"CREATE INDEX IF NOT EXISTS results_{field} ON results ({field})"
+                )
+
+    def add(self, result):
+        """Add a result, writing the batch if it is full"""
+        with self._lock:
+            self._pending.append(result)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def add_many(self, results):
+        for result in results:
+            self.add(result)
+
+    def flush(self):
+        """Write pending results in one transaction"""
+        with self._lock:
+            if not self._pending:
+                return
+            placeholders = ", ".join("?" for field in TestResult._fields)
+            with transaction(self.db):
+                self.db.executemany(
+                    f"INSERT OR IGNORE INTO results ({', '.join(TestResult._fields)})"
+                    f" VALUES ({placeholders})",
+                    self._pending,
+                )
+            self._pending = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def query(self, **filters):
+        """Query results, filtered by equality on fields
+
+        e.g. query(run_id="2020-07-01T12.00", kind="build")
+        """
+        self.flush()
+        where = []
+        values = []
+        for field, value in filters.items():
+            if field not in TestResult._fields:
+                raise ValueError(f"No such field {field}")
+            where.append(f"{field} = ?")
+            values.append(value)
+        sql = "SELECT * FROM results"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY rowid"
+        with self._lock:
+            rows = self.db.execute(sql, values).fetchall()
+        for row in rows:
+            yield _from_row(dict(row))
+
+    def export_csv(self, path, **filters):
+        """Export results to a CSV file, in the same format as CSVResults
+
+        Returns the number of results exported.
+        """
+        csv_results = CSVResults(path)
+        count = 0
+        try:
+            for result in self.query(**filters):
+                csv_results.add(result)
+                count += 1
+        finally:
+            csv_results.close()
+        return count
+
+
+def find_result_files(run_dir):
+    """Find all results CSV files in a run directory
+
+    Only descends as far as each repo's directory,
+    not into its logs.
+    """
+    for parent, dirs, files in os.walk(run_dir):
+        dirs.sort()
+        if "results" in dirs and "logs" in dirs:
+            # a repo's run directory
+            dirs[:] = []
+            result_dir = os.path.join(parent, "results")
+            for fname in sorted(os.listdir(result_dir)):
+                if fname.endswith(".csv"):
+                    yield os.path.join(result_dir, fname)
+
+
+def import_csv_tree(run_dir, store):
+    """Import all results CSV files in run_dir into a results store
+
+    Returns the number of results read.
+    """
+    count = 0
+    for path in find_result_files(run_dir):
+        log.info(f"Importing {path}")
+        for result in read_csv(path):
+            store.add(result)
+            count += 1
+    store.flush()
+    return count
+
+
+def main(argv=None):
+    tornado.log.enable_pretty_logging()
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(
+        prog="repo2docker-checker results",
+        description="Import and export results in a results database",
+    )
+    parser.add_argument(
+        "--db", default="./runs/results.sqlite", help="The results database"
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    import_parser = subparsers.add_parser(
+        "import", help="Import results CSV files from a run directory"
+    )
+    import_parser.add_argument("run_dir", help="The run directory to import")
+    export_parser = subparsers.add_parser("export", help="Export results to CSV")
+    for field in INDEXED_FIELDS:
+        if field == "success":
+            continue
+        export_parser.add_argument(
+            f"--{field.replace('_', '-')}",
+            help=f"Only export results with this {field}",
+        )
+    export_parser.add_argument("output", help="The CSV file to write")
+    opts = parser.parse_args(argv)
+
+    store = SQLiteResults(opts.db, batch_size=1000)
+    try:
+        if opts.action == "import":
+            count = import_csv_tree(opts.run_dir, store)
+            print(f"Imported {count} results from {opts.run_dir} into {opts.db}")
+        elif opts.action == "export":
+            filters = {}
+            for field in INDEXED_FIELDS:
+                value = getattr(opts, field, None)
+                if value is not None:
+                    filters[field] = value
+            count = store.export_csv(opts.output, **filters)
+            print(f"Exported {count} results to {opts.output}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Carrying forward results of tests that haven't changed
+
+When a repo is checked again at a new commit,
+most of its notebooks and its environment are often unchanged.
+A notebook that passed with the same content, in the same environment
+(see buildcache.env_hash), built by the same repo2docker version,
+with the same kernel, is not run again:
+its passing result is carried forward, pointing to the log of the run that passed.
+
+Notebooks may read data or import modules from anywhere in the repo,
+so a change to any other file in the repo (other than notebooks)
+runs all its notebooks again.
+"""
+import hashlib
+import json
+import os
+from subprocess import CalledProcessError
+from subprocess import check_output
+from subprocess import DEVNULL
+from threading import Lock
+
+import repo2docker
+
+from .buildcache import env_hash
+from .db import connect
+
+
+def kernel_name(nb_bytes):
+    """The name of a notebook's kernel, from its metadata ("" if unknown)"""
+    try:
+        nb = json.loads(nb_bytes.decode("utf8"))
+        return nb["metadata"]["kernelspec"]["name"]
+    except (ValueError, KeyError, TypeError):
+        return ""
+
+
+def repo_files_hash(checkout_path):
+    """Hash the files in a checkout's commit, other than notebooks
+
+    Uses the ids git has for each file (`git ls-tree`), without reading them.
+    Returns None if the checkout isn't a git repo.
+    """
+    try:
+        out = check_output(
+            ["git", "ls-tree", "-r", "-z", "HEAD"], cwd=checkout_path, stderr=DEVNULL
+        )
+    except (CalledProcessError, OSError):
+        return None
+    h = hashlib.sha256()
+    # entries are "mode type id\tpath"
+    for entry in out.split(b"\0"):
+        if entry and not entry.endswith(b".ipynb"):
+            h.update(entry + b"\0")
+    return h.hexdigest()
+
+
+def cache_keys(repo, checkout_path, nb_paths):
+    """Compute the cache keys of notebook tests in a checkout
+
+    Keys include the other files in the repo (see repo_files_hash),
+    which notebooks may use.
+
+    Returns {nb_path: key}, without notebooks that can't be cached:
+    all of them if the repo's environment may depend on other files in the repo
+    (env_hash is None, e.g. with a postBuild script or `-e .` requirements),
+    since the key couldn't tell when the environment changed,
+    or if the checkout isn't a git repo.
+    """
+    env_id = env_hash(checkout_path)
+    if env_id is None:
+        return {}
+    files_id = repo_files_hash(checkout_path)
+    if files_id is None:
+        return {}
+    keys = {}
+    for nb_path in nb_paths:
+        try:
+            with open(os.path.join(checkout_path, nb_path), "rb") as f:
+                nb_bytes = f.read()
+        except OSError:
+            continue
+        h = hashlib.sha256()
+        for part in (
+            repo,
+            nb_path,
+            hashlib.sha256(nb_bytes).hexdigest(),
+            env_id,
+            files_id,
+            repo2docker.__version__,
+            kernel_name(nb_bytes),
+        ):
+            h.update(f"{part}\0".encode("utf8"))
+        keys[nb_path] = h.hexdigest()[:40]
+    return keys
+
+
+class TestCache:
+    """Passing test results by key (see cache_keys), in a SQLite database
+
+    Only the latest passing result of each (repo, test) is kept.
+    Log paths are stored relative to the database's directory (the run directory).
+    Safe to share across threads and processes, like results.SQLiteResults.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self._lock = Lock()
+        self.db = connect(path)
+        with self._lock:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS tests ("
+                " key TEXT PRIMARY KEY, repo TEXT, test_id TEXT,"
+                " path TEXT, duration TEXT, run_id TEXT"
+                ")"
+            )
+            self.db.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS tests_test ON tests (repo, test_id)"
+            )
+
+    def get(self, key):
+        """Get the passing result for key
+
+        Returns a dict with path (absolute), duration and run_id,
+        or None if there is none, or its log has since been removed.
+        """
+        with self._lock:
+            row = self.db.execute(
+                "SELECT path, duration, run_id FROM tests WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        path, duration, run_id = row
+        path = os.path.join(self.root, path)
+        if not os.path.exists(path):
+            return None
+        return {"path": path, "duration": duration, "run_id": run_id}
+
+    def add(self, key, repo, test_id, path, duration, run_id):
+        """Record a passing result, replacing any earlier one for the same test"""
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO tests"
+                " (key, repo, test_id, path, duration, run_id)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    repo,
+                    test_id,
+                    os.path.relpath(os.path.abspath(path), self.root),
+                    str(duration),
+                    run_id,
+                ),
+            )
+
+    def discard(self, repo, test_id):
+        """Forget the result for a test, e.g. because it failed since"""
+        with self._lock:
+            self.db.execute(
+                "DELETE FROM tests WHERE repo = ? AND test_id = ?", (repo, test_id)
+            )
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,113 @@
+"""Timing spans for each phase of checking a repo
+
+Spans record wall time, growth of peak memory and bytes of log output
+of phases such as clone, build and test,
+and are written to a trace file in Chrome's trace event format,
+which can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+The trace file has one event per line (the closing bracket is optional
+in the trace format), so several processes can append to it,
+and it can be read line by line with read_trace.
+"""
+import fcntl
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from threading import get_ident
+from threading import Lock
+
+
+def max_rss():
+    """Peak resident memory in bytes of this process and its children
+
+    Children only count once they have exited (e.g. jupyter-repo2docker),
+    and the peak is over the lifetime of the process,
+    not only the current span.
+    """
+    # ru_maxrss is in KiB, except on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+class Tracer:
+    """Write timing spans to a trace file
+
+    If path is None, spans are measured but not written anywhere.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = Lock()
+
+    def write(self, *events):
+        """Append trace events (dicts) to the trace file"""
+        if not self.path or not events:
+            return
+        lines = "".join(json.dumps(event) + ",\n" for event in events)
+        with self._lock, open(self.path, "a") as f:
+            # lock across processes sharing a run directory
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    f.write("[\n")
+                f.write(lines)
+            finally:
+                f.flush()
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def span(self, name, **args):
+        """Time a block of code
+
+        Yields the span's args, a dict which the block can add to
+        (e.g. log_bytes). On exit, 'duration' (seconds) is added,
+        'max_rss_increase': how much max_rss() rose during the span
+        (0 unless the span set a new peak, which may be due to concurrent spans),
+        and 'error' if the block raised.
+        """
+        start = time.time()
+        tic = time.perf_counter()
+        peak = max_rss()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - tic
+            args["duration"] = round(duration, 3)
+            args["max_rss_increase"] = max_rss() - peak
+            self.write(
+                {
+                    "name": name,
+                    "cat": "checker",
+                    "ph": "X",
+                    "ts": int(start * 1e6),
+                    "dur": int(duration * 1e6),
+                    "pid": os.getpid(),
+                    "tid": get_ident(),
+                    "args": args,
+                }
+            )
+
+
+def read_trace(path):
+    """Read events from a trace file written by Tracer"""
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip().rstrip(",")
+            if not line or line in {"[", "]"}:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # incomplete last line, if a writer crashed
+                continue
+    return events
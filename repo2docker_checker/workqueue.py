@@ -0,0 +1,508 @@
+"""A queue of repos to check, shared by several worker processes
+
+The queue is a SQLite database of (repo, ref) jobs.
+Workers lease a job at a time, renew the lease with heartbeats while they
+work on it, and mark it done or failed when they are finished.
+A job whose lease expires (e.g. its worker died) goes back in the queue,
+and failed jobs are retried, until they have run out of attempts.
+
+The queue relies on SQLite's file locking, so it must be on a local filesystem:
+locking over network filesystems (NFS, SMB, ...) is unreliable,
+so leases could be granted twice and the database corrupted.
+Queues on network filesystems are refused (see network_filesystem).
+Workers on other hosts use the queue through a coordinator
+(see coordinator.py), which serves it over HTTP.
+
+Create a queue and add repos to it:
+
+    repo2docker-checker queue add --queue runs/queue.sqlite binder-examples/requirements ...
+
+then start any number of workers on the same host:
+
+    repo2docker-checker --queue runs/queue.sqlite --jobs 2
+
+or serve it to workers on other hosts:
+
+    repo2docker-checker queue serve --queue runs/queue.sqlite --ip 0.0.0.0
+    # on each worker host
+    repo2docker-checker --queue http://coordinator:8765 --jobs 2
+
+and check on progress with:
+
+    repo2docker-checker queue status --queue runs/queue.sqlite
+"""
+import argparse
+import logging
+import os
+import socket
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Event
+from threading import get_ident
+from threading import Lock
+from threading import Thread
+from uuid import uuid4
+
+import tornado.log
+
+from .db import connect
+from .db import transaction
+
+log = logging.getLogger(__name__)
+
+# job states
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+STATES = (PENDING, LEASED, DONE, FAILED)
+
+Job = namedtuple("Job", ("id", "repo", "ref", "attempts", "lease"))
+
+# filesystem types where SQLite's locking can't be trusted
+NETWORK_FILESYSTEMS = {
+    "9p",
+    "afs",
+    "ceph",
+    "cifs",
+    "fuse.glusterfs",
+    "fuse.sshfs",
+    "glusterfs",
+    "gpfs",
+    "lustre",
+    "nfs",
+    "nfs4",
+    "smb3",
+    "smbfs",
+}
+
+
+def network_filesystem(path, mounts_file="/proc/mounts"):
+    """The type of the network filesystem path is on, or None if it's local
+
+    Looks up the mount containing path in mounts_file,
+    so always None where that isn't available (e.g. not Linux).
+    """
+    path = os.path.realpath(path)
+    try:
+        with open(mounts_file) as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) >= 3]
+    except OSError:
+        return None
+    best = ""
+    fstype = None
+    for mount_point, mount_type in mounts:
+        # spaces in mount points are escaped as \040
+        mount_point = mount_point.replace("\\040", " ")
+        inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) >= len(best):
+            best = mount_point
+            fstype = mount_type
+    return fstype if fstype in NETWORK_FILESYSTEMS else None
+
+
+class BaseQueue:
+    """What workers need from a queue, beyond leasing and completing jobs
+
+    Subclasses implement counts() and renew(job), and set lease_seconds.
+    """
+
+    lease_seconds = 600
+
+    def unfinished(self):
+        """Whether any jobs are pending or leased"""
+        counts = self.counts()
+        return counts[PENDING] + counts[LEASED] > 0
+
+    @contextmanager
+    def heartbeat(self, job):
+        """Keep renewing the lease on a job while working on it"""
+        stop = Event()
+
+        def renew_until_stopped():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    if not self.renew(job):
+                        log.warning(f"Lost lease on {job.repo}@{job.ref}")
+                        return
+                except Exception:
+                    log.exception(f"Error renewing lease on {job.repo}@{job.ref}")
+
+        t = Thread(target=renew_until_stopped, daemon=True)
+        t.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            t.join()
+
+
+class JobQueue(BaseQueue):
+    """A SQLite-backed queue of (repo, ref) jobs
+
+    lease_seconds: how long a worker has a job before it's given to another
+        worker, unless the lease is renewed (see heartbeat)
+    retry_delay: seconds to wait before retrying a failed job,
+        multiplied by the number of attempts so far
+
+    Safe to share across threads,
+    and for several processes on the same host to use the same database.
+    Raises ValueError if the database is on a network filesystem.
+    """
+
+    def __init__(self, path, lease_seconds=600, retry_delay=60):
+        fstype = network_filesystem(os.path.dirname(os.path.abspath(path)))
+        if fstype:
+            raise ValueError(
+                f"Queue {path} is on a network filesystem ({fstype}),"
+                " where SQLite's locking is unreliable. Use a local path."
+            )
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._lock = Lock()
+        # the rollback journal, not WAL, which needs shared memory between workers
+        self.db = connect(path, journal_mode="DELETE")
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock:
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                repo TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                not_before REAL NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease TEXT,
+                lease_expires REAL,
+                result_file TEXT,
+                error TEXT,
+                updated REAL,
+                UNIQUE (repo, ref)
+                )"""
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, not_before)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def _transaction(self):
+        """A write transaction, holding the database's write lock"""
+        return transaction(self.db, self._lock)
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return default if row is None else row["value"]
+
+    def set_meta(self, key, value):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    @property
+    def run_id(self):
+        """The run id shared by all workers"""
+        return self.get_meta("run_id")
+
+    def add(self, repo_refs, max_attempts=3):
+        """Add (repo, ref) jobs to the queue
+
+        Jobs already in the queue are not added again.
+        Returns the number of jobs added.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            before = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO jobs (repo, ref, max_attempts, updated)"
+                " VALUES (?, ?, ?, ?)",
+                [(repo, ref, max_attempts, now) for repo, ref in repo_refs],
+            )
+            return db.total_changes - before
+
+    def _expire_leases(self, db, now):
+        """Return jobs with expired leases to the queue (or fail them)"""
+        db.execute(
+            """UPDATE jobs SET
+            state = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END,
+            error = 'lease expired on ' || worker,
+            lease = NULL,
+            updated = ?
+            WHERE state = ? AND lease_expires < ?""",
+            (FAILED, PENDING, now, LEASED, now),
+        )
+
+    def lease(self, worker=None):
+        """Lease the next job, if there is one ready
+
+        worker identifies the worker in the queue's status
+        (default: this host, process and thread).
+        Returns a Job, or None.
+        """
+        now = time.time()
+        lease = uuid4().hex
+        with self._transaction() as db:
+            self._expire_leases(db, now)
+            row = db.execute(
+                "SELECT * FROM jobs WHERE state = ? AND not_before <= ?"
+                " ORDER BY not_before, id LIMIT 1",
+                (PENDING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                """UPDATE jobs SET
+                state = ?, attempts = attempts + 1,
+                worker = ?, lease = ?, lease_expires = ?, updated = ?
+                WHERE id = ?""",
+                (
+                    LEASED,
+                    worker or f"{self.worker_id}-{get_ident()}",
+                    lease,
+                    now + self.lease_seconds,
+                    now,
+                    row["id"],
+                ),
+            )
+        return Job(row["id"], row["repo"], row["ref"], row["attempts"] + 1, lease)
+
+    def _update_leased(self, job, sql, values):
+        """Update a job, if we still hold its lease
+
+        Returns False if the lease has been lost
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                f"UPDATE jobs SET {sql}, updated = ? WHERE id = ? AND lease = ?",
+                tuple(values) + (time.time(), job.id, job.lease),
+            )
+            return cursor.rowcount == 1
+
+    def renew(self, job):
+        """Extend the lease on a job
+
+        Returns False if the lease has been lost
+        (it expired, and the job may have gone to another worker).
+        """
+        return self._update_leased(
+            job, "lease_expires = ?", (time.time() + self.lease_seconds,)
+        )
+
+    def complete(self, job, result_file=None):
+        """Mark a job as done"""
+        if not self._update_leased(
+            job,
+            "state = ?, lease = NULL, result_file = ?, error = NULL",
+            (DONE, result_file),
+        ):
+            log.warning(f"Lost lease on {job.repo}@{job.ref} before it was done")
+
+    def fail(self, job, error):
+        """Record a failed attempt at a job
+
+        The job is retried later, if it has attempts left.
+        """
+        if not self._update_leased(
+            job,
+            """state = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END,
+            not_before = ?, lease = NULL, error = ?""",
+            (FAILED, PENDING, time.time() + self.retry_delay * job.attempts, error),
+        ):
+            log.warning(f"Lost lease on {job.repo}@{job.ref} before it failed")
+
+    def retry_failed(self):
+        """Put failed jobs back in the queue, with their attempts reset
+
+        Returns the number of jobs requeued
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET state = ?, attempts = 0, not_before = 0, updated = ?"
+                " WHERE state = ?",
+                (PENDING, time.time(), FAILED),
+            )
+            return cursor.rowcount
+
+    def counts(self):
+        """The number of jobs in each state"""
+        counts = dict.fromkeys(STATES, 0)
+        with self._lock:
+            for row in self.db.execute(
+                "SELECT state, COUNT(*) AS count FROM jobs GROUP BY state"
+            ):
+                counts[row["state"]] = row["count"]
+        return counts
+
+    def jobs(self, state=None):
+        """All jobs (as dicts), optionally only those in a given state"""
+        sql = "SELECT * FROM jobs"
+        values = ()
+        if state:
+            sql += " WHERE state = ?"
+            values = (state,)
+        with self._lock:
+            return [dict(row) for row in self.db.execute(sql + " ORDER BY id", values)]
+
+
+def _work(job_queue, run_job, poll_interval):
+    """One worker thread: run jobs until the queue is finished
+
+    Errors talking to the queue (e.g. a coordinator restarting) are retried,
+    and jobs whose results couldn't be recorded are run again
+    once their lease expires.
+    """
+    while True:
+        try:
+            job = job_queue.lease()
+            if job is None and not job_queue.unfinished():
+                return
+        except Exception:
+            log.exception("Error leasing a job")
+            job = None
+        if job is None:
+            # wait for retries, or leases held by other workers
+            time.sleep(poll_interval)
+            continue
+        log.info(f"Working on {job.repo}@{job.ref} (attempt {job.attempts})")
+        with job_queue.heartbeat(job):
+            try:
+                try:
+                    result_file = run_job(job)
+                except Exception as e:
+                    log.exception(f"Error checking {job.repo}@{job.ref}")
+                    job_queue.fail(job, f"{type(e).__name__}: {e}")
+                else:
+                    job_queue.complete(job, result_file)
+            except Exception:
+                log.exception(f"Error recording {job.repo}@{job.ref} in the queue")
+
+
+def work(job_queue, run_job, jobs=1, poll_interval=10):
+    """Run jobs from a queue until none are left
+
+    run_job(job) is called for each job, in `jobs` threads at once,
+    and returns the job's result file.
+    Exceptions are failed attempts.
+    Returns when no jobs are pending or leased (by any worker).
+    """
+    threads = [
+        Thread(target=_work, args=(job_queue, run_job, poll_interval), daemon=True)
+        for i in range(max(jobs, 1))
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def main(argv=None):
+    """repo2docker-checker queue: add repos to a queue, check on it, and serve it"""
+    # avoid circular imports: checker runs workers, and coordinator serves queues
+    from .checker import parse_repo_ref
+    from .coordinator import serve
+
+    tornado.log.enable_pretty_logging()
+    logging.getLogger().setLevel(logging.INFO)
+    parser = argparse.ArgumentParser(
+        prog="repo2docker-checker queue",
+        description="Manage a queue of repos to check, shared by several workers",
+    )
+    # --queue is accepted after the action, e.g. `queue add --queue FILE`
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--queue", default="./runs/queue.sqlite", help="The queue database"
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    add_parser = subparsers.add_parser(
+        "add", parents=[common], help="Add repos to the queue"
+    )
+    add_parser.add_argument(
+        "--run-id",
+        default=os.environ.get("RUN_ID"),
+        help="""The run id for all workers, when creating the queue
+        (default: $RUN_ID, or the current time)""",
+    )
+    add_parser.add_argument(
+        "--max-attempts",
+        default=3,
+        type=int,
+        help="Max number of times to try checking each repo",
+    )
+    add_parser.add_argument("repos", nargs="+", help="repos to check")
+    subparsers.add_parser(
+        "status", parents=[common], help="Show the state of the queue"
+    )
+    subparsers.add_parser("retry", parents=[common], help="Retry failed jobs")
+    serve_parser = subparsers.add_parser(
+        "serve",
+        parents=[common],
+        help="Serve the queue to workers on other hosts (see coordinator.py)",
+    )
+    serve_parser.add_argument(
+        "--ip", default="127.0.0.1", help="The IP address to listen on"
+    )
+    serve_parser.add_argument(
+        "--port", default=8765, type=int, help="The port to listen on"
+    )
+    serve_parser.add_argument(
+        "--token",
+        default=os.environ.get("QUEUE_TOKEN"),
+        help="Token workers must send (default: $QUEUE_TOKEN)",
+    )
+    opts = parser.parse_args(argv)
+
+    os.makedirs(os.path.dirname(os.path.abspath(opts.queue)), exist_ok=True)
+    try:
+        job_queue = JobQueue(opts.queue)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        if opts.action == "add":
+            if job_queue.run_id is None:
+                # same default as checker.run_id
+                run_id = opts.run_id or datetime.now().strftime("%Y-%m-%dT%H.%M")
+                job_queue.set_meta("run_id", run_id)
+            elif opts.run_id and opts.run_id != job_queue.run_id:
+                parser.error(
+                    f"{opts.queue} is for run {job_queue.run_id}, not {opts.run_id}"
+                )
+            repo_refs = [parse_repo_ref(repo) for repo in opts.repos]
+            count = job_queue.add(repo_refs, max_attempts=opts.max_attempts)
+            print(f"Added {count} repos to {opts.queue} (run {job_queue.run_id})")
+        elif opts.action == "status":
+            print(f"Queue {opts.queue} for run {job_queue.run_id}:")
+            for state, count in job_queue.counts().items():
+                print(f"  {state}: {count}")
+            for job in job_queue.jobs(LEASED):
+                print(f"  {job['repo']}@{job['ref']} leased by {job['worker']}")
+            for job in job_queue.jobs(FAILED):
+                print(f"  {job['repo']}@{job['ref']} failed: {job['error']}")
+        elif opts.action == "retry":
+            count = job_queue.retry_failed()
+            print(f"Retrying {count} failed repos")
+        elif opts.action == "serve":
+            if job_queue.run_id is None:
+                parser.error(f"Add repos to {opts.queue} before serving it")
+            serve(job_queue, ip=opts.ip, port=opts.port, token=opts.token)
+    finally:
+        job_queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
 import sys
+from subprocess import check_output
 
 import pytest
 
@@ -8,6 +9,55 @@ repo = os.path.abspath(os.path.join(test_dir, os.pardir))
 sys.path.insert(0, repo)
 
 
+@pytest.fixture(autouse=True)
+def image_usage_file(tmpdir, monkeypatch):
+    """Don't record image usage in the user's cache"""
+    from repo2docker_checker import prune
+
+    path = str(tmpdir.join("image-usage.json"))
+    monkeypatch.setattr(prune, "usage_file", path)
+    return path
+
+
 @pytest.fixture
 def here():
     return test_dir
+
+
+def git(*args, cwd=None):
+    """Run a git command with a test identity"""
+    env = dict(os.environ)
+    env.update(
+        {
+            "GIT_AUTHOR_NAME": "test",
+            "GIT_AUTHOR_EMAIL": "test@example.com",
+            "GIT_COMMITTER_NAME": "test",
+            "GIT_COMMITTER_EMAIL": "test@example.com",
+        }
+    )
+    out = check_output(("git",) + args, cwd=cwd, env=env)
+    return out.decode("utf8").strip()
+
+
+def commit_files(repo_path, files, message="commit"):
+    """Write files to a git repo and commit them, return the commit sha"""
+    for name, content in files.items():
+        path = os.path.join(repo_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    git("add", "-A", cwd=repo_path)
+    git("commit", "-m", message, cwd=repo_path)
+    return git("rev-parse", "HEAD", cwd=repo_path)
+
+
+@pytest.fixture
+def git_repo(tmpdir):
+    """A local git repo with one commit on master
+
+    Returns the path to the repo
+    """
+    repo_path = str(tmpdir.mkdir("origin").mkdir("repo"))
+    git("init", "-q", "-b", "master", cwd=repo_path)
+    commit_files(repo_path, {"README.md": "# test\n"}, "initial commit")
+    return repo_path
@@ -0,0 +1,110 @@
+import os
+
+from repo2docker_checker.analysis import analyze
+from repo2docker_checker.analysis import check_environment_yml
+from repo2docker_checker.analysis import check_requirements
+from repo2docker_checker.analysis import INVALID_SPEC
+from repo2docker_checker.analysis import load_package_index
+from repo2docker_checker.analysis import NO_NOTEBOOKS
+from repo2docker_checker.analysis import UNKNOWN_PACKAGE
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_check_requirements(tmpdir):
+    index = {"numpy", "scikit-learn", "matplotlib"}
+    path = str(tmpdir.join("requirements.txt"))
+    write(
+        path,
+        "\n".join(
+            [
+                "# comment",
+                "numpy==1.18",
+                "Scikit_Learn>=0.22  # normalized name",
+                "-r other.txt",
+                "git+https://github.com/org/pkg",
+                "./local",
+                "notapackage",
+                "matplotlib>>3",
+            ]
+        ),
+    )
+    problems = check_requirements(path, index)
+    assert [(reason, message.split(": ")[0]) for reason, message in problems] == [
+        (INVALID_SPEC, f"{path}:8"),
+        (UNKNOWN_PACKAGE, f"{path}:7"),
+    ]
+    # no index, only syntax is checked
+    assert [reason for reason, message in check_requirements(path)] == [INVALID_SPEC]
+    # another index: package names can't be checked
+    write(path, "--extra-index-url https://example.org/simple\nnotapackage\n")
+    assert check_requirements(path, index) == []
+
+
+def test_check_requirements_options(tmpdir):
+    index = {"numpy", "foo", "pandas"}
+    path = str(tmpdir.join("requirements.txt"))
+    write(
+        path,
+        "\n".join(
+            [
+                # hash-pinned, as written by pip-compile --generate-hashes
+                "numpy==1.19.0 \\",
+                "    --hash=sha256:0123456789abcdef \\",
+                "    --hash=sha256:fedcba9876543210",
+                "foo==1.0 --install-option='--prefix=/opt'",
+                "pandas>=1.0 ; python_version >= '3.6' -C key=value",
+                # continuation of a broken requirement
+                "notapackage \\",
+                "    >>1",
+            ]
+        ),
+    )
+    problems = check_requirements(path, index)
+    # reported on the line the requirement starts
+    assert [(reason, message.split(": ")[0]) for reason, message in problems] == [
+        (INVALID_SPEC, f"{path}:6"),
+    ]
+    write(path, "numpy==1.19.0 \\\n    --hash=sha256:0123\nnotapackage\n")
+    assert [
+        message.split(": ")[0] for _, message in check_requirements(path, index)
+    ] == [f"{path}:3"]
+
+
+def test_check_environment_yml(tmpdir):
+    path = str(tmpdir.join("environment.yml"))
+    write(path, "dependencies:\n  - numpy\n")
+    assert check_environment_yml(path) == []
+    write(path, "dependencies:\n  - numpy\n - bad: [indent\n")
+    assert [reason for reason, message in check_environment_yml(path)] == [INVALID_SPEC]
+
+
+def test_load_package_index(tmpdir):
+    path = str(tmpdir.join("index.txt"))
+    write(path, "NumPy\nscikit_learn\n\n")
+    assert load_package_index(path) == {"numpy", "scikit-learn"}
+
+
+def test_analyze(tmpdir):
+    repo = str(tmpdir.mkdir("repo"))
+    write(os.path.join(repo, "binder", "requirements.txt"), "numpy\n")
+    write(os.path.join(repo, "README.md"), "")
+    analysis = analyze(repo, package_index={"numpy"})
+    assert analysis["config_files"] == [os.path.join("binder", "requirements.txt")]
+    assert analysis["problems"] == []
+    assert analysis["reason"] == NO_NOTEBOOKS
+
+    write(os.path.join(repo, "index.ipynb"), "{}")
+    analysis = analyze(repo, package_index={"numpy"})
+    assert analysis["notebooks"] == ["index.ipynb"]
+    assert analysis["reason"] is None
+
+    analysis = analyze(repo, package_index={"pandas"})
+    assert analysis["reason"] == UNKNOWN_PACKAGE
+    assert analysis["problems"] == [
+        (UNKNOWN_PACKAGE, "binder/requirements.txt:1: no such package numpy")
+    ]
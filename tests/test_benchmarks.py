@@ -0,0 +1,41 @@
+import json
+
+from benchmarks import bench_checker
+
+
+def test_bench_checker(tmpdir, capsys):
+    """The benchmarks run (and their fakes still fit the checker)"""
+    args = ["--notebooks", "5", "--build-mb", "1", "--results", "10", "--repeat", "1"]
+    before = str(tmpdir.join("before.json"))
+    bench_checker.main(args + ["-o", before])
+    with open(before) as f:
+        results = json.load(f)
+    assert results["params"]["notebooks"] == 5
+    assert set(results["benchmarks"]) == {
+        "clone_repo_cold",
+        "clone_repo_cached",
+        "build_image",
+        "find_notebooks_git",
+        "find_notebooks_walk",
+        "run_tests_batch",
+        "run_tests_each",
+        "results_csv",
+        "results_sqlite",
+    }
+    bench_checker.main(args + ["--compare", before, "--threshold", "1000"])
+    assert "Compared to" in capsys.readouterr().err
+
+
+def test_compare():
+    def result(**seconds):
+        return {
+            "version": bench_checker.VERSION,
+            "params": {},
+            "benchmarks": {k: {"seconds": v} for k, v in seconds.items()},
+        }
+
+    rows = bench_checker.compare(result(a=1, b=1), result(a=1.1, b=2, c=1))
+    assert [(name, regressed) for name, *_, regressed in rows] == [
+        ("a", False),
+        ("b", True),
+    ]
@@ -0,0 +1,244 @@
+import os
+
+from repo2docker_checker import buildcache
+from repo2docker_checker.buildcache import env_hash
+from repo2docker_checker.logstream import LogWriter
+
+
+def write(path, content=""):
+    with path.open("w") as f:
+        f.write(content)
+
+
+def test_env_hash(tmpdir, monkeypatch):
+    repo = tmpdir.mkdir("repo")
+    write(repo.join("requirements.txt"), "numpy\n")
+    write(repo.join("a.ipynb"), "{}")
+    before = env_hash(str(repo))
+    assert before
+
+    # notebooks don't affect the environment
+    write(repo.join("a.ipynb"), '{"cells": []}')
+    write(repo.join("b.ipynb"), "{}")
+    assert env_hash(str(repo)) == before
+
+    # config files do
+    write(repo.join("requirements.txt"), "numpy==1.19\n")
+    changed = env_hash(str(repo))
+    assert changed != before
+
+    # start only runs if executable
+    write(repo.join("start"), "exec $@")
+    not_executable = env_hash(str(repo))
+    assert not_executable != changed
+    os.chmod(repo.join("start"), 0o755)
+    assert env_hash(str(repo)) != not_executable
+
+    # so does the repo2docker version
+    before = env_hash(str(repo))
+    monkeypatch.setattr(buildcache.repo2docker, "__version__", "0.0.0")
+    assert env_hash(str(repo)) != before
+
+
+def test_env_hash_binder_dir(tmpdir):
+    repo = tmpdir.mkdir("repo")
+    write(repo.join("requirements.txt"), "numpy\n")
+    before = env_hash(str(repo))
+    binder = repo.mkdir("binder")
+    write(binder.join("requirements.txt"), "numpy\n")
+    in_binder = env_hash(str(repo))
+    assert in_binder != before
+    # files outside binder/ are ignored
+    write(repo.join("requirements.txt"), "scipy\n")
+    assert env_hash(str(repo)) == in_binder
+    # except a package in the root, which may be installed from binder/
+    write(repo.join("setup.py"), "")
+    assert env_hash(str(repo)) is None
+
+
+def test_env_hash_whole_repo(tmpdir):
+    repo = tmpdir.mkdir("repo")
+    write(repo.join("requirements.txt"), "numpy\n")
+    write(repo.join("setup.py"), "")
+    assert env_hash(str(repo)) is None
+
+
+def test_env_hash_postbuild(tmpdir):
+    repo = tmpdir.mkdir("repo")
+    write(repo.join("requirements.txt"), "numpy\n")
+    # postBuild can install anything from the repo, e.g. `pip install ./mypkg`
+    write(repo.join("postBuild"), "pip install ./mypkg\n")
+    assert env_hash(str(repo)) is None
+
+
+def test_env_hash_local_requirements(tmpdir):
+    repo = tmpdir.mkdir("repo")
+    binder = repo.mkdir("binder")
+    for requirements in ["-e ..", ".", "./mypkg", "numpy\n--editable=../pkg"]:
+        write(binder.join("requirements.txt"), requirements + "\n")
+        assert env_hash(str(repo)) is None, requirements
+    write(binder.join("requirements.txt"), "-e git+https://github.com/org/pkg\n")
+    assert env_hash(str(repo))
+    write(binder.join("environment.yml"), "dependencies:\n  - pip:\n    - -e ..\n")
+    assert env_hash(str(repo)) is None
+    binder.join("environment.yml").remove()
+
+    # included files are part of the environment
+    write(binder.join("requirements.txt"), "-r ../requirements-base.txt\nscipy\n")
+    write(repo.join("requirements-base.txt"), "numpy\n")
+    before = env_hash(str(repo))
+    assert before
+    write(repo.join("requirements-base.txt"), "numpy==1.19\n")
+    assert env_hash(str(repo)) != before
+    # including files that install from the repo
+    write(repo.join("requirements-base.txt"), "-c constraints.txt\n")
+    write(repo.join("constraints.txt"), "./pkg\n")
+    assert env_hash(str(repo)) is None
+
+
+def test_detect_base(tmpdir):
+    repo = tmpdir.mkdir("repo")
+    # default buildpack
+    assert buildcache.detect_base(str(repo)) == ("python", "")
+    write(repo.join("requirements.txt"), "numpy\n")
+    write(repo.join("runtime.txt"), "python-3.8\n")
+    assert buildcache.detect_base(str(repo)) == ("python", "3.8")
+    write(repo.join("Pipfile"), "")
+    assert buildcache.detect_base(str(repo)) == ("pipfile", "3.8")
+    write(repo.join("environment.yml"), "dependencies:\n  - python=3.9.1\n  - numpy\n")
+    assert buildcache.detect_base(str(repo)) == ("conda", "3.9")
+    write(repo.join("environment.yml"), "dependencies:\n  - numpy\n")
+    assert buildcache.detect_base(str(repo)) == ("conda", "")
+    # config in binder/ takes precedence
+    binder = repo.mkdir("binder")
+    write(binder.join("runtime.txt"), "r-2020-07-01\n")
+    assert buildcache.detect_base(str(repo)) is None
+    binder.join("runtime.txt").remove()
+    write(binder.join("Dockerfile"), "FROM python\n")
+    assert buildcache.detect_base(str(repo)) is None
+
+
+def test_detect_buildpack(tmpdir):
+    repo = tmpdir.mkdir("repo")
+    assert buildcache.detect_buildpack(str(repo)) == "python"
+    # in repo2docker's order of detection
+    for name, buildpack in [
+        ("Pipfile.lock", "pipfile"),
+        ("environment.yml", "conda"),
+        ("install.R", "r"),
+        ("default.nix", "nix"),
+        ("Project.toml", "julia"),
+        ("Dockerfile", "docker"),
+    ]:
+        write(repo.join(name))
+        assert buildcache.detect_buildpack(str(repo)) == buildpack
+
+
+def test_base_image_id(monkeypatch):
+    monkeypatch.setattr(buildcache.repo2docker, "__version__", "2023.06.0+12.gabc")
+    assert (
+        buildcache.base_image_id(("conda", "3.9"))
+        == "r2d-base-conda-py3.9:2023.06.0-12.gabc"
+    )
+    assert buildcache.base_image_id(("python", "")).startswith(
+        "r2d-base-python-pydefault:"
+    )
+
+
+def test_base_repo_files(tmpdir):
+    for base in [
+        ("conda", "3.9"),
+        ("conda", ""),
+        ("pipfile", "3.8"),
+        ("python", ""),
+        ("python", "3.10"),
+    ]:
+        repo = tmpdir.mkdir("-".join(base) or "default")
+        for name, content in buildcache.base_repo_files(base).items():
+            write(repo.join(name), content)
+        # the minimal repo has the same base
+        assert buildcache.detect_base(str(repo)) == base
+
+
+class FakeImage:
+    def __init__(self, layers, sizes):
+        self.attrs = {"RootFS": {"Layers": layers}, "Size": sum(sizes)}
+        # newest first, with steps that add no layer
+        nop = {"CreatedBy": "/bin/sh -c #(nop)  ENV X=1", "Size": 0}
+        self._history = [nop]
+        for size in sizes:
+            self._history.insert(0, {"CreatedBy": "/bin/sh -c step", "Size": size})
+            self._history.insert(0, nop)
+
+    def history(self):
+        return self._history
+
+
+class FakeImages:
+    def __init__(self, images):
+        self._images = images
+
+    def get(self, image_id):
+        return self._images[image_id]
+
+
+class FakeDocker:
+    def __init__(self, images):
+        self.images = FakeImages(images)
+
+
+def test_layer_reuse():
+    client = FakeDocker(
+        {
+            "base": FakeImage(["a", "b", "c"], [10, 20, 5]),
+            "image": FakeImage(["a", "b", "x", "y"], [10, 20, 30, 40]),
+        }
+    )
+    assert buildcache.layer_reuse(client, "image", "base") == {
+        "base_layers": 2,
+        "layers": 4,
+        "base_bytes": 30,
+        "bytes": 100,
+    }
+    # layers that add no bytes still count
+    client = FakeDocker(
+        {
+            "base": FakeImage(["a", "b", "c"], [10, 0, 5]),
+            "image": FakeImage(["a", "b", "x", "y"], [10, 0, 30, 40]),
+        }
+    )
+    assert buildcache.layer_reuse(client, "image", "base") == {
+        "base_layers": 2,
+        "layers": 4,
+        "base_bytes": 10,
+        "bytes": 80,
+    }
+
+
+class FakeBuildAPI:
+    def __init__(self):
+        self.dockerfiles = []
+
+    def build(self, path, dockerfile, tag, **kw):
+        with open(dockerfile) as f:
+            self.dockerfiles.append(f.read())
+        yield {"stream": f"Successfully tagged {tag}\n"}
+
+
+def test_overlay_image(tmpdir):
+    client = FakeDocker({"env": FakeImage([], [])})
+    client.images.get("env").attrs["Config"] = {
+        "WorkingDir": "/home/jovyan",
+        "User": "1000",
+    }
+    client.api = FakeBuildAPI()
+    log_file = tmpdir.join("build.txt")
+    with LogWriter(str(log_file), echo=False) as log_w:
+        buildcache.overlay_image(client, "env", str(tmpdir), "image", log_w)
+    [dockerfile] = client.api.dockerfiles
+    lines = dockerfile.splitlines()
+    assert lines[0] == "FROM env"
+    # the earlier commit's files are removed before copying the new ones
+    assert lines[1].startswith("RUN find /home/jovyan -mindepth 1 -maxdepth 1")
+    assert lines[2] == "COPY --chown=1000 . /home/jovyan"
+    assert "Successfully tagged image" in log_file.read()
@@ -1,9 +1,22 @@
+import json
+import os
+import threading
+import time
+
 import pytest
+from conftest import git
 
+from repo2docker_checker import checker
+from repo2docker_checker import inrepo
+from repo2docker_checker import testcache
+from repo2docker_checker.buildcache import env_hash
 from repo2docker_checker.checker import build_repo
 from repo2docker_checker.checker import clone_repo
 from repo2docker_checker.checker import find_notebooks
 from repo2docker_checker.checker import main
+from repo2docker_checker.checker import remove_checkout
+from repo2docker_checker.gitcache import GitCache
+from repo2docker_checker.logstream import open_log
 
 example_repo_short = "binder-examples/requirements"
 example_repo = f"https://github.com/{example_repo_short}"
@@ -79,3 +92,710 @@ def test_find_notebooks(tmpdir):
 
     notebooks = sorted(find_notebooks(str(repo)))
     assert notebooks == [path.relto(repo) for path in (nb1, nb2)]
+
+
+def test_main_jobs(monkeypatch, tmpdir, capsys):
+    lock = threading.Lock()
+    active = {"clone": 0, "build": 0}
+    peak = {"clone": 0, "build": 0}
+    checked = []
+
+    def fake_test_one_repo(repo, ref, run_dir, force_build):
+        for stage_name in ("clone", "build"):
+            with checker.stage(stage_name):
+                with lock:
+                    active[stage_name] += 1
+                    peak[stage_name] = max(peak[stage_name], active[stage_name])
+                time.sleep(0.05)
+                with lock:
+                    active[stage_name] -= 1
+        checked.append((repo, ref))
+        result = checker.TestResult(
+            repo, ref, ref, "", "build", "build", False, "build.txt", "", "", ""
+        )
+        return f"{repo}-{ref}.csv", [result]
+
+    monkeypatch.setattr(checker, "test_one_repo", fake_test_one_repo)
+    pruned = []
+    monkeypatch.setattr(checker, "_prune_images", lambda *args: pruned.append(args))
+    removed = []
+    monkeypatch.setattr(
+        checker, "_remove_orphaned_containers", lambda: removed.append(True)
+    )
+    repos = [f"org/repo{i}@ref" for i in range(6)]
+    checker.main(
+        ["--run-dir", str(tmpdir), "-j", "4", "--build-jobs", "2"] + repos + [repos[0]]
+    )
+    # duplicates are only checked once
+    assert sorted(checked) == [
+        (f"https://github.com/org/repo{i}", "ref") for i in range(6)
+    ]
+    assert 1 < peak["clone"] <= 4
+    assert 1 < peak["build"] <= 2
+    out = capsys.readouterr().out
+    assert out.count("Build failed") == 6
+    # orphaned containers are removed after each repo,
+    # images only pruned with --max-image-bytes
+    assert len(removed) == 6
+    assert pruned == []
+    checker.main(["--run-dir", str(tmpdir), "--max-image-bytes", "10G", repos[0]])
+    assert pruned == [(10 * 1024**3, "lru")]
+
+
+def test_main_queue(monkeypatch, tmpdir, capsys):
+    monkeypatch.setattr(checker, "run_id", checker.run_id)
+    queue_dir = tmpdir.join("shared")
+    queue = str(queue_dir.join("queue.sqlite"))
+    repos = [f"org/repo{i}@ref" for i in range(4)]
+    main(["queue", "add", "--queue", queue, "--run-id", "queue-run"] + repos)
+
+    def fake_test_one_repo(repo, ref, run_dir, force_build):
+        repo_run_dir = os.path.join(run_dir, checker.repo_slug(repo))
+        result_file = os.path.join(
+            repo_run_dir, "results", f"results-{ref}-{checker.run_id}.csv"
+        )
+        os.makedirs(os.path.dirname(result_file))
+        os.makedirs(os.path.join(repo_run_dir, "logs"))
+        with open(os.path.join(repo_run_dir, "logs", "build.txt"), "w") as f:
+            f.write("build log")
+        result = checker.TestResult(
+            repo, ref, ref, "", "build", "build", False, "build.txt", "", "", ""
+        )
+        with checker.CSVResults(result_file) as csv_results:
+            csv_results.add(result)
+        return result_file, [result]
+
+    monkeypatch.setattr(checker, "test_one_repo", fake_test_one_repo)
+    monkeypatch.setattr(checker, "_remove_orphaned_containers", lambda: None)
+    worker_dir = tmpdir.join("worker")
+    main(["--queue", queue, "--run-dir", str(worker_dir), "-j", "2"])
+    assert checker.run_id == "queue-run"
+    out = capsys.readouterr().out
+    assert out.count("Build failed") == 4
+    # results and logs are pushed to the queue's directory
+    for i in range(4):
+        repo_dir = queue_dir.join("github.com", "org", f"repo{i}")
+        assert repo_dir.join("logs", "build.txt").read() == "build log"
+        assert repo_dir.join("results", "results-ref-queue-run.csv").exists()
+    db = checker.SQLiteResults(str(queue_dir.join("results.sqlite")))
+    assert len(list(db.query(run_id="queue-run"))) == 0
+    assert len(list(db.query(kind="build"))) == 4
+    db.close()
+
+
+def test_run_tests_parallel(monkeypatch, tmpdir):
+    notebooks = [f"nb{i}.ipynb" for i in range(5)]
+    monkeypatch.setattr(checker, "find_notebooks", lambda path, **kw: iter(notebooks))
+    monkeypatch.setattr(checker, "test_parallel", 2)
+    monkeypatch.setattr(checker, "tests_per_container", 1)
+    monkeypatch.setattr(checker, "_test_slots", None)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def fake_run_one_test(image, kind, argument, run_dir, log_file):
+        with lock:
+            running.append(argument)
+            peak.append(len(running))
+        # finish in reverse order
+        time.sleep(0.1 * (5 - notebooks.index(argument)) / 5)
+        with lock:
+            running.remove(argument)
+        if argument == "nb3.ipynb":
+            raise RuntimeError("oops")
+        return {"kind": kind, "success": True, "test_id": argument, "path": log_file}
+
+    monkeypatch.setattr(checker, "run_one_test", fake_run_one_test)
+    results = list(checker.run_tests("image", str(tmpdir), str(tmpdir)))
+    assert [r["test_id"] for r in results] == notebooks[: checker.notebook_limit]
+    assert [r["success"] for r in results] == [True, True, True, False, True]
+    assert max(peak) == 2
+
+
+def test_run_tests_retry(monkeypatch, tmpdir):
+    notebooks = ["flaky.ipynb", "broken.ipynb", "ok.ipynb"]
+    monkeypatch.setattr(checker, "find_notebooks", lambda path, **kw: iter(notebooks))
+    monkeypatch.setattr(checker, "test_parallel", 1)
+    monkeypatch.setattr(checker, "tests_per_container", 1)
+    monkeypatch.setattr(checker, "_test_slots", None)
+    ran = []
+
+    def fake_run_one_test(image, kind, argument, run_dir, log_file):
+        ran.append(argument)
+        success = argument == "ok.ipynb" or ran.count(argument) > 1
+        with open(log_file, "w") as f:
+            if argument == "broken.ipynb":
+                f.write("ERROR: No matching distribution found for nosuchpkg\n")
+            elif not success:
+                f.write("socket.gaierror: Temporary failure in name resolution\n")
+        return {"kind": kind, "success": success, "test_id": argument, "path": log_file}
+
+    monkeypatch.setattr(checker, "run_one_test", fake_run_one_test)
+    monkeypatch.setattr(checker, "_stage_semaphores", {})
+    checker.set_stage_limits(test=1)
+    waited = []
+
+    def fake_wait_to_retry(what, attempt):
+        # nothing is held while waiting to retry
+        assert checker._stage_semaphores["test"].acquire(blocking=False)
+        checker._stage_semaphores["test"].release()
+        assert checker.test_slots().acquire(blocking=False)
+        checker.test_slots().release()
+        waited.append(attempt)
+
+    monkeypatch.setattr(checker, "wait_to_retry", fake_wait_to_retry)
+    tmpdir.mkdir("logs")
+    results = list(checker.run_tests("image", str(tmpdir), str(tmpdir)))
+    assert waited == [1]
+    assert sorted(ran) == sorted(notebooks + ["flaky.ipynb"])
+    assert [(r["test_id"], r["success"], r["failure_reason"]) for r in results] == [
+        ("broken.ipynb", False, "no-distribution"),
+        ("ok.ipynb", True, ""),
+        ("flaky.ipynb", True, ""),
+    ]
+
+
+def test_run_tests_cached(monkeypatch, tmpdir):
+    checkout = tmpdir.mkdir("repo")
+    checkout.join("requirements.txt").write("numpy\n")
+    notebooks = ["a.ipynb", "b.ipynb", "c.ipynb"]
+    for nb_path in notebooks:
+        checkout.join(nb_path).write("{}")
+    git("init", "-q", cwd=str(checkout))
+
+    def commit():
+        git("add", "-A", cwd=str(checkout))
+        git("commit", "-q", "--allow-empty", "-m", "commit", cwd=str(checkout))
+
+    commit()
+    run_dir = tmpdir.mkdir("runs")
+    run_dir.mkdir("logs")
+    cache = testcache.TestCache(str(run_dir.join("test-cache.sqlite")))
+    monkeypatch.setattr(checker, "find_notebooks", lambda path, **kw: iter(notebooks))
+    monkeypatch.setattr(checker, "test_parallel", 1)
+    monkeypatch.setattr(checker, "tests_per_container", 1)
+    monkeypatch.setattr(checker, "_test_slots", None)
+    monkeypatch.setattr(checker, "retries", 0)
+    monkeypatch.setattr(checker, "test_cache", cache)
+    ran = []
+
+    def fake_run_one_test(image, kind, argument, run_dir, log_file):
+        ran.append(argument)
+        with open(log_file, "w") as f:
+            f.write("ok")
+        success = argument != "c.ipynb"
+        return {"kind": kind, "success": success, "test_id": argument, "path": log_file}
+
+    def run_tests():
+        ran[:] = []
+        return list(
+            checker.run_tests("image", str(checkout), str(run_dir), repo="repo")
+        )
+
+    monkeypatch.setattr(checker, "run_one_test", fake_run_one_test)
+    first = run_tests()
+    assert sorted(ran) == notebooks
+
+    # a new run: only tests that failed or changed are run again
+    monkeypatch.setattr(checker, "run_id", "run2")
+    checkout.join("b.ipynb").write('{"cells": []}')
+    commit()
+    results = run_tests()
+    assert sorted(ran) == ["b.ipynb", "c.ipynb"]
+    assert [(r["test_id"], r.get("cache", "")) for r in results] == [
+        ("a.ipynb", "result"),
+        ("b.ipynb", ""),
+        ("c.ipynb", ""),
+    ]
+    # pointing to the log of the run where it passed
+    assert results[0]["path"] == first[0]["path"]
+
+    monkeypatch.setattr(checker, "force_tests", True)
+    run_tests()
+    assert sorted(ran) == notebooks
+    monkeypatch.setattr(checker, "force_tests", False)
+    # a change to other files in the repo invalidates everything
+    checkout.join("data.csv").write("a,b\n")
+    commit()
+    run_tests()
+    assert sorted(ran) == notebooks
+    # as does a changed environment
+    checkout.join("requirements.txt").write("numpy==1.19\n")
+    commit()
+    run_tests()
+    assert sorted(ran) == notebooks
+    # as does one that may depend on anything in the repo
+    checkout.join("postBuild").write("pip install ./mypkg\n")
+    commit()
+    run_tests()
+    assert sorted(ran) == notebooks
+    checkout.join("postBuild").write("pip install ./otherpkg\n")
+    commit()
+    results = run_tests()
+    assert sorted(ran) == notebooks
+    assert not any(r.get("cache") for r in results)
+    cache.close()
+
+
+def test_run_one_test_output_limit(monkeypatch, tmpdir):
+    monkeypatch.setattr(checker, "test_output_limit", 1000)
+    monkeypatch.setattr(checker, "quiet", True)
+    tmpdir.mkdir("logs")
+
+    def fake_run_container(image, args, run_dir, log_w):
+        if args[1] == "quiet.ipynb":
+            log_w.write("ModuleNotFoundError: No module named 'x'\n")
+            return {"StatusCode": 1}
+        while True:
+            log_w.write("spam\n")
+
+    monkeypatch.setattr(checker, "_run_container", fake_run_container)
+    log_file = checker.test_log_file(str(tmpdir), "notebook", "spam.ipynb")
+    result = checker.run_one_test(
+        "image", "notebook", "spam.ipynb", str(tmpdir), log_file
+    )
+    assert not result["success"]
+    assert result["failure_reason"] == "output-limit"
+    with open(log_file) as f:
+        log = f.read()
+    assert log.startswith("spam\n")
+    assert log.endswith("Output limit of 1000 bytes exceeded, container killed\n")
+
+    result = checker.run_one_test(
+        "image", "notebook", "quiet.ipynb", str(tmpdir), log_file
+    )
+    assert result["failure_reason"] == "unknown"
+
+
+def test_test_slots(monkeypatch):
+    class FakeDocker:
+        def info(self):
+            return {"NCPU": 8, "MemTotal": 5 * 1024**3}
+
+    monkeypatch.setattr(checker, "docker_client", FakeDocker)
+    monkeypatch.setattr(checker, "test_parallel", 0)
+    monkeypatch.setattr(checker, "test_mem_limit", "2G")
+    monkeypatch.setattr(checker, "test_cpus", 1)
+    monkeypatch.setattr(checker, "_test_slots", None)
+    # memory-bound
+    assert checker.test_slots()._initial_value == 2
+    monkeypatch.setattr(checker, "test_mem_limit", "")
+    monkeypatch.setattr(checker, "test_cpus", 2)
+    monkeypatch.setattr(checker, "_test_slots", None)
+    # cpu-bound
+    assert checker.test_slots()._initial_value == 4
+
+
+@pytest.mark.parametrize("compress_logs", [False, True])
+def test_run_batch(monkeypatch, tmpdir, compress_logs):
+    monkeypatch.setattr(checker, "compress_logs", compress_logs)
+    run_dir = tmpdir.mkdir("run")
+    run_dir.mkdir("logs")
+
+    def fake_run_container(image, args, run_dir, log_w):
+        # run inrepo's batch mode in-process with run_dir as /io
+        kind, manifest = args
+        assert kind == "batch"
+        manifest = manifest.replace("/io", run_dir, 1)
+        with open(manifest) as f:
+            tests = json.load(f)
+        # skip the last test, as if the container died
+        with open(manifest, "w") as f:
+            json.dump(tests[:-1], f)
+        inrepo.run_batch(manifest, run_dir)
+        log_w.write("container output\n")
+        return {"StatusCode": 0}
+
+    monkeypatch.setattr(checker, "_run_container", fake_run_container)
+    tests = [("import", "os"), ("import", "nosuchmod"), ("import", "crash")]
+    log_files = [checker.test_log_file(str(run_dir), *test) for test in tests]
+    results = checker.run_batch("image", tests, str(run_dir), log_files)
+    assert [r["test_id"] for r in results] == ["os", "nosuchmod", "crash"]
+    assert [r["success"] for r in results] == [True, False, False]
+    assert [r["path"] for r in results] == log_files
+    assert all(path.endswith(".gz") == compress_logs for path in log_files)
+    with open_log(log_files[1], "r") as f:
+        assert "No module named 'nosuchmod'" in f.read()
+    with open_log(log_files[2], "r") as f:
+        assert f.read() == "container output\n"
+    # the container's output is kept with the test logs
+    container_logs = [
+        name for name in os.listdir(run_dir.join("logs")) if "test-batch-" in name
+    ]
+    assert len(container_logs) == 1
+    with open_log(str(run_dir.join("logs", container_logs[0])), "r") as f:
+        assert f.read() == "container output\n"
+    with open_log(log_files[0], "r") as f:
+        assert f.read().endswith(f" is in {container_logs[0]}\n")
+    # batch dir is cleaned up
+    assert run_dir.join("batch").listdir() == []
+
+
+def test_run_batch_output_limit(monkeypatch, tmpdir):
+    monkeypatch.setattr(checker, "test_output_limit", 1000)
+    monkeypatch.setattr(checker, "quiet", True)
+    run_dir = tmpdir.mkdir("run")
+    run_dir.mkdir("logs")
+    batches = []
+
+    def fake_run_container(image, args, run_dir, log_w):
+        manifest = args[1].replace("/io", run_dir, 1)
+        batch_dir = os.path.dirname(manifest)
+        with open(manifest) as f:
+            tests = json.load(f)
+        batches.append([argument for kind, argument in tests])
+        for i, (kind, argument) in enumerate(tests):
+            # spam is over the limit for one test, but not for the whole batch
+            log_w.write(f"{argument}\n" * (240 if argument == "spam" else 450))
+            with open(os.path.join(batch_dir, f"{i}.log"), "w") as f:
+                f.write(f"{argument} ok\n")
+            with open(os.path.join(batch_dir, "results.jsonl"), "a") as f:
+                record = {"index": i, "success": True, "log": f"{i}.log"}
+                f.write(json.dumps(record) + "\n")
+        return {"StatusCode": 0}
+
+    monkeypatch.setattr(checker, "_run_container", fake_run_container)
+    tests = [("notebook", "a"), ("notebook", "spam"), ("notebook", "b")]
+    log_files = [checker.test_log_file(str(run_dir), *test) for test in tests]
+    results = checker.run_batch("image", tests, str(run_dir), log_files)
+    assert [r["test_id"] for r in results] == ["a", "spam", "b"]
+    assert [r["success"] for r in results] == [True, False, True]
+    assert [r.get("failure_reason") for r in results] == [None, "output-limit", None]
+    # only the tests that didn't run are run again
+    assert batches == [["a", "spam", "b"], ["b"]]
+    with open(log_files[1]) as f:
+        assert f.read().endswith("container killed\n")
+
+
+def test_clone_local(monkeypatch, tmpdir, git_repo):
+    monkeypatch.setattr(checker, "git_cache", GitCache(str(tmpdir.join("cache"))))
+    checkout_path, resolved_ref, timestamp = clone_repo(f"file://{git_repo}", "master")
+    assert checkout_path.endswith(git_repo)
+    assert git("rev-parse", "HEAD", cwd=git_repo).startswith(resolved_ref)
+    assert len(resolved_ref) == 7
+    assert timestamp == git(
+        "log", "-1", "--date=iso-strict", "--format=%ad", cwd=git_repo
+    )
+    remove_checkout(checkout_path)
+    assert not os.path.exists(checkout_path)
+
+
+class FakeImage:
+    def __init__(self, images, image_id):
+        self.images = images
+        self.id = image_id
+
+    def tag(self, repository, tag):
+        self.images[f"{repository}:{tag}"] = self
+
+
+class FakeImages(dict):
+    def get(self, image_id):
+        if image_id not in self:
+            raise checker.docker.errors.ImageNotFound(image_id)
+        return self[image_id]
+
+
+class FakeDocker:
+    def __init__(self):
+        self.images = FakeImages()
+
+
+def test_build_image_env_cache(monkeypatch, tmpdir):
+    d = FakeDocker()
+    monkeypatch.setattr(checker, "docker_client", lambda: d)
+    built = []
+
+    def fake_run(cmd, **kwargs):
+        image_id = cmd[-2]
+        d.images[image_id] = FakeImage(d.images, image_id)
+        built.append(image_id)
+
+    def fake_overlay(client, base_image_id, checkout_path, image_id, log_w):
+        d.images[image_id] = FakeImage(d.images, image_id)
+        built.append(f"{base_image_id}->{image_id}")
+
+    monkeypatch.setattr(checker, "run", fake_run)
+    monkeypatch.setattr(checker, "overlay_image", fake_overlay)
+
+    repo = "https://github.com/org/repo"
+    checkout = tmpdir.mkdir("repo")
+    with checkout.join("requirements.txt").open("w") as f:
+        f.write("numpy")
+    log_file = str(tmpdir.join("build.txt"))
+
+    image_id, cache = checker.build_image(repo, "aaaaaaa", str(checkout), log_file)
+    assert cache == "miss"
+    assert built == [image_id]
+    env_image_id = checker.make_image_id(repo, f"env-{env_hash(str(checkout))}")
+    assert env_image_id in d.images
+
+    image_id, cache = checker.build_image(repo, "aaaaaaa", str(checkout), log_file)
+    assert cache == "image"
+
+    # new commit, same environment
+    with checkout.join("new.ipynb").open("w") as f:
+        f.write("{}")
+    image_id, cache = checker.build_image(repo, "bbbbbbb", str(checkout), log_file)
+    assert cache == "env"
+    assert built[-1] == f"{env_image_id}->{image_id}"
+
+    # new environment
+    with checkout.join("requirements.txt").open("w") as f:
+        f.write("scipy")
+    image_id, cache = checker.build_image(repo, "ccccccc", str(checkout), log_file)
+    assert cache == "miss"
+    assert built[-1] == image_id
+
+
+class Crash(BaseException):
+    """Like KeyboardInterrupt, not caught as a test failure"""
+
+
+def test_resume(monkeypatch, tmpdir):
+    run_dir = str(tmpdir.join("runs"))
+    notebooks = ["a.ipynb", "b.ipynb", "c.ipynb"]
+    monkeypatch.setattr(checker, "run_id", "resume-test")
+    monkeypatch.setattr(checker, "results_db", None)
+    monkeypatch.setattr(checker, "find_notebooks", lambda path, **kw: iter(notebooks))
+    monkeypatch.setattr(checker, "remove_checkout", lambda path: None)
+    monkeypatch.setattr(checker, "analyze", lambda path, **kw: {"reason": None})
+    monkeypatch.setattr(checker, "_test_slots", None)
+    monkeypatch.setattr(checker, "test_parallel", 1)
+    monkeypatch.setattr(checker, "tests_per_container", 1)
+    calls = []
+    crashed = []
+
+    def fake_clone_repo(repo, ref):
+        calls.append("clone")
+        return str(tmpdir), "abc1234", "2020-01-01T00:00:00"
+
+    def fake_build_image(repo, resolved_ref, checkout_path, build_log_file, **kw):
+        calls.append("build")
+        return "r2d-test-image", "miss"
+
+    def fake_run_one_test(image, kind, argument, run_dir, log_file):
+        if argument == "b.ipynb" and not crashed:
+            crashed.append(argument)
+            raise Crash()
+        calls.append(argument)
+        return {"kind": kind, "success": True, "test_id": argument, "path": log_file}
+
+    monkeypatch.setattr(checker, "clone_repo", fake_clone_repo)
+    monkeypatch.setattr(checker, "build_image", fake_build_image)
+    monkeypatch.setattr(checker, "run_one_test", fake_run_one_test)
+
+    repo = "https://example.org/org/repo"
+    with pytest.raises(Crash):
+        checker.test_one_repo(repo, run_dir=run_dir)
+    # c.ipynb may run concurrently, but its result is not recorded
+    assert calls[:3] == ["clone", "build", "a.ipynb"]
+    assert crashed
+
+    # resume: a.ipynb and the build result are kept, not recorded again
+    calls[:] = []
+    result_file, results = checker.test_one_repo(repo, run_dir=run_dir)
+    assert calls == ["clone", "build", "b.ipynb", "c.ipynb"]
+    assert [(r.kind, r.test_id) for r in results] == [
+        ("build", "build"),
+        ("notebook", "a.ipynb"),
+        ("notebook", "b.ipynb"),
+        ("notebook", "c.ipynb"),
+    ]
+    assert list(checker.read_csv(result_file)) == results
+
+    # done: nothing is run again
+    calls[:] = []
+    result_file, results2 = checker.test_one_repo(repo, run_dir=run_dir)
+    assert calls == []
+    assert results2 == results
+
+
+def test_slowest_cells(monkeypatch, tmpdir, capsys):
+    monkeypatch.setattr(checker, "run_id", "run2")
+    repo_run_dir = tmpdir.mkdir("repo")
+    profiles = repo_run_dir.mkdir("profiles")
+    for run_id, nb_path, durations in [
+        ("run2", "a.ipynb", [1, 5]),
+        ("run2", "sub/b.ipynb", [3, 0.5, 7]),
+        # not run in this run, e.g. carried forward
+        ("run1", "c.ipynb", [10]),
+    ]:
+        cells = [
+            {"index": i, "duration": d, "busy": None, "status": "ok"}
+            for i, d in enumerate(durations)
+        ]
+        profile = profiles.join(run_id, nb_path + ".json")
+        profile.dirpath().ensure(dir=True)
+        with profile.open("w") as f:
+            json.dump({"notebook": nb_path, "cells": cells}, f)
+    cells = checker.slowest_cells(
+        str(repo_run_dir),
+        ["a.ipynb", "sub/b.ipynb", "c.ipynb", "missing.ipynb"],
+        n=3,
+    )
+    assert [(nb, cell["index"]) for nb, cell in cells] == [
+        ("sub/b.ipynb", 2),
+        ("a.ipynb", 1),
+        ("sub/b.ipynb", 0),
+    ]
+
+
+def test_untestable_not_built(monkeypatch, tmpdir, capsys):
+    run_dir = str(tmpdir.join("runs"))
+    checkout = tmpdir.mkdir("checkout")
+    checkout.join("README.md").write("")
+    monkeypatch.setattr(checker, "run_id", "untestable")
+    monkeypatch.setattr(checker, "results_db", None)
+    monkeypatch.setattr(checker, "remove_checkout", lambda path: None)
+    monkeypatch.setattr(
+        checker,
+        "clone_repo",
+        lambda repo, ref: (str(checkout), "abc1234", "2020-01-01T00:00:00"),
+    )
+    built = []
+
+    def fake_build_image(repo, resolved_ref, checkout_path, build_log_file, **kw):
+        built.append(repo)
+        return "r2d-test-image", "miss"
+
+    monkeypatch.setattr(checker, "build_image", fake_build_image)
+
+    repo = "https://example.org/org/repo"
+    result_file, results = checker.test_one_repo(repo, run_dir=run_dir)
+    assert built == []
+    assert [(r.kind, r.test_id, r.success) for r in results] == [
+        ("analysis", "no-notebooks", False)
+    ]
+    with open(os.path.join(run_dir, results[0].path)) as f:
+        assert json.load(f)["reason"] == "no-notebooks"
+    checker.print_summary(results, result_file, run_dir)
+    out = capsys.readouterr().out
+    assert "Can't be tested (no-notebooks)" in out
+    assert "Not built" in out
+
+    # opt in to building anyway
+    monkeypatch.setattr(checker, "run_id", "build-anyway")
+    monkeypatch.setattr(checker, "build_untestable", True)
+    result_file, results = checker.test_one_repo(repo, run_dir=run_dir)
+    assert built == [repo]
+    assert [(r.kind, r.success) for r in results] == [
+        ("analysis", False),
+        ("build", True),
+    ]
+
+
+def test_build_retry(monkeypatch, tmpdir, capsys):
+    run_dir = str(tmpdir.join("runs"))
+    checkout = tmpdir.mkdir("checkout")
+    checkout.join("index.ipynb").write("{}")
+    monkeypatch.setattr(checker, "run_id", "build-retry")
+    monkeypatch.setattr(checker, "results_db", None)
+    monkeypatch.setattr(checker, "retry_delay", 0)
+    monkeypatch.setattr(checker, "remove_checkout", lambda path: None)
+    monkeypatch.setattr(checker, "analyze", lambda path, **kw: {"reason": None})
+    monkeypatch.setattr(checker, "run_tests", lambda *args, **kw: iter([]))
+    monkeypatch.setattr(
+        checker,
+        "clone_repo",
+        lambda repo, ref: (str(checkout), "abc1234", "2020-01-01T00:00:00"),
+    )
+    builds = []
+
+    def fake_build_image(repo, resolved_ref, checkout_path, build_log_file, **kw):
+        builds.append(repo)
+        with open_log(build_log_file, "a") as f:
+            f.write(f"{message}\n")
+        if len(builds) == 1 or "pip" in message:
+            raise checker.CalledProcessError(1, ["repo2docker"])
+        return "r2d-test-image", "miss"
+
+    monkeypatch.setattr(checker, "build_image", fake_build_image)
+
+    repo = "https://example.org/org/repo"
+    message = "fatal: Could not resolve host: github.com"
+    result_file, results = checker.test_one_repo(repo, run_dir=run_dir)
+    assert len(builds) == 2
+    assert [(r.kind, r.success, r.failure_reason) for r in results] == [
+        ("build", True, "")
+    ]
+
+    # real failures aren't retried
+    builds.clear()
+    monkeypatch.setattr(checker, "run_id", "build-fails")
+    message = "pip: No matching distribution found for nosuchpkg"
+    result_file, results = checker.test_one_repo(repo, run_dir=run_dir)
+    assert len(builds) == 1
+    assert [(r.kind, r.success, r.failure_reason) for r in results] == [
+        ("build", False, "no-distribution")
+    ]
+    checker.print_summary(results, result_file, run_dir)
+    assert "no-distribution" in capsys.readouterr().out
+
+
+def test_prewarm_bases(monkeypatch, tmpdir):
+    d = FakeDocker()
+    monkeypatch.setattr(checker, "docker_client", lambda: d)
+    monkeypatch.setattr(checker, "base_images", {})
+    monkeypatch.setattr(checker, "prewarm_min_repos", 2)
+    monkeypatch.setattr(checker, "remove_checkout", lambda path: None)
+    repos = {
+        "a": {"requirements.txt": "numpy"},
+        "b": {"requirements.txt": "scipy"},
+        "c": {"environment.yml": "dependencies:\n  - python=3.8\n"},
+        "d": {"Dockerfile": "FROM python"},
+    }
+    for name, files in repos.items():
+        repo_dir = tmpdir.mkdir(name)
+        for fname, content in files.items():
+            repo_dir.join(fname).write(content)
+
+    def fake_clone_repo(repo, ref):
+        if repo == "missing":
+            raise ValueError("No such repo")
+        return str(tmpdir.join(repo)), "abc1234", "2020-01-01T00:00:00"
+
+    monkeypatch.setattr(checker, "clone_repo", fake_clone_repo)
+    built = []
+
+    def fake_run(cmd, **kwargs):
+        image_id = cmd[-2]
+        # built from a minimal repo with the same base
+        assert sorted(os.listdir(cmd[-1])) == ["requirements.txt"]
+        d.images[image_id] = FakeImage(d.images, image_id)
+        built.append(image_id)
+
+    monkeypatch.setattr(checker, "run", fake_run)
+    run_dir = str(tmpdir.join("runs"))
+    repo_refs = [(name, "master") for name in list(repos) + ["missing"]]
+    counts = checker.prewarm_bases(repo_refs, run_dir, jobs=2)
+    assert counts == {("python", ""): 2, ("conda", "3.8"): 1}
+    base_image = checker.base_image_id(("python", ""))
+    assert built == [base_image]
+    assert checker.base_images == {("python", ""): base_image}
+    assert len(os.listdir(os.path.join(run_dir, "bases"))) == 1
+
+    # already built
+    checker.prewarm_bases(repo_refs, run_dir)
+    assert built == [base_image]
+
+    # builds report their reuse of the base
+    monkeypatch.setattr(
+        checker,
+        "layer_reuse",
+        lambda client, image_id, base_image_id: {
+            "base_layers": 10,
+            "layers": 12,
+            "base_bytes": 900,
+            "bytes": 1000,
+        },
+    )
+    log_file = str(tmpdir.join("build.txt"))
+    reuse = checker.report_base_reuse("r2d-test-a:1", str(tmpdir.join("a")), log_file)
+    assert reuse["base"] == base_image
+    assert reuse["base_layers"] == 10
+    with open(log_file) as f:
+        assert "Reused 10/12 layers (900/1000 bytes)" in f.read()
+    assert (
+        checker.report_base_reuse("r2d-test-c:1", str(tmpdir.join("c")), log_file) == {}
+    )
@@ -0,0 +1,130 @@
+import asyncio
+import io
+import os
+import tarfile
+from threading import Thread
+
+import pytest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from repo2docker_checker import checker
+from repo2docker_checker.coordinator import make_app
+from repo2docker_checker.coordinator import RemoteQueue
+from repo2docker_checker.coordinator import unpack_results
+from repo2docker_checker.results import SQLiteResults
+from repo2docker_checker.workqueue import JobQueue
+
+
+@pytest.fixture
+def coordinator(tmpdir):
+    """A coordinator serving a queue in tmpdir/shared, in a thread"""
+    run_dir = str(tmpdir.join("shared"))
+    os.makedirs(run_dir)
+    job_queue = JobQueue(os.path.join(run_dir, "queue.sqlite"))
+    job_queue.set_meta("run_id", "remote-run")
+    results_db = SQLiteResults(os.path.join(run_dir, "results.sqlite"))
+    app = make_app(job_queue, run_dir, results_db, token="secret")
+    sock, port = bind_unused_port()
+    loops = []
+
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        loops.append(IOLoop.current())
+        IOLoop.current().start()
+        server.stop()
+
+    t = Thread(target=serve, daemon=True)
+    t.start()
+    yield job_queue, results_db, f"http://127.0.0.1:{port}"
+    loops[0].add_callback(loops[0].stop)
+    t.join()
+    results_db.close()
+    job_queue.close()
+
+
+def test_remote_queue(coordinator):
+    job_queue, results_db, url = coordinator
+    job_queue.add([("repo1", "ref"), ("repo2", "ref")], max_attempts=1)
+    with pytest.raises(RuntimeError, match="403"):
+        RemoteQueue(url, token="wrong")
+    q = RemoteQueue(url, token="secret")
+    assert q.run_id == "remote-run"
+    assert q.lease_seconds == job_queue.lease_seconds
+    job1 = q.lease()
+    job2 = q.lease(worker="worker-2")
+    assert (job1.repo, job2.repo) == ("repo1", "repo2")
+    assert q.lease() is None
+    assert q.renew(job1)
+    leased = q.jobs("leased")
+    assert leased[0]["worker"].startswith(q.worker_id)
+    assert leased[1]["worker"] == "worker-2"
+    q.complete(job1, "results.csv")
+    q.fail(job2, "oops")
+    assert q.counts() == {"pending": 0, "leased": 0, "done": 1, "failed": 1}
+    assert not q.unfinished()
+    assert job_queue.jobs("done")[0]["result_file"] == "results.csv"
+    assert job_queue.jobs("failed")[0]["error"] == "oops"
+
+
+def test_check_remote_queue(monkeypatch, coordinator, tmpdir):
+    job_queue, results_db, url = coordinator
+    job_queue.add([(f"https://github.com/org/repo{i}", "ref") for i in range(3)])
+    monkeypatch.setattr(checker, "run_id", "remote-run")
+
+    def fake_test_one_repo(repo, ref, run_dir, force_build):
+        repo_run_dir = os.path.join(run_dir, checker.repo_slug(repo))
+        result_file = os.path.join(
+            repo_run_dir, "results", f"results-{ref}-{checker.run_id}.csv"
+        )
+        os.makedirs(os.path.dirname(result_file))
+        os.makedirs(os.path.join(repo_run_dir, "logs"))
+        with open(os.path.join(repo_run_dir, "logs", "build.txt"), "w") as f:
+            f.write("build log")
+        with open(os.path.join(repo_run_dir, "results", "repo.lock"), "w") as f:
+            f.write("")
+        result = checker.TestResult(
+            repo, ref, ref, "", "build", "build", False, "build.txt", "", "", ""
+        )
+        with checker.CSVResults(result_file) as csv_results:
+            csv_results.add(result)
+        return result_file, [result]
+
+    monkeypatch.setattr(checker, "test_one_repo", fake_test_one_repo)
+    worker_dir = str(tmpdir.join("worker"))
+    checker.check_queue(RemoteQueue(url, token="secret"), worker_dir, jobs=2)
+    assert job_queue.counts()["done"] == 3
+    # results and logs are uploaded to the queue's directory
+    shared = tmpdir.join("shared")
+    for i in range(3):
+        repo_dir = shared.join("github.com", "org", f"repo{i}")
+        assert repo_dir.join("logs", "build.txt").read() == "build log"
+        assert repo_dir.join("results", "results-ref-remote-run.csv").exists()
+        assert not repo_dir.join("results", "repo.lock").exists()
+    assert len(list(results_db.query(kind="build"))) == 3
+
+
+def _tarball(*names):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = 1
+            tf.addfile(info, io.BytesIO(b"x"))
+    return buf.getvalue()
+
+
+def test_unpack_results_outside(tmpdir):
+    result_file = "github.com/org/repo/results/results.csv"
+    with pytest.raises(ValueError):
+        unpack_results(result_file, _tarball("github.com/org/other/x.txt"), str(tmpdir))
+    with pytest.raises(ValueError):
+        unpack_results(
+            result_file, _tarball("github.com/org/repo/../../../x.txt"), str(tmpdir)
+        )
+    with pytest.raises(ValueError):
+        unpack_results("../results.csv", _tarball("x.txt"), str(tmpdir))
+    assert tmpdir.listdir() == []
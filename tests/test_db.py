@@ -0,0 +1,27 @@
+from threading import Lock
+
+import pytest
+
+from repo2docker_checker.db import connect
+from repo2docker_checker.db import transaction
+
+
+def test_transaction(tmpdir):
+    path = str(tmpdir.join("test.sqlite"))
+    db = connect(path)
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    db.execute("CREATE TABLE t (x INTEGER)")
+    lock = Lock()
+    with transaction(db, lock):
+        assert lock.locked()
+        db.execute("INSERT INTO t VALUES (1)")
+    with pytest.raises(ValueError):
+        with transaction(db):
+            db.execute("INSERT INTO t VALUES (2)")
+            raise ValueError("oops")
+    assert [row["x"] for row in db.execute("SELECT x FROM t")] == [1]
+    db.close()
+
+    db = connect(path, journal_mode="DELETE")
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    db.close()
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+from conftest import commit_files
+
+from repo2docker_checker.discovery import find_notebooks
+from repo2docker_checker.discovery import git_notebooks
+from repo2docker_checker.discovery import rank_notebooks
+from repo2docker_checker.discovery import walk_notebooks
+
+files = {
+    "b.ipynb": "x" * 10,
+    "a.ipynb": "x" * 100,
+    "sub/c.ipynb": "x",
+    "sub/deeper/d.ipynb": "x" * 1000,
+    "sub/notes.txt": "",
+    ".ipynb_checkpoints/a-checkpoint.ipynb": "",
+    "node_modules/pkg/e.ipynb": "",
+}
+
+
+def write_files(path, files):
+    for name, content in files.items():
+        fpath = os.path.join(path, name)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "w") as f:
+            f.write(content)
+
+
+def test_walk_notebooks(tmpdir):
+    path = str(tmpdir)
+    write_files(path, files)
+    assert git_notebooks(path) is None
+    assert sorted(walk_notebooks(path)) == [
+        "a.ipynb",
+        "b.ipynb",
+        os.path.join("sub", "c.ipynb"),
+        os.path.join("sub", "deeper", "d.ipynb"),
+    ]
+
+
+def test_git_notebooks(git_repo):
+    commit_files(git_repo, files)
+    # untracked notebooks are not tested
+    write_files(git_repo, {"untracked.ipynb": "", "sub/untracked.ipynb": ""})
+    assert sorted(git_notebooks(git_repo)) == sorted(walk_notebooks(git_repo))[:4]
+    assert "untracked.ipynb" not in git_notebooks(git_repo)
+    assert find_notebooks(git_repo) == [
+        "a.ipynb",
+        "b.ipynb",
+        os.path.join("sub", "c.ipynb"),
+        os.path.join("sub", "deeper", "d.ipynb"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "priority, expected",
+    [
+        ("depth,name", ["a", "b", "sub/c", "sub/deeper/d"]),
+        ("size", ["sub/c", "b", "a", "sub/deeper/d"]),
+        ("-size", ["sub/deeper/d", "a", "b", "sub/c"]),
+        ("depth,-size", ["a", "b", "sub/c", "sub/deeper/d"]),
+        ("-depth,name", ["sub/deeper/d", "sub/c", "a", "b"]),
+    ],
+)
+def test_rank_notebooks(tmpdir, priority, expected):
+    path = str(tmpdir)
+    write_files(path, files)
+    ranked = rank_notebooks(path, walk_notebooks(path), priority)
+    assert ranked == [os.path.join(*f"{name}.ipynb".split("/")) for name in expected]
+
+
+def test_rank_notebooks_bad_priority(tmpdir):
+    with pytest.raises(ValueError):
+        rank_notebooks(str(tmpdir), [], "nosuchkey")
@@ -0,0 +1,345 @@
+import asyncio
+import json
+import struct
+import threading
+import time
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import pytest
+
+from repo2docker_checker.engine import AsyncDockerClient
+from repo2docker_checker.engine import demux
+from repo2docker_checker.engine import DockerAPIError
+from repo2docker_checker.engine import Engine
+from repo2docker_checker.engine import LOG_THREADS
+from repo2docker_checker.logstream import LogWriter
+from repo2docker_checker.logstream import OutputLimitExceeded
+
+
+class FakeDockerAPI:
+    """A fake docker API server on a unix socket
+
+    Containers don't run anything, their Cmd is a list of instructions:
+    "out:text" writes text to stdout, "sleep:seconds" waits,
+    and the container exits with status 0 (137 if killed).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.containers = {}
+        self.connections = 0
+        # (method, path) of each request
+        self.requests = []
+        # close connections after reading this many requests, without a response
+        self.hang_up = 0
+        self._writers = set()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        self.server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def _stop(self):
+        self.server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def close_connections(self):
+        """Close all open connections, as if they were idle for too long"""
+
+        async def close():
+            for writer in self._writers:
+                writer.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line == b"\r\n":
+                        break
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = json.loads(await reader.readexactly(length)) if length else None
+                url = urlparse(target)
+                self.requests.append((method, url.path))
+                if self.hang_up:
+                    self.hang_up -= 1
+                    return
+                await self._route(method, url.path, parse_qs(url.query), body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _respond(self, writer, status, content=None):
+        data = b"" if content is None else json.dumps(content).encode()
+        writer.write(
+            f"HTTP/1.1 {status} X\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+            + data
+        )
+
+    async def _run(self, container):
+        for instruction in container["config"]["Cmd"]:
+            action, _, arg = instruction.partition(":")
+            if action == "out":
+                frame = arg.encode()
+                container["output"].append(struct.pack(">BxxxL", 1, len(frame)) + frame)
+                container["changed"].set()
+            elif action == "sleep":
+                await asyncio.sleep(float(arg))
+        container["status"] = 0
+        container["done"].set()
+        container["changed"].set()
+
+    async def _route(self, method, path, query, body, writer):
+        parts = path.strip("/").split("/")
+        if path == "/containers/create":
+            cid = f"c{len(self.containers)}"
+            self.containers[cid] = {
+                "config": body,
+                "output": [],
+                "changed": asyncio.Event(),
+                "done": asyncio.Event(),
+                "status": None,
+                "removed": False,
+            }
+            return self._respond(writer, 201, {"Id": cid})
+        container = self.containers.get(parts[1])
+        if container is None or container["removed"]:
+            return self._respond(writer, 404, {"message": "No such container"})
+        action = parts[2] if len(parts) > 2 else ""
+        if method == "POST" and action == "start":
+            container["task"] = asyncio.ensure_future(self._run(container))
+            return self._respond(writer, 204)
+        elif method == "POST" and action == "kill":
+            if container["done"].is_set():
+                return self._respond(writer, 409, {"message": "not running"})
+            container["task"].cancel()
+            container["status"] = 137
+            container["done"].set()
+            container["changed"].set()
+            return self._respond(writer, 204)
+        elif method == "POST" and action == "wait":
+            await container["done"].wait()
+            return self._respond(writer, 200, {"StatusCode": container["status"]})
+        elif method == "GET" and action == "logs":
+            writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+            sent = 0
+            while True:
+                for frame in container["output"][sent:]:
+                    # split frames across chunks, to exercise demux
+                    for piece in (frame[:5], frame[5:]):
+                        writer.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+                sent = len(container["output"])
+                await writer.drain()
+                if container["done"].is_set():
+                    break
+                container["changed"].clear()
+                await container["changed"].wait()
+            writer.write(b"0\r\n\r\n")
+        elif method == "DELETE":
+            if container.get("task"):
+                container["task"].cancel()
+            container["removed"] = True
+            return self._respond(writer, 204)
+        else:
+            return self._respond(writer, 404, {"message": "not found"})
+
+
+class Log:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.data += data
+
+
+@pytest.fixture
+def fake_api(tmpdir):
+    api = FakeDockerAPI(str(tmpdir.join("docker.sock")))
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def engine(fake_api):
+    engine = Engine(AsyncDockerClient(f"unix://{fake_api.path}"))
+    yield engine
+    engine.close()
+
+
+def test_demux():
+    frames = [b"hello\n", b"", b"x" * 100000, b"world"]
+    stream = b"".join(struct.pack(">BxxxL", 1, len(f)) + f for f in frames)
+
+    async def chunks():
+        for i in range(0, len(stream), 7):
+            yield stream[i : i + 7]
+
+    async def collect():
+        return [data async for data in demux(chunks())]
+
+    assert b"".join(asyncio.run(collect())) == b"".join(frames)
+
+
+def test_run_container(engine, fake_api):
+    log_w = Log()
+    status = engine.run_container({"Cmd": ["out:hello ", "out:world"]}, log_w)
+    assert status == {"StatusCode": 0}
+    assert log_w.data == b"hello world"
+    assert fake_api.containers["c0"]["removed"]
+
+
+def test_many_containers(engine, fake_api):
+    n = 50
+    logs = [Log() for i in range(n)]
+
+    async def run_all():
+        return await asyncio.gather(
+            *(
+                engine.client.run_container(
+                    {"Cmd": [f"out:{i}", "sleep:0.5", "out:done"]}, logs[i]
+                )
+                for i in range(n)
+            )
+        )
+
+    threads = threading.active_count()
+    tic = time.perf_counter()
+    statuses = engine.run(run_all())
+    # all containers run concurrently, without a thread each
+    assert time.perf_counter() - tic < 5
+    assert threading.active_count() <= threads + LOG_THREADS
+    assert statuses == [{"StatusCode": 0}] * n
+    assert [log_w.data for log_w in logs] == [f"{i}done".encode() for i in range(n)]
+    assert all(c["removed"] for c in fake_api.containers.values())
+
+
+def test_timeout(engine, fake_api):
+    log_w = Log()
+    tic = time.perf_counter()
+    status = engine.run_container(
+        {"Cmd": ["out:start", "sleep:30"]}, log_w, timeout=0.5
+    )
+    assert time.perf_counter() - tic < 5
+    assert status["StatusCode"] is None
+    assert "timed out" in status["Error"]["Message"]
+    assert log_w.data.startswith(b"start")
+    assert fake_api.containers["c0"]["status"] == 137
+    assert fake_api.containers["c0"]["removed"]
+
+
+def test_cancel(engine, fake_api):
+    future = engine.submit(engine.client.run_container({"Cmd": ["sleep:30"]}, Log()))
+    for i in range(50):
+        if fake_api.containers.get("c0", {}).get("task"):
+            break
+        time.sleep(0.1)
+    future.cancel()
+    for i in range(50):
+        if fake_api.containers["c0"]["removed"]:
+            break
+        time.sleep(0.1)
+    assert fake_api.containers["c0"]["removed"]
+
+
+def test_output_limit(engine, fake_api, tmpdir):
+    log_file = str(tmpdir.join("log.txt"))
+    tic = time.perf_counter()
+    with LogWriter(log_file, echo=False, limit=10) as log_w:
+        with pytest.raises(OutputLimitExceeded):
+            engine.run_container(
+                {"Cmd": ["out:hello ", "out:world", "out:again", "sleep:30"]}, log_w
+            )
+        log_w.write("killed")
+    assert time.perf_counter() - tic < 5
+    assert fake_api.containers["c0"]["removed"]
+    with open(log_file) as f:
+        assert f.read() == "hello worlkilled"
+
+
+class SlowLog(Log):
+    def write(self, data):
+        time.sleep(1)
+        super().write(data)
+
+
+def test_slow_log(engine, fake_api):
+    async def run_both():
+        slow = asyncio.ensure_future(
+            engine.client.run_container({"Cmd": ["out:slow"]}, SlowLog())
+        )
+        tic = time.perf_counter()
+        await engine.client.run_container({"Cmd": ["out:fast"]}, Log())
+        toc = time.perf_counter()
+        await slow
+        return toc - tic
+
+    # writing one container's log doesn't hold up the others
+    assert engine.run(run_both()) < 0.5
+
+
+def test_connection_reuse(engine, fake_api):
+    for i in range(10):
+        engine.run_container({"Cmd": ["out:x"]}, Log())
+    # one pooled connection for requests, plus one per log stream
+    assert fake_api.connections <= 10 + 2
+
+
+def test_idle_connection_closed(engine, fake_api):
+    engine.run_container({"Cmd": ["out:x"]}, Log())
+    fake_api.close_connections()
+    time.sleep(0.1)
+    # a new connection is used
+    assert engine.run_container({"Cmd": ["out:x"]}, Log()) == {"StatusCode": 0}
+
+
+def test_idle_connection_hang_up(engine, fake_api):
+    engine.run_container({"Cmd": ["out:x"]}, Log())
+    fake_api.hang_up = 1
+    del fake_api.requests[:]
+    # closed as the request was sent on the idle connection,
+    # so it's sent again on a fresh connection
+    assert engine.run_container({"Cmd": ["out:x"]}, Log()) == {"StatusCode": 0}
+    assert fake_api.requests[:2] == [("POST", "/containers/create")] * 2
+
+
+def test_no_resend(engine, fake_api):
+    engine.run_container({"Cmd": ["out:x"]}, Log())
+    fake_api.hang_up = 3
+    del fake_api.requests[:]
+    with pytest.raises(ConnectionError):
+        engine.run_container({"Cmd": ["out:x"]}, Log())
+    # the request was retried once, on a fresh connection, and not again
+    assert fake_api.requests == [("POST", "/containers/create")] * 2
+
+
+def test_error(engine):
+    with pytest.raises(DockerAPIError) as e:
+        engine.run(engine.client.wait("nosuchcontainer"))
+    assert e.value.status == 404
@@ -0,0 +1,107 @@
+import gzip
+
+import pytest
+
+from repo2docker_checker import failures
+from repo2docker_checker.failures import classify
+from repo2docker_checker.failures import classify_log
+from repo2docker_checker.failures import is_transient
+
+
+@pytest.mark.parametrize(
+    "log, reason",
+    [
+        (
+            "WARNING: Retrying (Retry(total=0)) after connection broken by"
+            " 'NewConnectionError(': Failed to establish a new connection:"
+            " [Errno -3] Temporary failure in name resolution')'\n"
+            "ERROR: Could not find a version that satisfies the requirement numpy\n"
+            "ERROR: No matching distribution found for numpy\n",
+            "dns",
+        ),
+        (
+            # pip recovered from a timeout, the package doesn't exist
+            "WARNING: Retrying (Retry(total=4, connect=None, read=None))"
+            " after connection broken by 'ReadTimeoutError(\"HTTPSConnectionPool"
+            "(host='pypi.org', port=443): Read timed out. (read timeout=15)\")'"
+            ": /simple/nosuchpkg/\n"
+            "ERROR: Could not find a version that satisfies the requirement"
+            " nosuchpkg==9.9 (from versions: none)\n"
+            "ERROR: No matching distribution found for nosuchpkg==9.9\n",
+            "no-distribution",
+        ),
+        ("ReadTimeoutError: HTTPSConnectionPool: Read timed out.", "network-timeout"),
+        ("ConnectionResetError: [Errno 104] Connection reset by peer", "connection"),
+        ("toomanyrequests: You have reached your pull rate limit.", "docker-daemon"),
+        (
+            "docker.errors.APIError: 500 Server Error: Internal Server Error"
+            ' ("Get https://registry-1.docker.io/v2/: context deadline exceeded")',
+            "docker-daemon",
+        ),
+        (
+            # a daemon error caused by the container, not worth retrying
+            "docker.errors.APIError: 500 Server Error: Internal Server Error"
+            ' ("OCI runtime create failed: exec: \\"jupyter\\":'
+            ' executable file not found in $PATH")',
+            "unknown",
+        ),
+        (
+            "ERROR: Could not find a version that satisfies the requirement nosuchpkg\n"
+            "ERROR: No matching distribution found for nosuchpkg\n",
+            "no-distribution",
+        ),
+        ("Container exited with status: {'StatusCode': 137}", "oom"),
+        ("step 3\nKilled\n", "oom"),
+        ("Container timed out after 60s", "timeout"),
+        ("nbclient.exceptions.DeadKernelError: Kernel died", "kernel-died"),
+        ("ZeroDivisionError: division by zero", "unknown"),
+    ],
+)
+def test_classify(log, reason):
+    assert classify(log.encode("utf8")) == reason
+
+
+def test_classify_last_error():
+    # an early network error, recovered from, and a real error at the end
+    log = b"".join(
+        [
+            b"CondaHTTPError: HTTP 000 CONNECTION FAILED, retrying\n",
+            b"Collecting numpy\n" * 100,
+            b"ERROR: No matching distribution found for nosuchpkg==9.9\n",
+        ]
+    )
+    assert classify(log) == "no-distribution"
+    # network errors are still found before the last lines, as a fallback
+    log = b"Could not resolve host: github.com\n" + b"step\n" * 100
+    assert classify(log) == "dns"
+    # after any non-transient error
+    assert classify(b"MemoryError\n" + log) == "oom"
+
+
+def test_transient():
+    assert is_transient("dns")
+    assert not is_transient("no-distribution")
+    assert not is_transient("unknown")
+    assert not is_transient("")
+
+
+def test_classify_log_tail(tmpdir, monkeypatch):
+    monkeypatch.setattr(failures, "TAIL_BYTES", 100)
+    path = str(tmpdir.join("log.txt"))
+    with open(path, "w") as f:
+        f.write("Could not resolve host: github.com\n")
+        f.write("x" * 1000 + "\n")
+        f.write("MemoryError\n")
+    assert classify_log(path) == "oom"
+    # only the tail is searched
+    with open(path, "a") as f:
+        f.write("y" * 1000 + "\n")
+    assert classify_log(path) == "unknown"
+
+
+def test_classify_log_compressed(tmpdir):
+    path = str(tmpdir.join("log.txt.gz"))
+    with gzip.open(path, "wb") as f:
+        f.write(b"x" * 1000000 + b"\nNo matching distribution found for x\n")
+    assert classify_log(path) == "no-distribution"
+    assert classify_log(str(tmpdir.join("nosuchfile"))) == "unknown"
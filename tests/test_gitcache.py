@@ -0,0 +1,100 @@
+import os
+
+from conftest import commit_files
+from conftest import git
+
+from repo2docker_checker import gitcache
+from repo2docker_checker.gitcache import dir_size
+from repo2docker_checker.gitcache import GitCache
+
+
+def test_checkout(tmpdir, git_repo):
+    cache = GitCache(str(tmpdir.join("cache")))
+    repo = f"file://{git_repo}"
+    slug = "localhost/test/repo"
+    first_sha = git("rev-parse", "HEAD", cwd=git_repo)
+    checkout_path, sha = cache.checkout(repo, slug, "master")
+    assert sha == first_sha
+    assert os.path.exists(os.path.join(checkout_path, "README.md"))
+    assert git("remote", "get-url", "origin", cwd=checkout_path) == repo
+    mirror = cache.mirror_path(slug)
+    assert os.path.isdir(mirror)
+    # checkouts are next to the mirrors, with objects hardlinked
+    assert checkout_path.startswith(cache.checkouts_path + os.sep)
+    [pack] = [
+        name
+        for name in os.listdir(os.path.join(mirror, "objects", "pack"))
+        if name.endswith(".pack")
+    ]
+    assert os.path.samefile(
+        os.path.join(mirror, "objects", "pack", pack),
+        os.path.join(checkout_path, ".git", "objects", "pack", pack),
+    )
+    cache.remove_checkout(checkout_path)
+    assert not os.path.exists(checkout_path)
+    # no temporary directories left behind
+    assert os.listdir(cache.checkouts_path) == []
+
+    # new commit is fetched into the same mirror
+    second_sha = commit_files(git_repo, {"a.ipynb": "{}"})
+    checkout_path, sha = cache.checkout(repo, slug, "master")
+    assert sha == second_sha
+    assert os.path.exists(os.path.join(checkout_path, "a.ipynb"))
+    mirrors = [name for name in os.listdir(cache.path) if name.endswith(".git")]
+    assert mirrors == [os.path.basename(mirror)]
+    cache.remove_checkout(checkout_path)
+
+    # commits already in the cache don't need the origin
+    os.rename(git_repo, git_repo + "-moved")
+    checkout_path, sha = cache.checkout(repo, slug, first_sha[:7])
+    assert sha == first_sha
+    assert not os.path.exists(os.path.join(checkout_path, "a.ipynb"))
+    cache.remove_checkout(checkout_path)
+
+
+def test_evict(tmpdir, git_repo, monkeypatch):
+    cache = GitCache(str(tmpdir.join("cache")))
+    repo = f"file://{git_repo}"
+    slugs = [f"localhost/test/repo{i}" for i in range(3)]
+    for i, slug in enumerate(slugs):
+        checkout_path, sha = cache.checkout(repo, slug, "master")
+        cache.remove_checkout(checkout_path)
+        # make sure use times are distinct
+        os.utime(cache.mirror_path(slug) + ".lock", (i, i))
+    # use the first one again
+    checkout_path, sha = cache.checkout(repo, slugs[0], "master")
+    cache.remove_checkout(checkout_path)
+
+    mirrors = [cache.mirror_path(slug) for slug in slugs]
+    assert all(os.path.exists(mirror) for mirror in mirrors)
+    # sizes are recorded when mirrors change
+    assert [cache.mirror_size(mirror) for mirror in mirrors] == [
+        dir_size(mirror) for mirror in mirrors
+    ]
+    # room for two mirrors: evict the least recently used
+    cache.max_bytes = dir_size(mirrors[0]) + dir_size(mirrors[2])
+    monkeypatch.setattr(gitcache, "dir_size", None)
+    cache.evict()
+    assert [os.path.exists(mirror) for mirror in mirrors] == [True, False, True]
+    assert not os.path.exists(mirrors[1] + ".size")
+
+    # locked mirrors are not evicted
+    cache.max_bytes = 1
+    with cache._lock(mirrors[0]):
+        cache.evict()
+    assert [os.path.exists(mirror) for mirror in mirrors] == [True, False, False]
+
+
+def test_stale_checkouts(tmpdir, git_repo):
+    cache = GitCache(str(tmpdir.join("cache")))
+    # left behind by a process that has exited, and by one still running
+    stale = os.path.join(cache.checkouts_path, "r2d-test-999999999-abc")
+    running = os.path.join(cache.checkouts_path, f"r2d-test-{os.getpid()}-abc")
+    os.makedirs(stale)
+    os.makedirs(running)
+    checkout_path, sha = cache.checkout(
+        f"file://{git_repo}", "localhost/repo", "master"
+    )
+    assert not os.path.exists(stale)
+    assert os.path.exists(running)
+    cache.remove_checkout(checkout_path)
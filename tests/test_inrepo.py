@@ -1,4 +1,7 @@
+import gzip
+import json
 import os
+import time
 
 import pytest
 
@@ -26,3 +29,125 @@ def test_notebook_ok(tmpdir, here):
     nb = os.path.join(here, "passes.ipynb")
     inrepo.run_notebook(nb, output_dir)
     assert os.listdir(output_dir)
+    rel_path = os.path.relpath(nb, os.getcwd())
+    with open(os.path.join(output_dir, "profiles", rel_path + ".json")) as f:
+        profile = json.load(f)
+    assert profile["notebook"] == rel_path
+    assert profile["cells"]
+    for cell in profile["cells"]:
+        assert cell["status"] == "ok"
+        assert cell["end"] >= cell["start"]
+        assert cell["duration"] >= 0
+        assert "output_bytes" in cell
+
+
+def test_notebook_timeout(tmpdir, monkeypatch):
+    import nbformat
+    from nbformat.v4 import new_code_cell
+    from nbformat.v4 import new_notebook
+
+    output_dir = str(tmpdir.mkdir("out"))
+    nb_path = str(tmpdir.join("slow.ipynb"))
+    nb = new_notebook(
+        cells=[new_code_cell("1 + 1"), new_code_cell("import time; time.sleep(60)")]
+    )
+    nb.metadata["kernelspec"] = {"name": "python3", "language": "python"}
+    with open(nb_path, "w") as f:
+        nbformat.write(nb, f)
+    monkeypatch.setattr(inrepo, "notebook_timeout", 3)
+    tic = time.perf_counter()
+    with pytest.raises(Exception):
+        inrepo.run_notebook(nb_path, output_dir)
+    assert time.perf_counter() - tic < 30
+    rel_path = os.path.relpath(nb_path, os.getcwd())
+    with open(os.path.join(output_dir, "profiles", rel_path + ".json")) as f:
+        profile = json.load(f)
+    assert [cell["status"] for cell in profile["cells"]] == ["ok", "timeout"]
+
+
+def test_batch(tmpdir, here):
+    output_dir = str(tmpdir.mkdir("out"))
+    batch_dir = tmpdir.mkdir("batch")
+    manifest = batch_dir.join("manifest.json")
+    tests = [
+        ["notebook", os.path.join(here, "passes.ipynb")],
+        ["import", "nosuchmod"],
+        ["notebook", os.path.join(here, "fails.ipynb")],
+    ]
+    with manifest.open("w") as f:
+        json.dump(tests, f)
+    assert not inrepo.run_batch(str(manifest), output_dir)
+    with batch_dir.join("results.jsonl").open() as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["kind"], r["test_id"]) for r in records] == [tuple(t) for t in tests]
+    assert [r["success"] for r in records] == [True, False, False]
+    with batch_dir.join(records[1]["log"]).open() as f:
+        assert "nosuchmod" in f.read()
+
+
+def test_trace(tmpdir, here, monkeypatch):
+    output_dir = str(tmpdir.mkdir("out"))
+    trace_file = str(tmpdir.join("trace.jsonl"))
+    monkeypatch.setattr(inrepo, "trace_file", trace_file)
+    nb = os.path.join(here, "passes.ipynb")
+    inrepo.run_notebook(nb, output_dir)
+    with open(trace_file) as f:
+        events = [json.loads(line) for line in f]
+    assert [e["name"] for e in events] == ["run_notebook"]
+    args = events[0]["args"]
+    assert args["notebook"] == nb
+    assert args["duration"] > 0
+    assert args["max_rss_increase"] >= 0
+
+
+def test_batch_kernel_pool(tmpdir, here, monkeypatch):
+    output_dir = str(tmpdir.mkdir("out"))
+    trace_file = str(tmpdir.join("trace.jsonl"))
+    monkeypatch.setattr(inrepo, "trace_file", trace_file)
+    batch_dir = tmpdir.mkdir("batch")
+    manifest = batch_dir.join("manifest.json")
+    nb = os.path.join(here, "passes.ipynb")
+    tests = [["notebook", nb], ["import", "sys"], ["notebook", nb], ["notebook", nb]]
+    with manifest.open("w") as f:
+        json.dump(tests, f)
+    assert inrepo.run_batch(str(manifest), output_dir)
+    with open(trace_file) as f:
+        events = [json.loads(line) for line in f]
+    prestarted = [
+        e["args"]["prestarted"] for e in events if e["name"] == "run_notebook"
+    ]
+    assert prestarted == [True, True, True]
+    # unused kernels are shut down
+    assert inrepo.kernel_pool._kernels == []
+
+
+def test_notebook_compressed_stripped(tmpdir, monkeypatch):
+    import nbformat
+    from nbformat.v4 import new_code_cell
+    from nbformat.v4 import new_notebook
+
+    output_dir = str(tmpdir.mkdir("out"))
+    nb_path = str(tmpdir.join("image.ipynb"))
+    nb = new_notebook(
+        cells=[
+            new_code_cell(
+                "from IPython.display import display\n"
+                "display({'image/png': 'iVBORw0KGgo='}, raw=True)\n"
+                "'text'"
+            )
+        ]
+    )
+    nb.metadata["kernelspec"] = {"name": "python3", "language": "python"}
+    with open(nb_path, "w") as f:
+        nbformat.write(nb, f)
+    monkeypatch.setattr(inrepo, "compress_notebooks", True)
+    monkeypatch.setattr(inrepo, "strip_outputs", True)
+    inrepo.run_notebook(nb_path, output_dir)
+    rel_path = os.path.relpath(nb_path, os.getcwd())
+    with gzip.open(os.path.join(output_dir, "notebooks", rel_path + ".gz"), "rt") as f:
+        exported = nbformat.read(f, as_version=4)
+    outputs = exported.cells[0].outputs
+    assert [output["data"] for output in outputs] == [
+        {"text/plain": "<image/png output stripped>"},
+        {"text/plain": "'text'"},
+    ]
@@ -0,0 +1,176 @@
+import gzip
+import sys
+from subprocess import run
+from subprocess import STDOUT
+
+import pytest
+
+from repo2docker_checker import logstream
+from repo2docker_checker.logstream import copy_log
+from repo2docker_checker.logstream import LogWriter
+from repo2docker_checker.logstream import open_log
+from repo2docker_checker.logstream import tee
+
+
+@pytest.mark.parametrize("echo", [True, False])
+def test_tee_subprocess(tmpdir, capfd, echo):
+    log_file = str(tmpdir.join("log.txt"))
+    with tee(log_file, echo=echo) as stdout:
+        run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; print('out'); print('err', file=sys.stderr); print('é' * 100000)",
+            ],
+            stdout=stdout,
+            stderr=STDOUT,
+            check=True,
+        )
+    with open(log_file, encoding="utf8") as f:
+        lines = f.read().splitlines()
+    assert lines == ["out", "err", "é" * 100000]
+    captured = capfd.readouterr()
+    if echo:
+        assert "out\nerr\n" in captured.err
+    else:
+        assert captured.err == ""
+
+
+def test_log_writer_echoes_lines(tmpdir, capfd):
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file) as log_w:
+        log_w.write(b"partial")
+        assert capfd.readouterr().err == ""
+        log_w.write("é".encode("utf8")[:1])
+        log_w.write("é".encode("utf8")[1:] + b" line\nnext")
+        assert capfd.readouterr().err == "partialé line\n"
+        log_w.write("text\n")
+    assert capfd.readouterr().err == "nexttext\n"
+    assert log_w.bytes_written == len("partialé line\nnexttext\n".encode("utf8"))
+    with open(log_file, encoding="utf8") as f:
+        assert f.read() == "partialé line\nnexttext\n"
+
+
+def test_long_lines_are_echoed(tmpdir, capfd):
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file) as log_w:
+        log_w.write(b"x" * (logstream.BLOCK_SIZE + 1))
+        assert len(capfd.readouterr().err) == logstream.BLOCK_SIZE + 1
+
+
+def test_log_writer_max_bytes(tmpdir):
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file, echo=False, max_bytes=100) as log_w:
+        log_w.write(b"start\n")
+        for i in range(100000):
+            log_w.write(f"line {i}\n")
+        log_w.write(b"end\n")
+    with open(log_file, "rb") as f:
+        data = f.read()
+    assert data.startswith(b"start\nline 0\n")
+    assert data.endswith(b"line 99999\nend\n")
+    assert b"bytes truncated ...]\n" in data
+    head, tail = data.split(b"bytes truncated ...]\n")
+    assert len(tail) == 50
+    truncated = int(head.rsplit(b"[... ", 1)[1])
+    assert truncated + 100 == log_w.bytes_written
+
+
+def test_log_writer_under_max_bytes(tmpdir):
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file, echo=False, max_bytes=100) as log_w:
+        log_w.write(b"x" * 60)
+        log_w.write(b"y" * 40)
+    with open(log_file, "rb") as f:
+        assert f.read() == b"x" * 60 + b"y" * 40
+
+
+@pytest.mark.parametrize("max_bytes", [0, 1000])
+def test_tee_compressed(tmpdir, max_bytes):
+    log_file = str(tmpdir.join("log.txt.gz"))
+    with tee(log_file, echo=False, max_bytes=max_bytes) as stdout:
+        run(
+            [sys.executable, "-c", "print('é' * 100000)"],
+            stdout=stdout,
+            check=True,
+        )
+    with gzip.open(log_file, "rb") as f:
+        data = f.read()
+    if max_bytes:
+        assert len(data) < max_bytes + 100
+    else:
+        assert data == ("é" * 100000 + "\n").encode("utf8")
+    with open_log(log_file, "r") as f:
+        assert f.read().startswith("é" * 100)
+
+
+def test_copy_log(tmpdir):
+    src = str(tmpdir.join("src.log"))
+    with open(src, "wb") as f:
+        f.write(b"x" * 1000)
+    dest = str(tmpdir.join("dest.txt.gz"))
+    copy_log(src, dest, max_bytes=100)
+    with open_log(dest) as f:
+        data = f.read()
+    assert data.startswith(b"x" * 50 + b"\n[... 900 bytes truncated")
+    with open_log(dest, "a") as f:
+        f.write("appended\n")
+    with open_log(dest) as f:
+        assert f.read() == data + b"appended\n"
+
+
+def test_log_writer_tail(tmpdir):
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file, echo=False, keep_tail=10) as log_w:
+        log_w.write(b"short")
+        assert log_w.tail == b"short"
+        for i in range(100000):
+            log_w.write(f"line {i}\n")
+        # the tail doesn't grow without bounds
+        assert len(log_w._tail) < 2 * logstream.BLOCK_SIZE
+    assert log_w.tail == b"ine 99999\n"
+    # the log file is complete
+    with open(log_file) as f:
+        assert f.read().endswith("line 99998\nline 99999\n")
+
+
+def test_log_writer_tail_max_bytes(tmpdir):
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file, echo=False, keep_tail=100, max_bytes=20) as log_w:
+        for i in range(100):
+            log_w.write(f"{i:03}\n")
+    assert log_w.tail == "".join(f"{i:03}\n" for i in range(75, 100)).encode()
+    with open(log_file) as f:
+        assert f.read() == "000\n001\n00\n[... 380 bytes truncated ...]\n7\n098\n099\n"
+
+
+def test_log_writer_limit(tmpdir):
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file, echo=False, limit=10) as log_w:
+        log_w.write(b"12345")
+        with pytest.raises(logstream.OutputLimitExceeded):
+            log_w.write(b"67890abc")
+        # the limit is lifted after it's been exceeded
+        log_w.write(b"\nkilled\n")
+    with open(log_file) as f:
+        assert f.read() == "1234567890\nkilled\n"
+
+
+def test_log_writer_echo_rate(tmpdir, capfd, monkeypatch):
+    clock = [0]
+    monkeypatch.setattr(logstream.time, "monotonic", lambda: clock[0])
+    log_file = str(tmpdir.join("log.txt"))
+    with LogWriter(log_file, echo_rate=10) as log_w:
+        log_w.write(b"line 1\n")
+        # over the rate
+        log_w.write(b"line 2\n")
+        log_w.write(b"line 3\n")
+        assert capfd.readouterr().err == "line 1\n"
+        clock[0] += 1
+        log_w.write(b"line 4\n")
+        assert capfd.readouterr().err == "[... 14 bytes not echoed ...]\nline 4\n"
+        log_w.write(b"line 5\n")
+    assert capfd.readouterr().err == "[... 7 bytes not echoed ...]\n"
+    # logs are complete
+    with open(log_file) as f:
+        assert f.read() == "".join(f"line {i}\n" for i in range(1, 6))
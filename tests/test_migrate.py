@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+from repo2docker_checker import checker
+from repo2docker_checker import migrate
+from repo2docker_checker.results import CSVResults
+from repo2docker_checker.results import read_csv
+from repo2docker_checker.results import SQLiteResults
+from repo2docker_checker.results import TestResult as Result
+
+
+def make_old_repo(run_dir, slug, n_logs=3):
+    """Make a repo run directory in the old layout, with results"""
+    repo_dir = run_dir.join(*slug.split("/"))
+    logs = repo_dir.ensure("logs", dir=True)
+    repo_dir.ensure("results", dir=True)
+    results = []
+    for i in range(n_logs):
+        logs.join(f"test-{i}.txt").write(f"log {i}")
+        results.append(
+            Result(
+                repo=f"https://{slug}",
+                ref="master",
+                resolved_ref="abc1234",
+                last_modified="",
+                kind="notebook",
+                test_id=f"nb{i}.ipynb",
+                success=True,
+                path=f"{slug}/logs/test-{i}.txt",
+                timestamp="",
+                run_id="run1",
+                repo2docker_version="",
+            )
+        )
+    with CSVResults(str(repo_dir.join("results", "results-master-run1.csv"))) as f:
+        for result in results:
+            f.add(result)
+    return results
+
+
+@pytest.fixture
+def old_run_dir(tmpdir):
+    run_dir = tmpdir.mkdir("runs")
+    results = []
+    for slug in [
+        "github.com/Org/RePo",
+        "github.com/Org/other",
+        "github.com/someone/repo",
+        "gitlab.com/Group/Project",
+    ]:
+        results.extend(make_old_repo(run_dir, slug))
+    # already migrated
+    make_old_repo(run_dir, "github.com/n/new/repo")
+    # just results, not an org
+    run_dir.join("localhost", "path").ensure("results", dir=True)
+    run_dir.join("localhost", "path").ensure("logs", dir=True)
+    store = SQLiteResults(str(run_dir.join("results.sqlite")))
+    store.add_many(results)
+    store.close()
+    return run_dir
+
+
+def test_migrate_slugs(old_run_dir):
+    run_dir = str(old_run_dir)
+    assert sorted(migrate.slug_moves(run_dir)) == [
+        ("github.com/Org/RePo", "github.com/o/org/repo"),
+        ("github.com/Org/other", "github.com/o/org/other"),
+        ("github.com/someone/repo", "github.com/s/someone/repo"),
+        ("gitlab.com/Group/Project", "gitlab.com/g/group/project"),
+    ]
+    counts = migrate.migrate(run_dir, "slugs", jobs=2, batch_size=3)
+    assert counts == {"pending": 0, "done": 4, "failed": 0}
+    assert not old_run_dir.join("github.com", "Org", "RePo").check()
+    repo_dir = old_run_dir.join("github.com", "o", "org", "repo")
+    results = list(read_csv(str(repo_dir.join("results", "results-master-run1.csv"))))
+    assert [r.path for r in results] == [
+        f"github.com/o/org/repo/logs/test-{i}.txt" for i in range(3)
+    ]
+    for r in results:
+        assert old_run_dir.join(r.path).read() == f"log {r.test_id[2]}"
+    assert os.listdir(str(repo_dir.join("results"))) == ["results-master-run1.csv"]
+    store = SQLiteResults(str(old_run_dir.join("results.sqlite")))
+    paths = {r.path for r in store.query()}
+    store.close()
+    assert len(paths) == 12
+    assert all(old_run_dir.join(path).check() for path in paths)
+
+    # running again does nothing
+    assert migrate.migrate(run_dir, "slugs", jobs=1) == counts
+
+
+def test_migrate_resume(old_run_dir):
+    run_dir = str(old_run_dir)
+    journal = migrate.Journal(migrate.default_journal(run_dir, "slugs"))
+    journal.plan("slugs", migrate.slug_moves(run_dir))
+    # interrupted after moving one directory, before recording it
+    [(move_id, src, dest)] = next(journal.pending(batch_size=1))
+    assert migrate.apply_move(run_dir, src, dest) == ""
+    # and in the middle of moving another
+    [(move_id, src, dest)] = [
+        move for move in next(journal.pending()) if move[1] == "github.com/Org/other"
+    ]
+    os.makedirs(os.path.join(run_dir, os.path.dirname(dest)), exist_ok=True)
+    os.rename(os.path.join(run_dir, src), os.path.join(run_dir, dest))
+    journal.close()
+    # a repo added since planning isn't moved
+    make_old_repo(old_run_dir, "github.com/Late/repo")
+
+    counts = migrate.migrate(run_dir, "slugs", jobs=2)
+    assert counts == {"pending": 0, "done": 4, "failed": 0}
+    for results_file in old_run_dir.visit("results-*.csv"):
+        for r in read_csv(str(results_file)):
+            assert old_run_dir.join(r.path).check(), r.path
+
+
+def test_migrate_conflict(old_run_dir, capsys):
+    run_dir = str(old_run_dir)
+    make_old_repo(old_run_dir, "github.com/o/org/repo")
+    assert checker.main(["migrate", "--run-dir", run_dir, "--jobs", "1", "slugs"]) == 1
+    out = capsys.readouterr().out
+    assert "Moved 3 repos, 1 failed" in out
+    assert "github.com/o/org/repo already exists" in out
+    # the conflict is resolved, and the failed move is retried
+    old_run_dir.join("github.com", "o", "org", "repo").remove()
+    assert not checker.main(["migrate", "--run-dir", run_dir, "slugs"])
+    assert "Moved 4 repos, 0 failed" in capsys.readouterr().out
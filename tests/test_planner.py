@@ -0,0 +1,205 @@
+from datetime import datetime
+
+from repo2docker_checker import checker
+from repo2docker_checker import planner
+from repo2docker_checker.results import SQLiteResults
+from repo2docker_checker.results import TestResult as Result
+
+NOW = datetime(2020, 7, 17)
+
+
+def make_result(repo, run_id, kind="notebook", success=True, duration="10", **kw):
+    fields = dict(
+        repo=f"https://github.com/org/{repo}",
+        ref="master",
+        resolved_ref="abc1234",
+        last_modified="",
+        kind=kind,
+        test_id="" if kind == "build" else "nb.ipynb",
+        success=success,
+        path="",
+        timestamp=f"{run_id}T00:00:00",
+        run_id=run_id,
+        repo2docker_version="0.11.0",
+        duration=duration,
+    )
+    fields.update(kw)
+    return Result(**fields)
+
+
+def make_run(
+    repo, run_id, build_seconds="100", passed=1, failed=0, cache="miss", ref="master"
+):
+    results = [
+        make_result(
+            repo, run_id, kind="build", duration=build_seconds, cache=cache, ref=ref
+        )
+    ]
+    for i in range(passed + failed):
+        results.append(
+            make_result(
+                repo, run_id, test_id=f"nb{i}.ipynb", success=i < passed, ref=ref
+            )
+        )
+    return results
+
+
+def make_runs(n):
+    return [
+        {
+            "ref": "master",
+            "timestamp": f"2020-07-{i + 1:02}T00:00:00",
+            "build_success": True,
+            "build_cache": "miss",
+            "build_seconds": 100.0,
+            "test_seconds": 10.0,
+            "passed": 1,
+            "failed": 0,
+        }
+        for i in range(n)
+    ]
+
+
+def test_load_history(tmpdir):
+    store = SQLiteResults(str(tmpdir.join("results.sqlite")))
+    store.add_many(
+        make_run("a", "2020-07-01")
+        + make_run("a", "2020-07-02", build_seconds="5", cache="env", failed=1)
+        + make_run("b", "2020-07-01", build_seconds="")
+        + make_run("c", "2020-07-01")
+        + make_run("d", "2020-07-01")
+    )
+    store.flush()
+    repo_a = "https://github.com/org/a"
+    repo_b = "https://github.com/org/b"
+    repo_c = "https://github.com/org/c"
+    repo_refs = [(repo_a, "master"), (repo_b, "master"), (repo_c, "main")]
+    history = planner.load_history(store.db, repo_refs)
+    store.close()
+    # runs at other refs count
+    assert sorted(history) == [repo_a, repo_b, repo_c]
+    assert history[repo_c][0]["ref"] == "master"
+    first, second = history[repo_a]
+    assert first["build_seconds"] == 100
+    assert first["build_cache"] == "miss"
+    assert (first["passed"], first["failed"]) == (1, 0)
+    assert second["build_seconds"] == 5
+    assert second["build_cache"] == "env"
+    assert (second["passed"], second["failed"]) == (1, 1)
+    assert second["test_seconds"] == 20
+    assert history[repo_b][0]["build_seconds"] is None
+
+
+def test_information_value():
+    never = planner.information_value([], NOW)
+    once = planner.information_value(make_runs(1), NOW)
+    stable = planner.information_value(make_runs(2), NOW)
+    runs = make_runs(2)
+    runs[-1]["failed"] = 1
+    unstable = planner.information_value(runs, NOW)
+    assert never > unstable > once > stable > 0
+    # stable results are worth checking again once they're old
+    assert planner.information_value(make_runs(2), datetime(2020, 6, 3)) == 0
+    assert planner.information_value(make_runs(2), datetime(2021, 1, 1)) == 0.5
+
+
+def test_estimate_costs():
+    candidates = [
+        {"buildpack": "conda", "cached": False, "runs": make_runs(2)},
+        {"buildpack": "conda", "cached": False, "runs": []},
+        {"buildpack": "conda", "cached": True, "runs": []},
+        {"buildpack": "r", "cached": False, "runs": []},
+    ]
+    candidates[0]["runs"][1]["build_seconds"] = 300
+    planner.estimate_costs(candidates)
+    own, same_buildpack, cached, no_history = [c["cost"] for c in candidates]
+    assert own == 200 + 10
+    # the median of the repos with the same buildpack
+    assert same_buildpack == 200 + 10
+    assert cached == planner.DEFAULT_CACHED_BUILD_SECONDS + 10
+    # the median of all repos
+    assert no_history == 200 + 10
+
+
+def test_make_schedule():
+    candidates = [
+        {"repo": f"conda-{i}", "buildpack": "conda", "value": 1, "cost": 10}
+        for i in range(8)
+    ] + [
+        {"repo": "r-cheap", "buildpack": "r", "value": 0.5, "cost": 10},
+        {"repo": "r-valuable", "buildpack": "r", "value": 1, "cost": 10},
+        {"repo": "r-checked", "buildpack": "r", "value": 0, "cost": 1},
+    ]
+    schedule = planner.make_schedule(candidates, budget_seconds=50)
+    # r gets 2/10 of the budget, and goes first in the plan
+    assert [c["repo"] for c in schedule[:2]] == ["conda-0", "r-valuable"]
+    assert [c["repo"] for c in schedule if c["buildpack"] == "r"] == ["r-valuable"]
+    assert len(schedule) == 5
+    # leftover budget goes to the most valuable of the rest
+    schedule = planner.make_schedule(candidates[-3:], budget_seconds=15)
+    assert [c["repo"] for c in schedule] == ["r-valuable"]
+    schedule = planner.make_schedule(candidates[:1] + candidates[-3:], 30)
+    assert [c["repo"] for c in schedule] == ["conda-0", "r-valuable", "r-cheap"]
+
+
+def test_plan(tmpdir, capsys, monkeypatch):
+    run_dir = tmpdir.mkdir("runs")
+    store = SQLiteResults(str(run_dir.join("results.sqlite")))
+    store.add_many(
+        make_run("a", "2020-07-01")
+        + make_run("a", "2020-07-02")
+        + make_run("c", "2020-07-01", ref="other")
+    )
+    store.close()
+    candidates = tmpdir.join("candidates.txt")
+    candidates.write("# repos\norg/a\norg/b@main\n\norg/c\norg/a\n")
+    buildpacks = {"b": "conda", "c": "docker", "a": "python"}
+    monkeypatch.setattr(
+        checker,
+        "inspect_repos",
+        lambda repo_refs, inspect, jobs: [
+            buildpacks[repo.rsplit("/", 1)[1]] for repo, ref in repo_refs
+        ],
+    )
+    monkeypatch.setattr(planner, "cached_image_repositories", lambda: set())
+    output = tmpdir.join("plan.txt")
+    checker.main(
+        [
+            "plan",
+            "--db",
+            str(run_dir.join("results.sqlite")),
+            "--budget-hours",
+            "1",
+            "--output",
+            str(output),
+            "--detect",
+            str(candidates),
+        ]
+    )
+    # interleaved by buildpack
+    assert output.read().splitlines() == [
+        "https://github.com/org/b@main",
+        "https://github.com/org/c@master",
+        "https://github.com/org/a@master",
+    ]
+    out = capsys.readouterr().out
+    assert "Picked 3/3 repos" in out
+    assert "conda: 1/1 repos (1 new)" in out
+    # c was checked at another ref
+    assert "docker: 1/1 repos (0 new)" in out
+
+    # without --detect, nothing is cloned
+    monkeypatch.setattr(checker, "inspect_repos", None)
+    checker.main(
+        [
+            "plan",
+            "--db",
+            str(run_dir.join("results.sqlite")),
+            "--budget-hours",
+            "1",
+            "--output",
+            str(output),
+            str(candidates),
+        ]
+    )
+    assert "unknown: 3/3 repos (1 new)" in capsys.readouterr().out
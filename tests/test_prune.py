@@ -0,0 +1,165 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+from repo2docker_checker import checker
+from repo2docker_checker import prune
+
+
+class FakeImage:
+    def __init__(self, id, tags, created, size):
+        self.id = id
+        self.tags = tags
+        self.attrs = {
+            "Created": time.strftime(
+                "%Y-%m-%dT%H:%M:%S.123456789Z", time.gmtime(created)
+            ),
+            "Size": size,
+        }
+
+
+class FakeContainer:
+    def __init__(self, name, status, labels=None, image="other", age=2 * 3600):
+        self.name = name
+        self.status = status
+        self.labels = labels or {}
+        self.attrs = {
+            "Config": {"Image": image},
+            "Created": time.strftime(
+                "%Y-%m-%dT%H:%M:%S.123456789Z", time.gmtime(time.time() - age)
+            ),
+        }
+        self.removed = False
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+class FakeImages:
+    def __init__(self, images):
+        self.images = images
+        self.removed = []
+
+    def list(self):
+        return self.images
+
+    def remove(self, tag):
+        self.removed.append(tag)
+
+
+class FakeContainers:
+    def __init__(self, containers):
+        self.containers = containers
+
+    def list(self, all=False):
+        return self.containers
+
+
+class FakeDocker:
+    def __init__(self, images=(), containers=()):
+        self.images = FakeImages(list(images))
+        self.containers = FakeContainers(list(containers))
+
+
+day = 24 * 3600
+
+
+@pytest.fixture
+def client():
+    now = time.time()
+    return FakeDocker(
+        images=[
+            FakeImage("a1", ["r2d-test-a:1"], now - 10 * day, 100),
+            FakeImage("a2", ["r2d-test-a:2", "r2d-test-a:env-x"], now - 5 * day, 100),
+            FakeImage("b1", ["r2d-test-b:1"], now - 8 * day, 100),
+            FakeImage("other", ["python:3.8"], now - 20 * day, 1000),
+        ]
+    )
+
+
+def test_prune_lru(client):
+    # a1 was used recently
+    prune.touch_image("r2d-test-a:1")
+    evicted = prune.prune_images(client, max_bytes=150)
+    assert [image["id"] for image in evicted] == ["b1", "a2"]
+    assert client.images.removed == ["r2d-test-b:1", "r2d-test-a:2", "r2d-test-a:env-x"]
+
+
+def test_prune_min_age(client):
+    prune.touch_image("r2d-test-a:1")
+    evicted = prune.prune_images(client, max_bytes=0, min_age=3600)
+    assert sorted(image["id"] for image in evicted) == ["a2", "b1"]
+
+
+def test_prune_oldest_ref(client):
+    # most recently used, but not the newest ref of a
+    prune.touch_image("r2d-test-a:1")
+    evicted = prune.prune_images(client, max_bytes=150, policy="oldest-ref", min_age=0)
+    assert [image["id"] for image in evicted] == ["a1", "b1"]
+
+
+def test_dry_run(client):
+    evicted = prune.prune_images(client, max_bytes=0, dry_run=True)
+    assert len(evicted) == 3
+    assert client.images.removed == []
+
+
+def test_remove_orphaned_containers():
+    label = {prune.CONTAINER_LABEL: "test"}
+    alive = dict(label, **prune.owner_labels())
+    p = subprocess.Popen(["true"])
+    p.wait()
+    dead = dict(alive, **{prune.OWNER_PID_LABEL: str(p.pid)})
+    other_host = dict(alive, **{prune.OWNER_HOST_LABEL: "elsewhere"})
+    assert alive[prune.OWNER_PID_LABEL] == str(os.getpid())
+    containers = [
+        FakeContainer("running", "running", labels=label),
+        FakeContainer("exited", "exited", labels=label),
+        FakeContainer("unlabeled", "exited", image="r2d-test-a:1"),
+        FakeContainer("other", "exited"),
+        # not started yet, or exited with logs still being read
+        FakeContainer("created", "created", labels=label, age=10),
+        FakeContainer("new", "exited", labels=label, age=10),
+        FakeContainer("old-created", "created", labels=label),
+        # owned by a live process, however old
+        FakeContainer("alive", "exited", labels=alive),
+        FakeContainer("alive-created", "created", labels=alive),
+        # owned by a process that has exited, however new
+        FakeContainer("dead", "exited", labels=dead, age=10),
+        FakeContainer("other-host", "exited", labels=other_host, age=10),
+        FakeContainer("old-other-host", "exited", labels=other_host),
+    ]
+    client = FakeDocker(containers=containers)
+    assert prune.remove_orphaned_containers(client) == 5
+    assert [c.name for c in containers if c.removed] == [
+        "exited",
+        "unlabeled",
+        "old-created",
+        "dead",
+        "old-other-host",
+    ]
+
+
+def test_prune_subcommand(client, monkeypatch, capsys):
+    monkeypatch.setattr(prune.docker, "from_env", lambda: client)
+    checker.main(["prune", "--max-image-bytes", "100", "--min-age", "0"])
+    assert client.images.removed == ["r2d-test-a:1", "r2d-test-b:1"]
+    assert "Removed 2 images" in capsys.readouterr().out
+
+
+def test_remove_stale_bases(monkeypatch):
+    monkeypatch.setattr(prune, "base_tag", lambda: "2.0")
+    now = time.time()
+    client = FakeDocker(
+        images=[
+            FakeImage("old", ["r2d-base-conda-py3.9:1.0"], now - 10 * day, 100),
+            FakeImage("new", ["r2d-base-conda-py3.9:2.0"], now - 20 * day, 100),
+            FakeImage("a1", ["r2d-test-a:1"], now - 10 * day, 100),
+        ]
+    )
+    evicted = prune.prune(client, 1, min_age=0)
+    assert [image["id"] for image in evicted] == ["a1"]
+    # bases are never evicted, only removed when stale
+    assert client.images.removed == ["r2d-base-conda-py3.9:1.0", "r2d-test-a:1"]
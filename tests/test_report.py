@@ -0,0 +1,96 @@
+import json
+
+from test_results import make_result
+
+from repo2docker_checker import checker
+from repo2docker_checker import report
+from repo2docker_checker.results import SQLiteResults
+
+
+def test_age_bucket():
+    assert report.age_bucket("2020-07-01T14:23:17+02:00", "2020-07-02T00:00:00") == (
+        "<1 month"
+    )
+    assert report.age_bucket("2018-07-01T14:23:17+02:00", "2020-07-02T00:00:00") == (
+        ">2 years"
+    )
+    assert report.age_bucket("", "2020-07-02T00:00:00") == "unknown"
+
+
+def test_report_incremental(tmpdir):
+    db_path = str(tmpdir.join("results.sqlite"))
+    store = SQLiteResults(db_path)
+    store.add_many(
+        [
+            make_result(0, run_id="run1", kind="build"),
+            make_result(1, run_id="run1", success=False),
+            make_result(1, run_id="run2"),
+            make_result(0, run_id="run2", kind="build", success=False),
+        ]
+    )
+    store.flush()
+    r = report.make_report(store.db)
+    assert {
+        (row["kind"], row["passed"], row["failed"]) for row in r["counts"]["all"]
+    } == {
+        ("build", 1, 1),
+        ("notebook", 1, 1),
+    }
+    assert r["counts"]["repo2docker_version"][0]["repo2docker_version"] == "0.11.0"
+    assert [row["test_id"] for row in r["flaky"]] == ["nb0.ipynb", "nb1.ipynb"]
+
+    # cached aggregates are reused, only new results are processed
+    assert report.update_aggregates(store.db) == 0
+    store.add(make_result(2, run_id="run3", kind="build"))
+    store.flush()
+    r = report.make_report(store.db, runs=1, kind="build")
+    assert r["runs"] == ["run3"]
+    assert r["counts"]["all"] == [
+        {"all": "", "kind": "build", "passed": 1, "failed": 0, "success_rate": 1.0}
+    ]
+    assert report.update_aggregates(store.db) == 0
+    store.close()
+
+
+def test_report_subcommand(tmpdir, capsys):
+    db_path = str(tmpdir.join("results.sqlite"))
+    store = SQLiteResults(db_path)
+    store.add_many([make_result(i, run_id=f"run{i % 3}") for i in range(10)])
+    store.close()
+    checker.main(["report", "--db", db_path])
+    out = capsys.readouterr().out
+    assert "notebook: 10 ok, 0 failed (100.0% ok)" in out
+    checker.main(["report", "--db", db_path, "--json", "--runs", "2"])
+    r = json.loads(capsys.readouterr().out)
+    assert len(r["runs"]) == 2
+    assert r["counts"]["all"][0]["passed"] == 6
+
+
+def test_report_failure_reasons(tmpdir, capsys):
+    db_path = str(tmpdir.join("results.sqlite"))
+    store = SQLiteResults(db_path)
+    store.add_many(
+        [
+            make_result(0, success=False)._replace(failure_reason="kernel-died"),
+            make_result(1, success=False)._replace(failure_reason="kernel-died"),
+            make_result(2, kind="build", success=False)._replace(
+                failure_reason="no-distribution"
+            ),
+            make_result(3),
+        ]
+    )
+    store.close()
+    checker.main(["report", "--db", db_path, "--json"])
+    r = json.loads(capsys.readouterr().out)
+    assert {
+        (row["failure_reason"], row["kind"], row["failed"])
+        for row in r["counts"]["failure_reason"]
+    } == {
+        ("", "notebook", 0),
+        ("kernel-died", "notebook", 2),
+        ("no-distribution", "build", 1),
+    }
+    checker.main(["report", "--db", db_path])
+    out = capsys.readouterr().out
+    assert "Failures by reason:" in out
+    assert "kernel-died notebook: 2 failed" in out
@@ -0,0 +1,125 @@
+import csv
+import os
+from multiprocessing import Process
+
+from repo2docker_checker import checker
+from repo2docker_checker.results import CSVResults
+from repo2docker_checker.results import find_result_files
+from repo2docker_checker.results import read_csv
+from repo2docker_checker.results import SQLiteResults
+from repo2docker_checker.results import TestResult as Result
+
+
+def make_result(i=0, run_id="run1", kind="notebook", success=True, repo="repo"):
+    return Result(
+        repo=f"https://github.com/org/{repo}",
+        ref="master",
+        resolved_ref="abc1234",
+        last_modified="2020-07-01T14:23:17+02:00",
+        kind=kind,
+        test_id=f"nb{i}.ipynb",
+        success=success,
+        path=f"logs/test-{i}.txt",
+        timestamp="2020-07-02T00:00:00",
+        run_id=run_id,
+        repo2docker_version="0.11.0",
+    )
+
+
+def test_csv_roundtrip(tmpdir):
+    path = str(tmpdir.join("results.csv"))
+    results = [make_result(i, success=i % 2 == 0) for i in range(3)]
+    with CSVResults(path) as csv_results:
+        for result in results:
+            csv_results.add(result)
+            # written right away
+            assert list(read_csv(path))[-1] == result
+    assert list(read_csv(path)) == results
+
+
+def test_csv_append(tmpdir):
+    path = str(tmpdir.join("results.csv"))
+    results = [make_result(i) for i in range(3)]
+    with CSVResults(path) as csv_results:
+        csv_results.add(results[0])
+    # a crash mid-write leaves a partial line
+    with open(path, "a") as f:
+        f.write("repo,ref,abc")
+    with CSVResults(path, append=True) as csv_results:
+        assert list(read_csv(path)) == results[:1]
+        for result in results[1:]:
+            csv_results.add(result)
+    assert list(read_csv(path)) == results
+
+
+def test_sqlite_batches(tmpdir):
+    db_path = str(tmpdir.join("results.sqlite"))
+    store = SQLiteResults(db_path, batch_size=2)
+    other = SQLiteResults(db_path)
+    store.add(make_result(0))
+    assert list(other.query()) == []
+    store.add(make_result(1))
+    # a full batch is written
+    assert len(list(other.query())) == 2
+    store.add(make_result(2, kind="build", success=False))
+    store.close()
+    assert len(list(other.query())) == 3
+    assert [r.test_id for r in other.query(kind="build")] == ["nb2.ipynb"]
+    assert [r.test_id for r in other.query(success=False)] == ["nb2.ipynb"]
+    # adding the same results again is a no-op
+    other.add_many([make_result(0), make_result(1)])
+    assert len(list(other.query())) == 3
+    other.close()
+
+
+def _write_results(db_path, run_id):
+    store = SQLiteResults(db_path, batch_size=10)
+    for i in range(100):
+        store.add(make_result(i, run_id=run_id))
+    store.close()
+
+
+def test_sqlite_concurrent_writers(tmpdir):
+    db_path = str(tmpdir.join("results.sqlite"))
+    processes = [
+        Process(target=_write_results, args=(db_path, f"run{i}")) for i in range(4)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+    store = SQLiteResults(db_path)
+    assert len(list(store.query())) == 400
+    assert len(list(store.query(run_id="run2"))) == 100
+
+
+def test_import_export(tmpdir):
+    run_dir = tmpdir.mkdir("runs")
+    repo_dir = run_dir.join("github.com", "o", "org", "repo")
+    repo_dir.join("logs").ensure(dir=True)
+    result_dir = repo_dir.join("results").ensure(dir=True)
+    results = [make_result(i) for i in range(3)]
+    with CSVResults(str(result_dir.join("results-master-run1.csv"))) as csv_results:
+        for result in results:
+            csv_results.add(result)
+    # results from before the 'cache' column was added
+    old_results = [make_result(i, run_id="run0") for i in range(2)]
+    with result_dir.join("results-master-run0.csv").open("w") as f:
+        writer = csv.writer(f)
+        writer.writerow(Result._fields[:-1])
+        for result in old_results:
+            writer.writerow(result[:-1])
+    assert len(list(find_result_files(str(run_dir)))) == 2
+
+    db_path = str(tmpdir.join("results.sqlite"))
+    checker.main(["results", "--db", db_path, "import", str(run_dir)])
+    # importing twice doesn't duplicate results
+    checker.main(["results", "--db", db_path, "import", str(run_dir)])
+    store = SQLiteResults(db_path)
+    assert sorted(store.query()) == sorted(old_results + results)
+
+    out = str(tmpdir.join("out.csv"))
+    checker.main(["results", "--db", db_path, "export", "--run-id", "run1", out])
+    assert list(read_csv(out)) == results
+    assert os.path.exists(out)
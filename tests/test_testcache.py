@@ -0,0 +1,128 @@
+import json
+
+from conftest import git
+
+from repo2docker_checker import testcache
+
+
+def write_notebook(path, source="1 + 1", kernel="python3"):
+    nb = {
+        "cells": [{"cell_type": "code", "source": source}],
+        "metadata": {"kernelspec": {"name": kernel}},
+    }
+    path.write(json.dumps(nb))
+
+
+def commit(repo):
+    """Commit everything in a repo, creating it if needed"""
+    if not repo.join(".git").exists():
+        git("init", "-q", cwd=str(repo))
+    git("add", "-A", cwd=str(repo))
+    git("commit", "-q", "--allow-empty", "-m", "commit", cwd=str(repo))
+
+
+def test_cache_keys(tmpdir, monkeypatch):
+    repo = tmpdir.mkdir("repo")
+    repo.join("requirements.txt").write("numpy\n")
+    write_notebook(repo.join("a.ipynb"))
+    write_notebook(repo.join("b.ipynb"))
+    nb_paths = ["a.ipynb", "b.ipynb", "missing.ipynb"]
+    # not a git repo
+    assert testcache.cache_keys("repo", str(repo), nb_paths) == {}
+    commit(repo)
+    keys = testcache.cache_keys("repo", str(repo), nb_paths)
+    assert sorted(keys) == ["a.ipynb", "b.ipynb"]
+    # the same content at another path is another test
+    assert keys["a.ipynb"] != keys["b.ipynb"]
+    assert testcache.cache_keys("repo", str(repo), nb_paths) == keys
+    assert testcache.cache_keys("other", str(repo), nb_paths) != keys
+
+    write_notebook(repo.join("b.ipynb"), source="2 + 2")
+    commit(repo)
+    changed = testcache.cache_keys("repo", str(repo), nb_paths)
+    assert changed["a.ipynb"] == keys["a.ipynb"]
+    assert changed["b.ipynb"] != keys["b.ipynb"]
+
+    write_notebook(repo.join("b.ipynb"), kernel="ir")
+    commit(repo)
+    assert testcache.cache_keys("repo", str(repo), nb_paths) != keys
+
+    # a data file or module the notebooks may use changed
+    keys = testcache.cache_keys("repo", str(repo), nb_paths)
+    repo.mkdir("data").join("data.csv").write("a,b\n")
+    commit(repo)
+    changed = testcache.cache_keys("repo", str(repo), nb_paths)
+    assert changed["a.ipynb"] != keys["a.ipynb"]
+    assert changed["b.ipynb"] != keys["b.ipynb"]
+
+    # the environment changed
+    keys = changed
+    repo.join("requirements.txt").write("numpy==1.19\n")
+    commit(repo)
+    changed = testcache.cache_keys("repo", str(repo), nb_paths)
+    assert changed["a.ipynb"] != keys["a.ipynb"]
+    monkeypatch.setattr(testcache.repo2docker, "__version__", "0.0.0")
+    assert testcache.cache_keys("repo", str(repo), nb_paths) != changed
+
+    # the environment may depend on anything
+    repo.join("setup.py").write("")
+    commit(repo)
+    assert testcache.cache_keys("repo", str(repo), nb_paths) == {}
+
+
+def test_cache_keys_postbuild(tmpdir):
+    repo = tmpdir.mkdir("repo")
+    repo.join("requirements.txt").write("numpy\n")
+    write_notebook(repo.join("a.ipynb"))
+    commit(repo)
+    assert testcache.cache_keys("repo", str(repo), ["a.ipynb"])
+    # postBuild can change the environment without changing any hashed file
+    # (e.g. `pip install ./mypkg`), so nothing is cached,
+    # and only changing postBuild can't carry forward a result
+    repo.join("postBuild").write("pip install ./mypkg\n")
+    assert testcache.cache_keys("repo", str(repo), ["a.ipynb"]) == {}
+    repo.join("postBuild").write("pip install ./otherpkg\n")
+    assert testcache.cache_keys("repo", str(repo), ["a.ipynb"]) == {}
+    # as with local installs from requirements
+    repo.join("postBuild").remove()
+    repo.join("requirements.txt").write("-e .\n")
+    assert testcache.cache_keys("repo", str(repo), ["a.ipynb"]) == {}
+
+
+def test_kernel_name():
+    assert (
+        testcache.kernel_name(b'{"metadata": {"kernelspec": {"name": "ir"}}}') == "ir"
+    )
+    assert testcache.kernel_name(b'{"metadata": {}}') == ""
+    assert testcache.kernel_name(b"not json") == ""
+
+
+def test_test_cache(tmpdir):
+    run_dir = tmpdir.mkdir("runs")
+    log_file = run_dir.mkdir("logs").join("test-a.txt")
+    log_file.write("ok")
+    cache = testcache.TestCache(str(run_dir.join("test-cache.sqlite")))
+    assert cache.get("key1") is None
+    cache.add("key1", "repo", "a.ipynb", str(log_file), 1.5, "run1")
+    assert cache.get("key1") == {
+        "path": str(log_file),
+        "duration": "1.5",
+        "run_id": "run1",
+    }
+    # only the latest result of each test is kept
+    cache.add("key2", "repo", "a.ipynb", str(log_file), 2, "run2")
+    assert cache.get("key1") is None
+    assert cache.get("key2")["run_id"] == "run2"
+    cache.close()
+
+    # paths are relative to the run directory
+    run_dir.move(tmpdir.join("moved"))
+    cache = testcache.TestCache(str(tmpdir.join("moved", "test-cache.sqlite")))
+    assert cache.get("key2")["path"] == str(tmpdir.join("moved", "logs", "test-a.txt"))
+    # no log, no result
+    tmpdir.join("moved", "logs", "test-a.txt").remove()
+    assert cache.get("key2") is None
+    cache.add("key2", "repo", "a.ipynb", str(log_file), 2, "run2")
+    cache.discard("repo", "a.ipynb")
+    assert cache.get("key2") is None
+    cache.close()
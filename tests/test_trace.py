@@ -0,0 +1,79 @@
+import json
+from multiprocessing import Process
+
+import pytest
+
+from repo2docker_checker import trace
+from repo2docker_checker.trace import read_trace
+from repo2docker_checker.trace import Tracer
+
+
+def test_span(tmpdir):
+    path = str(tmpdir.join("trace.json"))
+    tracer = Tracer(path)
+    with tracer.span("outer", repo="repo") as args:
+        with tracer.span("inner"):
+            pass
+        args["log_bytes"] = 10
+    with pytest.raises(ValueError):
+        with tracer.span("fails"):
+            raise ValueError("oops")
+
+    events = read_trace(path)
+    assert [e["name"] for e in events] == ["inner", "outer", "fails"]
+    inner, outer, fails = events
+    assert outer["ph"] == "X"
+    assert outer["ts"] <= inner["ts"]
+    assert outer["dur"] >= inner["dur"]
+    assert outer["args"]["repo"] == "repo"
+    assert outer["args"]["log_bytes"] == 10
+    assert outer["args"]["max_rss_increase"] >= 0
+    assert fails["args"]["error"] == "ValueError"
+
+    # a valid Chrome trace, once closed
+    with open(path) as f:
+        content = f.read()
+    assert json.loads(content.rstrip().rstrip(",") + "]") == events
+
+
+def test_span_max_rss(monkeypatch):
+    peaks = iter([100, 100, 150, 150, 150, 150])
+    monkeypatch.setattr(trace, "max_rss", lambda: next(peaks))
+    tracer = Tracer()
+    with tracer.span("outer") as outer:
+        # a new peak
+        with tracer.span("inner") as inner:
+            pass
+    assert inner["max_rss_increase"] == 50
+    assert outer["max_rss_increase"] == 50
+    with tracer.span("after") as after:
+        pass
+    assert after["max_rss_increase"] == 0
+
+
+def test_span_no_path():
+    tracer = Tracer()
+    with tracer.span("nothing") as args:
+        pass
+    assert args["duration"] >= 0
+
+
+def _write_spans(path, n):
+    tracer = Tracer(path)
+    for i in range(n):
+        with tracer.span("span", i=i):
+            pass
+
+
+def test_concurrent_writers(tmpdir):
+    path = str(tmpdir.join("trace.json"))
+    procs = [Process(target=_write_spans, args=(path, 50)) for i in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    events = read_trace(path)
+    assert len(events) == 200
+    assert len({e["pid"] for e in events}) == 4
+    with open(path) as f:
+        assert f.readline() == "[\n"
@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from repo2docker_checker import workqueue
+from repo2docker_checker.workqueue import JobQueue
+from repo2docker_checker.workqueue import work
+
+
+def test_lease_complete(tmpdir):
+    q = JobQueue(str(tmpdir.join("queue.sqlite")))
+    assert q.add([("repo1", "ref"), ("repo2", "ref")]) == 2
+    # already queued
+    assert q.add([("repo1", "ref")]) == 0
+    job1 = q.lease()
+    job2 = q.lease()
+    assert (job1.repo, job2.repo) == ("repo1", "repo2")
+    assert job1.attempts == 1
+    assert q.lease() is None
+    assert q.counts()["leased"] == 2
+    q.complete(job1, "results.csv")
+    q.complete(job2)
+    assert q.counts() == {"pending": 0, "leased": 0, "done": 2, "failed": 0}
+    assert not q.unfinished()
+    assert q.jobs("done")[0]["result_file"] == "results.csv"
+
+
+def test_fail_retry(tmpdir):
+    q = JobQueue(str(tmpdir.join("queue.sqlite")), retry_delay=0)
+    q.add([("repo", "ref")], max_attempts=2)
+    job = q.lease()
+    q.fail(job, "oops")
+    assert q.counts()["pending"] == 1
+    job = q.lease()
+    assert job.attempts == 2
+    q.fail(job, "oops again")
+    assert q.lease() is None
+    assert q.counts()["failed"] == 1
+    assert q.jobs("failed")[0]["error"] == "oops again"
+    assert q.retry_failed() == 1
+    assert q.lease().attempts == 1
+
+
+def test_retry_delay(tmpdir):
+    q = JobQueue(str(tmpdir.join("queue.sqlite")), retry_delay=60)
+    q.add([("repo", "ref")])
+    q.fail(q.lease(), "oops")
+    # not ready to retry yet
+    assert q.lease() is None
+    assert q.unfinished()
+
+
+def test_lease_expires(tmpdir):
+    path = str(tmpdir.join("queue.sqlite"))
+    q1 = JobQueue(path, lease_seconds=0.1)
+    q2 = JobQueue(path)
+    q1.add([("repo", "ref")])
+    job = q1.lease()
+    assert q2.lease() is None
+    time.sleep(0.2)
+    job2 = q2.lease()
+    assert job2.repo == "repo"
+    assert job2.attempts == 2
+    # the first worker has lost the job
+    assert not q1.renew(job)
+    q1.complete(job)
+    assert q2.counts()["leased"] == 1
+    q2.complete(job2)
+    assert q2.counts()["done"] == 1
+
+
+def test_heartbeat(tmpdir):
+    path = str(tmpdir.join("queue.sqlite"))
+    q1 = JobQueue(path, lease_seconds=0.3)
+    q2 = JobQueue(path)
+    q1.add([("repo", "ref")])
+    job = q1.lease()
+    with q1.heartbeat(job):
+        time.sleep(1)
+        assert q2.lease() is None
+    q1.complete(job)
+    assert q2.counts()["done"] == 1
+
+
+def _worker(path, record_path):
+    """A worker process, recording the jobs it finishes"""
+
+    def run_job(job):
+        time.sleep(0.05)
+        if job.repo == "crash" and job.attempts == 1:
+            # the worker dies, without giving up its lease
+            os._exit(1)
+        if job.repo == "flaky" and job.attempts == 1:
+            raise RuntimeError("flaky")
+        with open(record_path, "a") as f:
+            f.write(f"{os.getpid()} {job.repo} {job.attempts}\n")
+        return f"{job.repo}.csv"
+
+    job_queue = JobQueue(path, lease_seconds=1, retry_delay=0)
+    work(job_queue, run_job, jobs=2, poll_interval=0.1)
+
+
+def test_worker_processes(tmpdir):
+    path = str(tmpdir.join("queue.sqlite"))
+    record_path = str(tmpdir.join("records.txt"))
+    q = JobQueue(path)
+    repos = [f"repo{i}" for i in range(20)] + ["crash", "flaky"]
+    q.add([(repo, "ref") for repo in repos])
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_worker, args=(path, record_path)) for i in range(3)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(60)
+    assert q.counts() == {"pending": 0, "leased": 0, "done": 22, "failed": 0}
+    with open(record_path) as f:
+        records = [line.split() for line in f]
+    # each job finished at least once
+    # (the worker that crashed may have finished a job without marking it done)
+    assert {repo for pid, repo, attempts in records} == set(repos)
+    assert len(records) <= len(repos) + 1
+    attempts = {repo: int(attempts) for pid, repo, attempts in records}
+    assert attempts["flaky"] == 2
+    assert attempts["crash"] == 2
+    # jobs were shared by the workers that survived
+    assert len({pid for pid, repo, attempts in records}) >= 2
+
+
+def test_queue_main(tmpdir, capsys):
+    path = str(tmpdir.join("runs", "queue.sqlite"))
+    workqueue.main(["add", "--queue", path, "--run-id", "run1", "org/a", "org/b@v1"])
+    workqueue.main(["add", "--queue", path, "org/a"])
+    q = JobQueue(path)
+    assert q.run_id == "run1"
+    assert [(job["repo"], job["ref"]) for job in q.jobs()] == [
+        ("https://github.com/org/a", "master"),
+        ("https://github.com/org/b", "v1"),
+    ]
+    job = q.lease()
+    q.fail(job, "oops")
+    workqueue.main(["status", "--queue", path])
+    out = capsys.readouterr().out
+    assert "Added 2 repos" in out
+    assert "Added 0 repos" in out
+    assert "pending: 2" in out
+
+
+def test_network_filesystem(tmpdir, monkeypatch):
+    mounts = tmpdir.join("mounts")
+    mounts.write(
+        "\n".join(
+            [
+                "/dev/sda1 / ext4 rw 0 0",
+                "server:/export /mnt/shared nfs4 rw 0 0",
+                "/dev/sdb1 /mnt/shared/local ext4 rw 0 0",
+                "//server/share /mnt/my\\040share cifs rw 0 0",
+            ]
+        )
+    )
+    mounts_file = str(mounts)
+    assert workqueue.network_filesystem("/home/user", mounts_file) is None
+    assert workqueue.network_filesystem("/mnt/shared/runs", mounts_file) == "nfs4"
+    assert workqueue.network_filesystem("/mnt/shared", mounts_file) == "nfs4"
+    # the innermost mount wins
+    assert workqueue.network_filesystem("/mnt/shared/local/runs", mounts_file) is None
+    assert workqueue.network_filesystem("/mnt/sharedx", mounts_file) is None
+    assert workqueue.network_filesystem("/mnt/my share/runs", mounts_file) == "cifs"
+    # no mount table
+    assert workqueue.network_filesystem("/mnt/shared", str(tmpdir.join("x"))) is None
+
+    # queues on network filesystems are refused
+    monkeypatch.setattr(workqueue, "network_filesystem", lambda path: "nfs")
+    with pytest.raises(ValueError, match="network filesystem"):
+        JobQueue(str(tmpdir.join("queue.sqlite")))
+    with pytest.raises(SystemExit):
+        workqueue.main(["status", "--queue", str(tmpdir.join("queue.sqlite"))])